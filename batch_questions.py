@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import time
+from langgraph.graph.state import CompiledStateGraph
+from typing import Any
+from single_flight import SingleFlight
+
+# Runs a file of questions, one per line, through the graph of an agent, e.g.
+#   python batch_questions.py product_insight_agent questions.txt --max-concurrency 8 --output temp/answers.jsonl
+# Up to --max-concurrency questions are in flight at once, and the work that only depends on the product the question
+# is about, i.e., the retrieval or web search and the analysis, is done once per distinct product across the batch.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger: logging.Logger = logging.getLogger(__name__)
+
+def parse_args() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Answers a batch of questions with an agent')
+    parser.add_argument('agent', choices=['product_insight_agent', 'market_analysis_agent'])
+    parser.add_argument('questions', help='path to a text file with one question per line')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='number of questions in flight at once')
+    parser.add_argument('--output', help='path to write the S3 location of each answer to as JSON lines')
+    return parser.parse_args()
+
+def read_questions(path: str) -> list[str]:
+    # blank lines and lines starting with # are skipped
+    with open(path, encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
+
+async def abatch_questions(
+    graph: CompiledStateGraph, questions: list[str], max_concurrency: int = 8
+) -> list[dict[str, Any] | Exception]:
+    """
+    Runs the questions through the graph concurrently, sharing the work of the nodes across the questions
+
+    :param graph: Graph of an agent whose nodes coalesce their work, see single_flight.coalesce
+    :param questions: Questions to answer
+    :param max_concurrency: Maximum number of questions in flight at once
+    :return: Final state of the graph for each question, or the exception it failed with, in the order of the questions
+    """
+    single_flight: SingleFlight = SingleFlight()
+    started: float = time.perf_counter()
+    results: list[dict[str, Any] | Exception] = await graph.abatch(
+        [{'question': question} for question in questions],
+        config={'max_concurrency': max_concurrency, 'configurable': {'single_flight': single_flight}},
+        return_exceptions=True
+    )
+    failed: int = sum(isinstance(result, Exception) for result in results)
+    logger.info(
+        f'Answered {len(questions) - failed} of {len(questions)} questions in {time.perf_counter() - started:.1f}s, '
+        f'{single_flight.hits} of {single_flight.hits + single_flight.misses} node runs coalesced'
+    )
+    return results
+
+if __name__ == '__main__':
+    args: argparse.Namespace = parse_args()
+    graph: CompiledStateGraph = importlib.import_module(args.agent).graph
+    questions: list[str] = read_questions(args.questions)
+    results: list[dict[str, Any] | Exception] = asyncio.run(abatch_questions(graph, questions, args.max_concurrency))
+    lines: list[str] = []
+    for question, result in zip(questions, results):
+        if isinstance(result, Exception):
+            logger.error(f'Question: "{question}" failed: {result!r}')
+            lines.append(json.dumps({'question': question, 'error': repr(result)}, ensure_ascii=False))
+        else:
+            lines.append(json.dumps(
+                {'question': question, 's3_result_location': result['s3_result_location']}, ensure_ascii=False
+            ))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import boto3
+import json
+import logging
+import psycopg
+import sys
+import time
+from botocore.config import Config
+from dataclasses import asdict
+from langchain_core.documents import Document
+from psycopg import sql
+from typing import Any, Awaitable, Callable
+from benchmark_stubs import FakeS3Client, FakeVectorStoreWriter, StubEmbeddingServer, generate_corpus
+from ingestion_pipeline import build_ingestion_pipeline
+from json_chunker import JsonChunker
+from ollama_pool import OllamaPool, PooledOllamaEmbeddings
+from pg_bulk_load import CopyWriter
+from pipeline import Pipeline, StageStats
+from s3_utils import S3Object, list_objects
+from vector_index import ensure_indexable_column
+
+# Measures the throughput of the document loader's ingestion pipeline against a synthetic corpus, with stub services by
+# default so that it runs anywhere, e.g.
+#   python benchmark_ingestion.py --objects 5 --records 500 --output temp/benchmark.json
+#   python benchmark_ingestion.py --baseline temp/benchmark.json --max-regression 0.1
+# Pass --s3-endpoint, --postgres and/or --ollama-url to benchmark against MinIO, Postgres and Ollama instead, and
+# --stub-endpoints (or several --ollama-url endpoints) along with a higher --max-concurrency to embed on a pool of them.
+# Lower --range-threshold below the size of the objects, e.g. to --range-threshold 65536 --part-size 16384, to fetch
+# them with ranged GETs like multi-GB exports.
+
+S3_BUCKET: str = 'benchmark'
+TABLE_NAME: str = 'benchmark_vectorstore'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger: logging.Logger = logging.getLogger(__name__)
+
+def parse_args() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Benchmarks the ingestion pipeline')
+    corpus = parser.add_argument_group('corpus')
+    corpus.add_argument('--objects', type=int, default=3, help='number of output-#.json files')
+    corpus.add_argument('--records', type=int, default=200, help='number of records per file')
+    corpus.add_argument('--reviews', type=int, default=5, help='number of reviews nested in each record')
+    corpus.add_argument('--text-length', type=int, default=400, help='characters of each free text field')
+    corpus.add_argument('--seed', type=int, default=42)
+    services = parser.add_argument_group('services')
+    services.add_argument('--s3-endpoint', help='S3 endpoint (e.g. MinIO) to upload the corpus to, in-process fake by default')
+    services.add_argument('--s3-access-key', default='admin')
+    services.add_argument('--s3-secret-key', default='password')
+    services.add_argument('--s3-latency', type=float, default=0.01, help='latency of each GET of the fake S3')
+    services.add_argument('--ollama-url', help='comma separated Ollama endpoints to embed with, stub embedding servers by default')
+    services.add_argument('--stub-endpoints', type=int, default=1, help='number of stub embedding servers')
+    services.add_argument('--endpoint-max-concurrency', type=int, default=4, help='embedding requests in flight per endpoint')
+    services.add_argument('--model', default='llama3.2:3b')
+    services.add_argument('--dimensions', type=int, default=3072, help='dimensions of the stub embeddings')
+    services.add_argument('--embed-latency', type=float, default=0.05, help='latency of each stub embedding request')
+    services.add_argument('--embed-latency-per-input', type=float, default=0.002, help='latency added per text embedded')
+    services.add_argument('--postgres', help=f'psycopg connection string to COPY into a "{TABLE_NAME}" table, discarded by default')
+    services.add_argument('--write-latency', type=float, default=0.005, help='latency of each fake write')
+    ingestion = parser.add_argument_group('ingestion')
+    ingestion.add_argument('--chunk-size', type=int, default=1000)
+    ingestion.add_argument('--batch-size', type=int, default=64)
+    ingestion.add_argument('--max-concurrency', type=int, default=4)
+    ingestion.add_argument('--max-write-concurrency', type=int, default=2)
+    ingestion.add_argument('--queue-size', type=int, default=16)
+    ingestion.add_argument('--s3-max-workers', type=int, default=16)
+    ingestion.add_argument('--range-threshold', type=int, default=16 * 1024 * 1024, help='size from which objects are fetched with ranged GETs')
+    ingestion.add_argument('--part-size', type=int, default=8 * 1024 * 1024, help='size of each ranged GET')
+    ingestion.add_argument('--s3-max-buffer-bytes', type=int, default=64 * 1024 * 1024, help='bytes fetched ahead of the parser')
+    ingestion.add_argument('--report-interval', type=float, default=10.0)
+    results = parser.add_argument_group('results')
+    results.add_argument('--output', help='path to write the results to as JSON, e.g. to use as a baseline later')
+    results.add_argument('--baseline', help='path of the results of a previous run to compare against')
+    results.add_argument('--max-regression', type=float, default=0.1, help='tolerated regression relative to the baseline')
+    return parser.parse_args()
+
+def peak_rss_bytes() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes on Linux but in bytes on macOS
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def create_benchmark_table(conninfo: str, table_name: str, vector_size: int) -> None:
+    # same columns as PGEngine.init_vectorstore_table
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+        conn.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(table_name)))
+        conn.execute(sql.SQL(
+            """CREATE TABLE {}(
+                langchain_id UUID PRIMARY KEY,
+                content TEXT NOT NULL,
+                embedding vector({}) NOT NULL,
+                langchain_metadata JSON
+            )"""
+        ).format(sql.Identifier(table_name), sql.Literal(vector_size)))
+    ensure_indexable_column(conninfo, table_name, vector_size)
+
+def setup_s3(args: argparse.Namespace) -> Any:
+    if args.s3_endpoint:
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=args.s3_access_key,
+            aws_secret_access_key=args.s3_secret_key,
+            endpoint_url=args.s3_endpoint,
+            config=Config(max_pool_connections=args.s3_max_workers)
+        )
+        if S3_BUCKET not in [bucket['Name'] for bucket in s3_client.list_buckets()['Buckets']]:
+            s3_client.create_bucket(Bucket=S3_BUCKET)
+    else:
+        s3_client = FakeS3Client(latency_seconds=args.s3_latency)
+    size: int = 0
+    for key, body in generate_corpus(args.objects, args.records, args.reviews, args.text_length, args.seed):
+        s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=body)
+        size += len(body)
+    logger.info(f'Generated {args.objects} objects ({size / 1024 ** 2:.1f} MiB) in s3://{S3_BUCKET}')
+    return s3_client
+
+def run_benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    s3_client = setup_s3(args)
+    stubs: list[StubEmbeddingServer] = []
+    if not args.ollama_url:
+        stubs = [
+            StubEmbeddingServer(args.dimensions, args.embed_latency, args.embed_latency_per_input).start()
+            for _ in range(args.stub_endpoints)
+        ]
+    pool: OllamaPool = OllamaPool(
+        args.ollama_url.split(',') if args.ollama_url else [stub.base_url for stub in stubs],
+        max_concurrency=args.endpoint_max_concurrency
+    )
+    writer: CopyWriter | None = None
+    write_batch: Callable[[list[Document], list[list[float]]], Awaitable[list[str]]]
+    if args.postgres:
+        create_benchmark_table(args.postgres, TABLE_NAME, args.dimensions)
+        writer = CopyWriter(args.postgres, TABLE_NAME, upsert=False, max_connections=args.max_write_concurrency)
+        write_batch = lambda batch, vectors: asyncio.to_thread(writer.write, batch, vectors)
+    else:
+        write_batch = FakeVectorStoreWriter(args.write_latency).awrite
+    try:
+        objects: list[S3Object] = list(list_objects(s3_client, S3_BUCKET, '', 'output-*.json'))
+        sources: list[tuple[S3Object, dict[str, Any]]] = [
+            (obj, { 'source': f's3://{S3_BUCKET}/{obj.key}', 'document_seq_num': i + 1 }) for i, obj in enumerate(objects)
+        ]
+        pipeline: Pipeline = build_ingestion_pipeline(
+            s3_client,
+            S3_BUCKET,
+            sources,
+            JsonChunker(max_chunk_size=args.chunk_size),
+            PooledOllamaEmbeddings(pool=pool, model=args.model),
+            write_batch,
+            batch_size=args.batch_size,
+            max_concurrency=args.max_concurrency,
+            max_write_concurrency=args.max_write_concurrency,
+            queue_size=args.queue_size,
+            s3_max_workers=args.s3_max_workers,
+            s3_range_threshold=args.range_threshold,
+            s3_part_size=args.part_size,
+            s3_max_buffer_bytes=args.s3_max_buffer_bytes
+        )
+        started: float = time.perf_counter()
+        ids_by_batch: list[list[str]] = asyncio.run(pipeline.arun(report_interval_seconds=args.report_interval))
+        elapsed: float = time.perf_counter() - started
+    finally:
+        pool.close()
+        for stub in stubs:
+            stub.stop()
+        if writer is not None:
+            writer.close()
+
+    stages: dict[str, StageStats] = { stats.name: stats for stats in pipeline.stages }
+    documents: int = stages['parse'].items_out
+    chunks: int = sum(len(ids) for ids in ids_by_batch)
+    return {
+        'config': vars(args),
+        'elapsed_seconds': elapsed,
+        'documents': documents,
+        'chunks': chunks,
+        'documents_per_second': documents / elapsed,
+        'chunks_per_second': chunks / elapsed,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': {
+            name: {
+                **asdict(stats),
+                'items_per_second': stats.items_out / elapsed,
+                'busy_seconds': stats.busy_seconds(elapsed),
+            }
+            for name, stats in stages.items()
+        },
+    }
+
+def compare_to_baseline(result: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> list[str]:
+    """
+    Compares the throughput and peak RSS of a run against a previous run
+
+    :param result: Results of this run
+    :param baseline: Results of the previous run
+    :param max_regression: Tolerated regression, e.g. 0.1 for 10% lower throughput or 10% higher peak RSS
+    :return: Description of every regression beyond the tolerance
+    """
+    regressions: list[str] = []
+    for metric in ('documents_per_second', 'chunks_per_second'):
+        if result[metric] < baseline[metric] * (1 - max_regression):
+            regressions.append(f'{metric} dropped from {baseline[metric]:.1f} to {result[metric]:.1f}')
+    if result['peak_rss_bytes'] and baseline.get('peak_rss_bytes') \
+            and result['peak_rss_bytes'] > baseline['peak_rss_bytes'] * (1 + max_regression):
+        regressions.append(
+            f'peak_rss_bytes grew from {baseline["peak_rss_bytes"] / 1024 ** 2:.0f} MiB '
+            f'to {result["peak_rss_bytes"] / 1024 ** 2:.0f} MiB'
+        )
+    return regressions
+
+def print_report(result: dict[str, Any]) -> None:
+    print(f'{result["documents"]} documents and {result["chunks"]} chunks in {result["elapsed_seconds"]:.2f}s')
+    print(f'{result["documents_per_second"]:.1f} documents/s, {result["chunks_per_second"]:.1f} chunks/s')
+    if result['peak_rss_bytes'] is not None:
+        print(f'peak RSS {result["peak_rss_bytes"] / 1024 ** 2:.0f} MiB')
+    print(f'{"stage":<8}{"items":>8}{"items/s":>10}{"busy s":>9}{"starved s":>11}{"stalled s":>11}{"max queue":>11}')
+    for name, stats in result['stages'].items():
+        print(
+            f'{name:<8}{stats["items_out"]:>8}{stats["items_per_second"]:>10.1f}{stats["busy_seconds"]:>9.2f}'
+            f'{stats["starved_seconds"]:>11.2f}{stats["stalled_seconds"]:>11.2f}{stats["max_queue_depth"]:>11}'
+        )
+
+if __name__ == '__main__':
+    # guarded since the stub embedding server's process re-imports this module where processes are spawned
+    args: argparse.Namespace = parse_args()
+    result: dict[str, Any] = run_benchmark(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions: list[str] = compare_to_baseline(result, json.load(file), args.max_regression)
+        for regression in regressions:
+            logger.error(f'Regression: {regression}')
+        sys.exit(1 if regressions else 0)
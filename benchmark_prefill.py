@@ -0,0 +1,109 @@
+import argparse
+import json
+import logging
+import random
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_ollama import ChatOllama
+from typing import Any
+from benchmark_stubs import generate_record
+import market_analysis_agent
+import product_insight_agent
+from resources import OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE, OLLAMA_MODEL_ID, OLLAMA_NUM_CTX
+
+# Measures the prompt evaluation (prefill) of the agents' prompts with the static instructions as a leading system
+# message, which Ollama reuses from one request to the next, against the same prompts with the request's content
+# ahead of the instructions in a single message as they used to be, e.g.
+#   python benchmark_prefill.py --vehicles "Tesla Cybertruck" "Hyundai IONIQ 5" "Kia EV6"
+# Only a single token is generated per request so that the time measured is the prefill.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger: logging.Logger = logging.getLogger(__name__)
+
+def parse_args() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Benchmarks the prefill of the agent prompts')
+    parser.add_argument('--ollama-url', default=OLLAMA_BASE_URL)
+    parser.add_argument('--model', default=OLLAMA_MODEL_ID)
+    parser.add_argument('--num-ctx', type=int, default=OLLAMA_NUM_CTX)
+    parser.add_argument('--keep-alive', type=int, default=OLLAMA_KEEP_ALIVE)
+    parser.add_argument('--vehicles', nargs='+', default=['Tesla Cybertruck', 'Hyundai IONIQ 5', 'Kia EV6'])
+    parser.add_argument('--context-chars', type=int, default=4000, help='characters of the synthetic context per topic')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='path to write the results to as JSON')
+    return parser.parse_args()
+
+def synthetic_context(rnd: random.Random, context_chars: int) -> str:
+    parts: list[str] = []
+    while sum(len(part) for part in parts) < context_chars:
+        parts.append(json.dumps(generate_record(rnd, len(parts) + 1, 2, 300), ensure_ascii=False, separators=(',', ':')))
+    return '\n\n'.join(parts)
+
+def build_requests(args: argparse.Namespace) -> list[tuple[str, ChatPromptTemplate, dict[str, Any]]]:
+    # the requests in the order the agents send them, i.e., the extraction followed by the analysis of every topic
+    rnd: random.Random = random.Random(args.seed)
+    requests: list[tuple[str, ChatPromptTemplate, dict[str, Any]]] = []
+    for vehicle in args.vehicles:
+        question: str = f'Summarize the product information and customer feedback for {vehicle} in English.'
+        requests.append(('product extract', product_insight_agent.EXTRACT_PROMPT, {'question': question}))
+        requests.append(('market extract', market_analysis_agent.EXTRACT_PROMPT, {'question': question}))
+        for topic_num, topic in enumerate(product_insight_agent.ANALYSIS_TOPICS, start=1):
+            requests.append(('product topic', product_insight_agent.GENERATE_TOPIC_PROMPT, {
+                'vehicle': vehicle,
+                'topic': product_insight_agent.format_analysis_topic(topic_num, topic),
+                'context': synthetic_context(rnd, args.context_chars),
+            }))
+    return requests
+
+def interleaved(messages: list[BaseMessage]) -> list[BaseMessage]:
+    # the content of the request first and the instructions after it, so no two requests share a prefix
+    return [HumanMessage('\n'.join(message.content for message in reversed(messages)))]
+
+def run_layout(llm: ChatOllama, requests: list[tuple[str, ChatPromptTemplate, dict[str, Any]]], prefix: bool) -> dict[str, Any]:
+    by_prompt: dict[str, dict[str, float]] = {}
+    for name, prompt, values in requests:
+        messages: list[BaseMessage] = prompt.invoke(values).to_messages()
+        response: BaseMessage = llm.invoke(messages if prefix else interleaved(messages))
+        metadata: dict[str, Any] = response.response_metadata
+        stats: dict[str, float] = by_prompt.setdefault(name, {'requests': 0, 'prompt_tokens': 0, 'prefill_seconds': 0.0})
+        stats['requests'] += 1
+        # Ollama only counts and times the tokens of the prompt it had to evaluate, i.e., not the cached prefix
+        stats['prompt_tokens'] += metadata.get('prompt_eval_count', 0)
+        stats['prefill_seconds'] += metadata.get('prompt_eval_duration', 0) / 1e9
+    return {
+        'prompt_tokens': sum(stats['prompt_tokens'] for stats in by_prompt.values()),
+        'prefill_seconds': sum(stats['prefill_seconds'] for stats in by_prompt.values()),
+        'prompts': by_prompt,
+    }
+
+def print_report(results: dict[str, dict[str, Any]]) -> None:
+    print(f'{"layout":<13}{"prompt":<17}{"requests":>9}{"tokens":>9}{"prefill s":>11}')
+    for layout, result in results.items():
+        for name, stats in result['prompts'].items():
+            print(
+                f'{layout:<13}{name:<17}{stats["requests"]:>9}{stats["prompt_tokens"]:>9}'
+                f'{stats["prefill_seconds"]:>11.2f}'
+            )
+    interleaved_seconds: float = results['interleaved']['prefill_seconds']
+    prefix_seconds: float = results['prefix']['prefill_seconds']
+    print(
+        f'prefill {interleaved_seconds:.2f}s interleaved, {prefix_seconds:.2f}s with the static prefix, '
+        f'{interleaved_seconds - prefix_seconds:.2f}s '
+        f'({(1 - prefix_seconds / interleaved_seconds) * 100 if interleaved_seconds else 0:.0f}%) saved'
+    )
+
+if __name__ == '__main__':
+    args: argparse.Namespace = parse_args()
+    llm: ChatOllama = ChatOllama(
+        model=args.model, base_url=args.ollama_url, keep_alive=args.keep_alive, num_ctx=args.num_ctx, num_predict=1
+    )
+    requests: list[tuple[str, ChatPromptTemplate, dict[str, Any]]] = build_requests(args)
+    # loads the model so neither layout is timed with it
+    llm.invoke('Hi')
+    results: dict[str, dict[str, Any]] = {
+        'interleaved': run_layout(llm, requests, prefix=False),
+        'prefix': run_layout(llm, requests, prefix=True),
+    }
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'config': vars(args), **results}, file, indent=2)
@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import random
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Connection
+from langchain_core.documents import Document
+from typing import Any, Iterator
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+_VEHICLES: list[str] = [
+    'Tesla Model Y', 'Tesla Model 3', 'Hyundai Ioniq 5', 'Kia EV6', 'Ford Mustang Mach-E', 'Volkswagen ID.4',
+    'Toyota RAV4', 'Honda CR-V', 'BMW iX3', 'Genesis GV60'
+]
+_WORDS: list[str] = (
+    'range battery charging comfort cabin noise suspension handling acceleration braking software update '
+    'infotainment display seat trunk space price value warranty service dealer reliability efficiency road trip '
+    'winter heat pump autopilot lane assist visibility build quality panel gap interior materials resale'
+).split()
+
+def generate_record(rnd: random.Random, record_num: int, reviews: int, text_length: int) -> dict[str, Any]:
+    """
+    Generates a consumer report shaped like the elements of the output-#.json files
+
+    :param rnd: Random number generator, seeded for a reproducible corpus
+    :param record_num: Number of the record, used in its title
+    :param reviews: Number of customer reviews nested in the record
+    :param text_length: Approximate number of characters of each free text field
+    :return: JSON object of the record
+    """
+    def text() -> str:
+        words: list[str] = []
+        length: int = 0
+        while length < text_length:
+            words.append(rnd.choice(_WORDS))
+            length += len(words[-1]) + 1
+        return ' '.join(words)
+
+    vehicle: str = rnd.choice(_VEHICLES)
+    return {
+        'title': f'{vehicle} consumer report #{record_num}',
+        'vehicle': vehicle,
+        'url': f'https://example.com/reports/{record_num}',
+        'summary': text(),
+        'specifications': {
+            'range_km': rnd.randint(300, 650),
+            'battery_kwh': round(rnd.uniform(50, 110), 1),
+            'price_usd': rnd.randint(35000, 90000),
+            'drivetrain': rnd.choice(['RWD', 'AWD', 'FWD']),
+        },
+        'reviews': [
+            { 'rating': rnd.randint(1, 5), 'pros': text(), 'cons': text() }
+            for _ in range(reviews)
+        ],
+    }
+
+def generate_corpus(
+    objects: int = 3, records_per_object: int = 200, reviews: int = 5, text_length: int = 400, seed: int = 42
+) -> Iterator[tuple[str, bytes]]:
+    """
+    Generates synthetic output-#.json files, i.e., JSON arrays of consumer reports
+
+    :param objects: Number of files
+    :param records_per_object: Number of records in each file
+    :param reviews: Number of customer reviews nested in each record
+    :param text_length: Approximate number of characters of each free text field
+    :param seed: Seed of the generator, the same seed always generates the same corpus
+    :return: Iterator over the key and content of each file
+    """
+    rnd: random.Random = random.Random(seed)
+    for object_num in range(1, objects + 1):
+        records: list[dict[str, Any]] = [
+            generate_record(rnd, (object_num - 1) * records_per_object + i + 1, reviews, text_length)
+            for i in range(records_per_object)
+        ]
+        yield f'output-{object_num}.json', json.dumps(records, ensure_ascii=False, indent=2).encode('utf-8')
+
+def stub_embedding(text: str, dimensions: int) -> list[float]:
+    # derived from the text only so the same text always gets the same vector, rounded to keep the response small
+    values: array = array('H', hashlib.shake_256(text.encode('utf-8')).digest(dimensions * 2))
+    return [round(value / 32768 - 1, 3) for value in values]
+
+class _StubEmbeddingHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        # health check of OllamaPool
+        if self.path != '/api/version':
+            self.send_error(404)
+            return
+        self._send_json({'version': 'stub'})
+
+    def do_POST(self) -> None:
+        if self.path == '/api/chat':
+            self._chat()
+            return
+        if self.path != '/api/embed':
+            self.send_error(404)
+            return
+        request: dict[str, Any] = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        texts: list[str] = [request['input']] if isinstance(request['input'], str) else request['input']
+        started: float = time.perf_counter()
+        time.sleep(self.server.latency_seconds + self.server.latency_per_input_seconds * len(texts))
+        self._send_json({
+            'model': request['model'],
+            'embeddings': [stub_embedding(text, self.server.dimensions) for text in texts],
+            'total_duration': int((time.perf_counter() - started) * 1e9),
+            'prompt_eval_count': sum(len(text.split()) for text in texts),
+        })
+
+    def _chat(self) -> None:
+        # answers every prompt with the address of the server, one word per token, so it's visible which server of a
+        # pool answered, taking latency_seconds before the first token and latency_per_input_seconds for every token
+        request: dict[str, Any] = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        host, port = self.server.server_address[:2]
+        tokens: list[str] = ['Stub', ' response', ' from', f' {host}:{port}']
+        started: float = time.perf_counter()
+        time.sleep(self.server.latency_seconds)
+        messages: list[dict[str, Any]] = [{
+            'model': request['model'],
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'message': {'role': 'assistant', 'content': token},
+            'done': False,
+        } for token in tokens]
+        if not request.get('stream', True):
+            messages = [{**messages[0], 'message': {'role': 'assistant', 'content': ''.join(tokens)}}]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for message in messages:
+            time.sleep(self.server.latency_per_input_seconds)
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        self.wfile.write(json.dumps({
+            'model': request['model'],
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'message': {'role': 'assistant', 'content': ''},
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((time.perf_counter() - started) * 1e9),
+            'prompt_eval_count': sum(len(str(message.get('content', '')).split()) for message in request['messages']),
+            'eval_count': len(tokens),
+        }).encode('utf-8') + b'\n')
+
+    def _send_json(self, response: dict[str, Any]) -> None:
+        body: bytes = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+def _serve_stub_embeddings(
+    dimensions: int, latency_seconds: float, latency_per_input_seconds: float, host: str, port: int, conn: Connection
+) -> None:
+    server: ThreadingHTTPServer = ThreadingHTTPServer((host, port), _StubEmbeddingHandler)
+    server.daemon_threads = True
+    server.dimensions = dimensions
+    server.latency_seconds = latency_seconds
+    server.latency_per_input_seconds = latency_per_input_seconds
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+class StubEmbeddingServer:
+    """
+    Local HTTP server implementing Ollama's /api/embed with deterministic vectors and a configurable latency
+
+    Lets OllamaEmbeddings (and so the ingestion pipeline) run without Ollama, with each request taking latency_seconds
+    plus latency_per_input_seconds for every text in it, roughly like a model that batches its inputs. It also answers
+    /api/chat with a canned response naming the server and /api/version, so several of them can stand in for the
+    endpoints of an OllamaPool. The server runs in its own process so that encoding the responses doesn't compete
+    with the pipeline for the GIL.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = 3072,
+        latency_seconds: float = 0.05,
+        latency_per_input_seconds: float = 0.002,
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ):
+        """
+        :param dimensions: Number of dimensions of the vectors
+        :param latency_seconds: Latency of every request
+        :param latency_per_input_seconds: Latency added for every text in a request
+        :param host: Host to listen on
+        :param port: Port to listen on, any free port by default
+        """
+        self.dimensions: int = dimensions
+        self.latency_seconds: float = latency_seconds
+        self.latency_per_input_seconds: float = latency_per_input_seconds
+        self.host: str = host
+        self.port: int = port
+        self._process: multiprocessing.Process | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def start(self) -> 'StubEmbeddingServer':
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(
+            target=_serve_stub_embeddings,
+            args=(self.dimensions, self.latency_seconds, self.latency_per_input_seconds, self.host, self.port, sender),
+            name='stub-embedding-server',
+            daemon=True
+        )
+        self._process.start()
+        self.port = receiver.recv()
+        logger.info(f'Stub embedding server listening on {self.base_url}')
+        return self
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> 'StubEmbeddingServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+class _FakePaginator:
+    def __init__(self, s3_client: 'FakeS3Client'):
+        self.s3_client: FakeS3Client = s3_client
+
+    def paginate(self, Bucket: str, Prefix: str = '') -> Iterator[dict[str, Any]]:
+        keys: list[str] = sorted(key for key in self.s3_client.objects.get(Bucket, {}) if key.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), 1000):
+            yield {'Contents': [self.s3_client.head(Bucket, key) for key in keys[i:i + 1000]]}
+
+class FakeS3Client:
+    """
+    In-process stand-in for the subset of the boto3 S3 client used by s3_utils, with a configurable latency
+
+    Each GET takes latency_seconds plus the time to transfer the body at bandwidth_bytes_per_second, if set.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, bandwidth_bytes_per_second: float | None = None):
+        self.latency_seconds: float = latency_seconds
+        self.bandwidth_bytes_per_second: float | None = bandwidth_bytes_per_second
+        self.objects: dict[str, dict[str, tuple[bytes, datetime]]] = {}
+        self.gets: int = 0
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> None:
+        self.objects.setdefault(Bucket, {})[Key] = (Body, datetime.now(timezone.utc))
+
+    def head(self, bucket: str, key: str) -> dict[str, Any]:
+        body, last_modified = self.objects[bucket][key]
+        return {'Key': key, 'Size': len(body), 'LastModified': last_modified, 'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def get_paginator(self, operation_name: str) -> _FakePaginator:
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return _FakePaginator(self)
+
+    def get_object(self, Bucket: str, Key: str, IfMatch: str | None = None, Range: str | None = None) -> dict[str, Any]:
+        body, _ = self.objects[Bucket][Key]
+        if IfMatch is not None and IfMatch != self.head(Bucket, Key)['ETag']:
+            raise ValueError(f'PreconditionFailed: s3://{Bucket}/{Key} changed')
+        if Range is not None:
+            start, end = Range.removeprefix('bytes=').split('-')
+            body = body[int(start):int(end) + 1]
+        self.gets += 1
+        time.sleep(self.latency_seconds + (len(body) / self.bandwidth_bytes_per_second if self.bandwidth_bytes_per_second else 0))
+        return {'Body': io.BytesIO(body)}
+
+class FakeVectorStoreWriter:
+    """
+    Discards the written documents after an optional latency, standing in for Postgres in the ingestion pipeline
+    """
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds: float = latency_seconds
+        self.documents: int = 0
+
+    async def awrite(self, documents: list[Document], embeddings: list[list[float]]) -> list[str]:
+        await asyncio.sleep(self.latency_seconds)
+        self.documents += len(documents)
+        return [document.id or str(uuid.uuid4()) for document in documents]
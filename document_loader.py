@@ -1,12 +1,25 @@
 import asyncio
 import boto3
-import json
+import logging
+from botocore.config import Config
+from datetime import datetime
 from langchain_core.embeddings import Embeddings
 from langchain_core.documents import Document
 from langchain_core.vectorstores import VectorStore
-from langchain_ollama import OllamaEmbeddings
-from langchain_postgres import PGEngine, PGVectorStore
-from langchain_text_splitters import RecursiveJsonSplitter
+from langchain_postgres import Column, PGEngine, PGVectorStore
+from langchain_postgres.v2.indexes import BaseIndex, HNSWIndex
+from embedding_cache import cached_embeddings
+from hybrid_search import METADATA_COLUMNS, ensure_metadata_columns, ensure_search_indexes
+from ingestion import IngestManifest, bump_ingest_generation, table_exists
+from ingestion_pipeline import build_ingestion_pipeline
+from json_chunker import JsonChunker
+from ollama_pool import OllamaPool, PooledOllamaEmbeddings
+from pg_bulk_load import CopyWriter, build_indexes, get_index_definitions
+from pipeline import Pipeline
+from product_gazetteer import load_products, seed_products, write_products
+from s3_utils import S3Object, list_objects
+from vector_index import create_vector_index, default_index_name, ensure_indexable_column
+from typing import Any, Callable
 
 POSTGRES_USER: str = 'langchain'
 POSTGRES_PASSWORD: str = 'langchain'
@@ -14,41 +27,108 @@ POSTGRES_HOST: str = 'localhost'
 POSTGRES_PORT: str = '5432'
 POSTGRES_DB: str = 'langchain'
 TABLE_NAME: str = 'vectorstore'
+MANIFEST_TABLE_NAME: str = 'vectorstore_manifest'
+# bumped after every run so the agents invalidate the search results they cached, see SemanticSearchCache
+GENERATION_TABLE_NAME: str = 'vectorstore_generation'
 VECTOR_SIZE: int = 3072
 S3_BUCKET: str = 'raw'
 S3_ACCESS_KEY: str = 'admin'
 S3_SECRET_KEY: str = 'password'
 MINIO_ENDPOINT: str = 'http://localhost:9000'
-DOCUMENTS: list[str] = [ 'output-1.json', 'output-2.json', 'output-3.json' ]
+S3_PREFIX: str = ''
+S3_KEY_PATTERN: str = 'output-*.json'
+# when set, objects not modified since are assumed to be unchanged and aren't read at all, e.g.
+# datetime(2025, 10, 1, tzinfo=timezone.utc), which only applies to an incremental run
+S3_MODIFIED_AFTER: datetime | None = None
+# objects are fetched in parallel and any object over S3_RANGE_THRESHOLD is fetched as parallel ranged GETs, with at
+# most S3_MAX_BUFFER_BYTES fetched ahead of the parser so memory stays flat however large the objects are
+S3_MAX_WORKERS: int = 16
+S3_RANGE_THRESHOLD: int = 16 * 1024 * 1024
+S3_PART_SIZE: int = 8 * 1024 * 1024
+S3_MAX_BUFFER_BYTES: int = 64 * 1024 * 1024
 OLLAMA_MODEL_ID: str = 'llama3.2:3b'
-OLLAMA_BASE_URL: str = 'http://localhost:11434'
+# Ollama endpoints the chunks are embedded on, see OllamaPool, each with up to OLLAMA_MAX_CONCURRENCY requests in flight
+OLLAMA_BASE_URLS: list[str] = ['http://localhost:11434']
+OLLAMA_MAX_CONCURRENCY: int = 4
+EMBEDDING_CACHE_PATH: str = 'temp/embedding_cache.sqlite'
+# product names found in the PRODUCT_FIELD of the documents are added to the gazetteer the agents match questions with
+PRODUCT_GAZETTEER_PATH: str = 'temp/product_gazetteer.json'
+PRODUCT_FIELD: str = 'vehicle'
+# maximum size of a chunk, measured in characters unless a length function is set, e.g. to count tokens with
+# lambda text: len(tokenizer.encode(text)) in which case the size should be lowered accordingly
+JSON_CHUNK_SIZE: int = 1000
+JSON_CHUNK_LENGTH_FUNCTION: Callable[[str], int] = len
+# number of chunks embedded and written per request and how many of those requests are in flight at once
+INGEST_BATCH_SIZE: int = 64
+INGEST_MAX_CONCURRENCY: int = 4
+INGEST_MAX_WRITE_CONCURRENCY: int = 2
+INGEST_MAX_RETRIES: int = 3
+# maximum number of items waiting between two stages of the ingestion pipeline and how often the stats of each stage
+# are logged
+INGEST_QUEUE_SIZE: int = 16
+INGEST_REPORT_INTERVAL_SECONDS: float = 10.0
+# only embed new or changed chunks and delete vanished ones instead of dropping and re-embedding the whole table
+INCREMENTAL: bool = True
+# write with binary COPY instead of row by row inserts and, on a full re-ingestion, build the indexes of the previous
+# table once the load has finished instead of maintaining them on every insert
+BULK_LOAD: bool = True
+INDEX_MAINTENANCE_WORK_MEM: str = '1GB'
+INDEX_MAX_PARALLEL_WORKERS: int = 4
+# approximate nearest neighbour index built once the chunks are loaded (or None to keep searching with sequential
+# scans), which is only rebuilt when REBUILD_VECTOR_INDEX is set, e.g. after changing its parameters
+VECTOR_INDEX: BaseIndex | None = HNSWIndex(m=16, ef_construction=64)
+REBUILD_VECTOR_INDEX: bool = False
 
 CONNECTION_STRING: str = (
     f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}'
     f':{POSTGRES_PORT}/{POSTGRES_DB}'
 )
+# the manifest is maintained through psycopg directly since PGEngine doesn't expose arbitrary queries
+PSYCOPG_CONNECTION_STRING: str = (
+    f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}'
+    f':{POSTGRES_PORT}/{POSTGRES_DB}'
+)
 pg_engine: PGEngine = PGEngine.from_connection_string(url=CONNECTION_STRING)
 s3_client = boto3.client(
     's3',
     aws_access_key_id=S3_ACCESS_KEY,
     aws_secret_access_key=S3_SECRET_KEY,
-    endpoint_url=MINIO_ENDPOINT
+    endpoint_url=MINIO_ENDPOINT,
+    # the client is shared by every fetch thread so its connection pool has to be at least as large as the thread pool
+    config=Config(max_pool_connections=S3_MAX_WORKERS, retries={'max_attempts': 5, 'mode': 'adaptive'})
 )
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger: logging.Logger = logging.getLogger(__name__)
 
 # 1. Setup the vector store
 # TODO consider setup outside of the document loader
+# the table is only dropped and recreated for a full re-ingestion or when it doesn't exist yet
+vector_store_exists: bool = INCREMENTAL and table_exists(PSYCOPG_CONNECTION_STRING, TABLE_NAME)
+# indexes of the table about to be dropped are captured so they can be rebuilt after the bulk load
+deferred_indexes: dict[str, str] = (
+    get_index_definitions(PSYCOPG_CONNECTION_STRING, TABLE_NAME)
+    if BULK_LOAD and not vector_store_exists and table_exists(PSYCOPG_CONNECTION_STRING, TABLE_NAME)
+    else {}
+)
 async def setup_vector_store_sync():
+    if vector_store_exists:
+        return
     await pg_engine.ainit_vectorstore_table(
         table_name=TABLE_NAME,
         vector_size=VECTOR_SIZE,
-        overwrite_existing=True # TODO this drops the table, may need the equivalent of CREATE TABLE ... IF NOT EXISTS
+        # source and document_seq_num get columns of their own so the agents' filters on them are pushed down
+        metadata_columns=[Column(column, column_type) for column, column_type in METADATA_COLUMNS.items()],
+        overwrite_existing=True
     )
 # TODO is this sync, if not, then should it be setup to wait for the setup just in case of timing issues?
 asyncio.run(setup_vector_store_sync())
+# VECTOR_SIZE is over the 2000 dimensions pgvector can index as vector so the embeddings are stored as halfvec instead
+ensure_indexable_column(PSYCOPG_CONNECTION_STRING, TABLE_NAME, VECTOR_SIZE)
+# a table created before the metadata columns were introduced gets them filled in from its metadata JSON
+ensure_metadata_columns(PSYCOPG_CONNECTION_STRING, TABLE_NAME)
 
-# 2. Load the JSONs into list[Document]
-docs: list[Document] = []
-for i, document in enumerate(DOCUMENTS):
+# 2. Discover the JSON arrays in S3, fetch them in parallel and stream them one element at a time
+def list_sources(manifest: IngestManifest) -> list[tuple[S3Object, dict[str, Any]]]:
     # S3FileLoader runs into "ImportError: unstructured package not found, please install it with `pip install unstructured`"
     # https://github.com/langchain-ai/langchain/issues/7944
     # loader: BaseLoader = S3FileLoader(
@@ -56,35 +136,128 @@ for i, document in enumerate(DOCUMENTS):
     # )
     # docs.extend(loader.load())
     # JSONLoader doesn't work either because it only supports file_path being passed to it
-    obj = s3_client.get_object(Bucket=S3_BUCKET, Key=document)
-    content: str = obj['Body'].read().decode('utf-8')
+    objects: list[S3Object] = list(list_objects(s3_client, S3_BUCKET, S3_PREFIX, S3_KEY_PATTERN))
+    # numbered through the manifest rather than by position in the listing so adding or removing an object doesn't
+    # renumber the ones after it
+    document_seq_nums: dict[str, int] = {
+        obj.key: manifest.document_seq_num(f's3://{S3_BUCKET}/{obj.key}') for obj in objects
+    }
+    modified_after: datetime | None = S3_MODIFIED_AFTER if vector_store_exists else None
+    if modified_after is not None:
+        # the chunks of objects that weren't modified are kept as-is rather than treated as vanished
+        manifest.retain_sources(f's3://{S3_BUCKET}/{obj.key}' for obj in objects if obj.last_modified <= modified_after)
+        objects = [obj for obj in objects if obj.last_modified > modified_after]
+    logger.info(f'Found {len(document_seq_nums)} objects matching "{S3_PREFIX}{S3_KEY_PATTERN}", reading {len(objects)}')
     # partially derived from https://github.com/langchain-ai/langchain-community/blob/90860265dd6f0a9e840b8350ba8e8b2502225d51/libs/community/langchain_community/document_loaders/json_loader.py#L153-L168
-    docs.append(Document(page_content=content, metadata={ 'source': f's3://{S3_BUCKET}/{document}', 'document_seq_num': i + 1 }))
+    return [
+        (obj, { 'source': f's3://{S3_BUCKET}/{obj.key}', 'document_seq_num': document_seq_nums[obj.key] })
+        for obj in objects
+    ]
 
-# 3. Recursively split the JSON into manageable chunks
-all_split_docs: list[Document] = []
-json_splitter = RecursiveJsonSplitter(max_chunk_size=1000)
-for document in docs:
-    # note that the output-#.json files are actually JSON arrays
-    split_docs: list[Document] = json_splitter.create_documents(texts=json.loads(document.page_content))
-    # original metadata is lost with this approach so this is rehydrating it
-    # TODO confirm if there's a better way to do this
-    for i, split_doc in enumerate(split_docs):
-        split_doc.metadata = {
-            'source': document.metadata['source'],
-            'document_seq_num': document.metadata['document_seq_num'],
-            'document_chunk_seq_num': i + 1
-        }
-    all_split_docs.extend(split_docs)
+# 3. Split each JSON element into manageable chunks as soon as it's parsed, see build_ingestion_pipeline
+# produces the same chunks as RecursiveJsonSplitter(max_chunk_size=1000), which re-serialized every subtree to
+# measure it, while carrying over the metadata of the element instead of it having to be rehydrated
+json_chunker: JsonChunker = JsonChunker(max_chunk_size=JSON_CHUNK_SIZE, length_function=JSON_CHUNK_LENGTH_FUNCTION)
 
 # 4. Setup PGVectorStore to load it with documents
 async def get_vector_store_async() -> VectorStore:
-    embeddings: Embeddings = OllamaEmbeddings(model=OLLAMA_MODEL_ID, base_url=OLLAMA_BASE_URL)
+    embeddings: Embeddings = cached_embeddings(
+        PooledOllamaEmbeddings(
+            pool=OllamaPool(OLLAMA_BASE_URLS, max_concurrency=OLLAMA_MAX_CONCURRENCY), model=OLLAMA_MODEL_ID
+        ),
+        OLLAMA_MODEL_ID,
+        EMBEDDING_CACHE_PATH
+    )
     return await PGVectorStore.create(
         engine=pg_engine,
         table_name=TABLE_NAME,
         embedding_service=embeddings,
+        metadata_columns=list(METADATA_COLUMNS)
     )
 vector_store: VectorStore = asyncio.run(get_vector_store_async())
-# TODO it takes a 10-20 min when running locally so consider chunking the number of documents
-vector_store.add_documents(all_split_docs)
+# the manifest has to start over whenever the table was (re)created, otherwise chunks would be skipped as unchanged
+manifest: IngestManifest = IngestManifest(PSYCOPG_CONNECTION_STRING, TABLE_NAME, MANIFEST_TABLE_NAME)
+manifest.load(reset=not vector_store_exists)
+# a single add_documents call took 10-20 min locally so the chunks are streamed through a pipeline instead, where
+# fetching, parsing, splitting, embedding and writing all run at once with bounded queues between them so Ollama is
+# kept busy while S3 is read and Postgres is written
+async def write_batch(batch: list[Document], vectors: list[list[float]]) -> list[str]:
+    if writer is not None:
+        return await asyncio.to_thread(writer.write, batch, vectors)
+    return await vector_store.aadd_embeddings(
+        [document.page_content for document in batch],
+        vectors,
+        metadatas=[document.metadata for document in batch],
+        ids=[document.id for document in batch]
+    )
+
+# a freshly created table can't conflict so it's copied into directly, otherwise changed chunks are upserted, with a
+# connection for each of the writes in flight
+writer: CopyWriter | None = CopyWriter(
+    PSYCOPG_CONNECTION_STRING,
+    TABLE_NAME,
+    upsert=vector_store_exists,
+    metadata_columns=list(METADATA_COLUMNS),
+    max_connections=INGEST_MAX_WRITE_CONCURRENCY
+) if BULK_LOAD else None
+ingestion_pipeline: Pipeline = build_ingestion_pipeline(
+    s3_client,
+    S3_BUCKET,
+    list_sources(manifest),
+    json_chunker,
+    vector_store.embeddings,
+    write_batch,
+    manifest=manifest,
+    batch_size=INGEST_BATCH_SIZE,
+    max_concurrency=INGEST_MAX_CONCURRENCY,
+    max_write_concurrency=INGEST_MAX_WRITE_CONCURRENCY,
+    max_retries=INGEST_MAX_RETRIES,
+    queue_size=INGEST_QUEUE_SIZE,
+    s3_max_workers=S3_MAX_WORKERS,
+    s3_range_threshold=S3_RANGE_THRESHOLD,
+    s3_part_size=S3_PART_SIZE,
+    s3_max_buffer_bytes=S3_MAX_BUFFER_BYTES
+)
+try:
+    asyncio.run(ingestion_pipeline.arun(report_interval_seconds=INGEST_REPORT_INTERVAL_SECONDS))
+finally:
+    if writer is not None:
+        writer.close()
+if BULK_LOAD:
+    if VECTOR_INDEX is not None:
+        # built below so it isn't built twice when it has to be rebuilt
+        deferred_indexes.pop(VECTOR_INDEX.name or default_index_name(TABLE_NAME), None)
+    build_indexes(
+        PSYCOPG_CONNECTION_STRING,
+        deferred_indexes,
+        maintenance_work_mem=INDEX_MAINTENANCE_WORK_MEM,
+        max_parallel_maintenance_workers=INDEX_MAX_PARALLEL_WORKERS
+    )
+vector_store_modified: bool = manifest.commit()
+# full-text index for hybrid search and indexes of the metadata columns, unless they were already (re)built above
+ensure_search_indexes(
+    PSYCOPG_CONNECTION_STRING,
+    TABLE_NAME,
+    maintenance_work_mem=INDEX_MAINTENANCE_WORK_MEM,
+    max_parallel_maintenance_workers=INDEX_MAX_PARALLEL_WORKERS
+)
+if VECTOR_INDEX is not None:
+    create_vector_index(
+        PSYCOPG_CONNECTION_STRING,
+        TABLE_NAME,
+        VECTOR_INDEX,
+        rebuild=REBUILD_VECTOR_INDEX,
+        maintenance_work_mem=INDEX_MAINTENANCE_WORK_MEM,
+        max_parallel_maintenance_workers=INDEX_MAX_PARALLEL_WORKERS
+    )
+products: dict[str, list[str]] = load_products(PRODUCT_GAZETTEER_PATH)
+write_products(PRODUCT_GAZETTEER_PATH, {
+    **{ product: [] for product in seed_products(PSYCOPG_CONNECTION_STRING, TABLE_NAME, PRODUCT_FIELD) },
+    **products
+})
+# the search results cached by the agents are only invalidated when what they search has changed, so a run that found
+# nothing new keeps them
+if vector_store_modified or not vector_store_exists or REBUILD_VECTOR_INDEX:
+    bump_ingest_generation(PSYCOPG_CONNECTION_STRING, GENERATION_TABLE_NAME, TABLE_NAME)
+else:
+    logger.info('Nothing was written or deleted, the ingest generation is left as-is')
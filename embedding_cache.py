@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import EncoderBackedStore
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+from typing import Iterator, Optional, Sequence
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+class SQLiteByteStore(ByteStore):
+    """
+    Byte store persisted to a SQLite file with an in-memory LRU tier in front of it
+
+    Both tiers are bounded by the total size of the stored values. The in-memory tier evicts its least recently used
+    entries, while the SQLite file evicts its least recently accessed rows once max_bytes is exceeded. The file is
+    opened in WAL mode so the loader and the agents can share it.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 ** 3, memory_max_bytes: int = 64 * 1024 ** 2):
+        """
+        :param path: Path to the SQLite file, created along with its directory if missing
+        :param max_bytes: Maximum total size of the values kept in the SQLite file
+        :param memory_max_bytes: Maximum total size of the values kept in memory
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_bytes: int = max_bytes
+        self.memory_max_bytes: int = memory_max_bytes
+        self._lock: threading.Lock = threading.Lock()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes: int = 0
+        self._conn: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache(accessed_at)')
+        self._bytes: int = self._conn.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache').fetchone()[0]
+
+    def _remember(self, key: str, value: bytes) -> None:
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict(self) -> None:
+        # evict down to 90% of the limit so a full cache doesn't evict on every write
+        target: int = int(self.max_bytes * 0.9)
+        evicted: int = 0
+        while self._bytes > target:
+            rows = self._conn.execute(
+                'SELECT key, LENGTH(value) FROM cache ORDER BY accessed_at LIMIT 256'
+            ).fetchall()
+            if not rows:
+                break
+            self._conn.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key, _ in rows])
+            self._bytes -= sum(size for _, size in rows)
+            evicted += len(rows)
+        logger.info(f'Evicted {evicted} entries from the cache')
+
+    def _select(self, columns: str, keys: Sequence[str]) -> list[tuple]:
+        rows: list[tuple] = []
+        # stay well below SQLite's limit on the number of bound parameters
+        for i in range(0, len(keys), 500):
+            batch: Sequence[str] = keys[i:i + 500]
+            rows.extend(self._conn.execute(
+                f'SELECT {columns} FROM cache WHERE key IN ({", ".join("?" for _ in batch)})', batch
+            ).fetchall())
+        return rows
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        with self._lock:
+            values: dict[str, bytes] = {}
+            missing: list[str] = []
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    values[key] = self._memory[key]
+                else:
+                    missing.append(key)
+            for key, value in self._select('key, value', missing):
+                values[key] = value
+                self._remember(key, value)
+            if missing:
+                now: float = time.time()
+                self._conn.executemany(
+                    'UPDATE cache SET accessed_at = ? WHERE key = ?', [(now, key) for key in missing if key in values]
+                )
+            return [values.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        with self._lock:
+            now: float = time.time()
+            existing: dict[str, int] = dict(self._select('key, LENGTH(value)', [key for key, _ in key_value_pairs]))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO cache(key, value, accessed_at) VALUES (?, ?, ?)',
+                [(key, value, now) for key, value in key_value_pairs]
+            )
+            self._bytes += sum(len(value) for _, value in key_value_pairs) - sum(existing.values())
+            for key, value in key_value_pairs:
+                self._remember(key, value)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory_bytes -= len(self._memory.pop(key))
+            existing: dict[str, int] = dict(self._select('key, LENGTH(value)', keys))
+            self._conn.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in existing])
+            self._bytes -= sum(existing.values())
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            keys: list[str] = [row[0] for row in self._conn.execute('SELECT key FROM cache').fetchall()]
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+def _serialize_vector(vector: list[float]) -> bytes:
+    # pgvector stores single precision floats so nothing is lost compared to the stored embeddings
+    return array('f', vector).tobytes()
+
+def _deserialize_vector(value: bytes) -> list[float]:
+    vector: array = array('f')
+    vector.frombytes(value)
+    return vector.tolist()
+
+def cached_embeddings(
+    underlying_embeddings: Embeddings,
+    model_id: str,
+    path: str,
+    max_bytes: int = 1024 ** 3,
+    memory_max_bytes: int = 64 * 1024 ** 2,
+) -> Embeddings:
+    """
+    Wraps an embedding model so that documents and queries are only ever embedded once per model
+
+    Documents and queries share the same cache entries, which are keyed by the model id and the SHA-256 hash of the
+    text, so a query that matches an ingested chunk word for word is also served from the cache.
+
+    :param underlying_embeddings: Embedding model to call on a cache miss
+    :param model_id: Id of the embedding model, part of the cache key so different models never share entries
+    :param path: Path to the SQLite file backing the cache
+    :param max_bytes: Maximum size of the embeddings kept in the SQLite file
+    :param memory_max_bytes: Maximum size of the embeddings kept in memory
+    :return: Embeddings backed by the cache
+    """
+    store: EncoderBackedStore = EncoderBackedStore(
+        SQLiteByteStore(path, max_bytes=max_bytes, memory_max_bytes=memory_max_bytes),
+        key_encoder=lambda text: f'{model_id}:{hashlib.sha256(text.encode("utf-8")).hexdigest()}',
+        value_serializer=_serialize_vector,
+        value_deserializer=_deserialize_vector,
+    )
+    return CacheBackedEmbeddings(underlying_embeddings, store, query_embedding_store=store)
@@ -0,0 +1,154 @@
+import logging
+import psycopg
+import time
+from langchain_postgres.v2.hybrid_search_config import HybridSearchConfig
+from psycopg import sql
+from sqlalchemy import RowMapping
+from typing import Any, Sequence
+from pg_bulk_load import set_maintenance_options
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# text search configuration the content is indexed and queried with, which has to be the same for the index to be used
+FTS_LANGUAGE: str = 'pg_catalog.english'
+# metadata written by the document loader that is stored in columns of its own so filters on it are pushed down to
+# Postgres (and its indexes) instead of every document having to be read back, along with the type of each column
+METADATA_COLUMNS: dict[str, str] = {'source': 'TEXT', 'document_seq_num': 'INTEGER'}
+
+def fts_index_name(table_name: str) -> str:
+    return f'{table_name}_fts_index'
+
+def metadata_index_name(table_name: str, column: str) -> str:
+    return f'{table_name}_{column}_index'
+
+def reciprocal_rank_fusion(
+    primary_search_results: Sequence[RowMapping],
+    secondary_search_results: Sequence[RowMapping],
+    rrf_k: float = 60,
+    fetch_top_k: int = 4,
+) -> list[dict[str, Any]]:
+    """
+    Fuses the results of the vector and full-text searches by the sum of 1 / (rrf_k + rank) of each result
+
+    Unlike the reciprocal_rank_fusion of langchain_postgres, which sorts both results by descending distance and so
+    ranks the farthest vectors first, the results are ranked in the order the searches return them, i.e., by ascending
+    distance and descending full-text rank respectively.
+
+    :param primary_search_results: Rows of the vector search, the first column being the id
+    :param secondary_search_results: Rows of the full-text search, the first column being the id
+    :param rrf_k: Constant of reciprocal rank fusion, where a lower value favours the top results of either search
+    :param fetch_top_k: Number of rows to return
+    :return: Rows with the highest fused scores, which replace their distance
+    """
+    fused: dict[str, dict[str, Any]] = {}
+    for results in (primary_search_results, secondary_search_results):
+        for rank, row in enumerate(results):
+            id: str = str(next(iter(row.values())))
+            score: float = fused[id]['distance'] if id in fused else 0.0
+            fused[id] = { **row, 'distance': score + 1.0 / (rrf_k + rank + 1) }
+    return sorted(fused.values(), key=lambda row: row['distance'], reverse=True)[:fetch_top_k]
+
+def hybrid_search_config(candidates: int = 20, rrf_k: float = 60, tsv_lang: str = FTS_LANGUAGE) -> HybridSearchConfig:
+    """
+    Configures PGVectorStore to combine full-text ranking with vector distance by reciprocal rank fusion
+
+    The full-text search runs against to_tsvector(tsv_lang, content) rather than a stored tsvector column so that it's
+    served by the expression index of ensure_search_indexes and the COPY of the document loader stays unchanged.
+
+    :param candidates: Number of results of the full-text search that are fused with the vector search
+    :param rrf_k: Constant of reciprocal rank fusion, where a lower value favours the top results of either search
+    :param tsv_lang: Text search configuration, must match the one the index was built with
+    :return: Config to pass per search along with the full-text query, see asimilarity_search_many
+    """
+    return HybridSearchConfig(
+        tsv_column='',
+        tsv_lang=tsv_lang,
+        fusion_function=reciprocal_rank_fusion,
+        fusion_function_parameters={'rrf_k': rrf_k},
+        primary_top_k=candidates,
+        secondary_top_k=candidates,
+    )
+
+def ensure_metadata_columns(
+    conninfo: str,
+    table_name: str,
+    columns: dict[str, str] = METADATA_COLUMNS,
+    metadata_json_column: str = 'langchain_metadata',
+) -> None:
+    """
+    Adds the metadata columns to a table created without them and fills them in from the metadata JSON column
+
+    :param conninfo: psycopg connection string
+    :param table_name: Vector store table
+    :param columns: Type of each metadata column by name
+    :param metadata_json_column: Column the rest of the metadata is stored in as JSON
+    """
+    with psycopg.connect(conninfo) as conn:
+        existing: set[str] = {row[0] for row in conn.execute(
+            'SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped',
+            (sql.Identifier(table_name).as_string(conn),)
+        ).fetchall()}
+        for column, column_type in columns.items():
+            if column in existing:
+                continue
+            started: float = time.perf_counter()
+            conn.execute(sql.SQL('ALTER TABLE {} ADD COLUMN {} {}').format(
+                sql.Identifier(table_name), sql.Identifier(column), sql.SQL(column_type)
+            ))
+            # moved rather than copied out of the JSON the same way PGVectorStore writes metadata columns
+            updated: int = conn.execute(sql.SQL('UPDATE {} SET {} = ({} ->> {})::{}, {} = ({}::jsonb - {})::json').format(
+                sql.Identifier(table_name),
+                sql.Identifier(column),
+                sql.Identifier(metadata_json_column),
+                sql.Literal(column),
+                sql.SQL(column_type),
+                sql.Identifier(metadata_json_column),
+                sql.Identifier(metadata_json_column),
+                sql.Literal(column)
+            )).rowcount
+            logger.info(f'Added column {table_name}.{column} filled in for {updated} rows in {time.perf_counter() - started:.1f}s')
+
+def ensure_search_indexes(
+    conninfo: str,
+    table_name: str,
+    columns: list[str] = list(METADATA_COLUMNS),
+    content_column: str = 'content',
+    tsv_lang: str = FTS_LANGUAGE,
+    maintenance_work_mem: str = '1GB',
+    max_parallel_maintenance_workers: int = 4,
+) -> None:
+    """
+    Creates the full-text index used by hybrid search and the indexes of the metadata columns filters are pushed down to
+
+    Indexes that already exist are left as they are, so it's meant to run once the documents are loaded.
+
+    :param conninfo: psycopg connection string
+    :param table_name: Vector store table
+    :param columns: Metadata columns to index
+    :param content_column: Column the content of the documents is stored in
+    :param tsv_lang: Text search configuration, must match the one of hybrid_search_config
+    :param maintenance_work_mem: Memory each build may use
+    :param max_parallel_maintenance_workers: Number of parallel workers each build may use
+    """
+    definitions: dict[str, sql.Composable] = {
+        fts_index_name(table_name): sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} USING gin (to_tsvector({}::regconfig, {}))').format(
+            sql.Identifier(fts_index_name(table_name)),
+            sql.Identifier(table_name),
+            sql.Literal(tsv_lang),
+            sql.Identifier(content_column)
+        ),
+        **{
+            metadata_index_name(table_name, column): sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} ({})').format(
+                sql.Identifier(metadata_index_name(table_name, column)), sql.Identifier(table_name), sql.Identifier(column)
+            )
+            for column in columns
+        },
+    }
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        set_maintenance_options(conn, maintenance_work_mem, max_parallel_maintenance_workers)
+        for name, definition in definitions.items():
+            if conn.execute('SELECT to_regclass(%s) IS NOT NULL', (sql.Identifier(name).as_string(conn),)).fetchone()[0]:
+                continue
+            started: float = time.perf_counter()
+            conn.execute(definition)
+            logger.info(f'Built index {name} in {time.perf_counter() - started:.1f}s')
@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import logging
+import psycopg
+import uuid
+from itertools import islice
+from langchain_core.documents import Document
+from psycopg import sql
+from typing import Awaitable, Callable, Iterable, Iterator, TypeVar
+
+logger: logging.Logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+def batched(documents: Iterable[Document], batch_size: int) -> Iterator[list[Document]]:
+    """
+    Lazily groups documents into lists of at most batch_size documents
+
+    :param documents: Documents to group, consumed lazily so it may be a generator
+    :param batch_size: Maximum number of documents per batch
+    :return: Iterator over the batches
+    """
+    iterator: Iterator[Document] = iter(documents)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def assign_ids(documents: Iterable[Document]) -> None:
+    for document in documents:
+        if document.id is None:
+            document.id = str(uuid.uuid4())
+
+async def aretry(
+    func: Callable[[], Awaitable[T]], description: str, max_retries: int = 3, retry_backoff_seconds: float = 1.0
+) -> T:
+    """
+    Awaits func until it succeeds, retrying with exponential backoff
+
+    :param func: Creates the awaitable to retry, called once per attempt
+    :param description: What is being retried, used in the log messages
+    :param max_retries: Number of times func is retried before its exception is raised
+    :param retry_backoff_seconds: Initial delay before retrying, doubled on every attempt
+    :return: Result of the first successful attempt
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay: float = retry_backoff_seconds * 2 ** attempt
+            logger.warning(f'{description} failed on attempt {attempt + 1}, retrying in {delay:.1f}s: {e}')
+            await asyncio.sleep(delay)
+
+def chunk_id(document: Document) -> str:
+    """
+    Derives a stable id for a split document from its source and chunk sequence number
+
+    :param document: Split document with source and document_chunk_seq_num metadata
+    :return: UUID that stays the same across runs as long as the chunk keeps its position in its source
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{document.metadata['source']}#{document.metadata['document_chunk_seq_num']}"))
+
+def chunk_hash(document: Document) -> str:
+    """
+    Hashes a split document's source, chunk sequence number and content
+
+    :param document: Split document with source and document_chunk_seq_num metadata
+    :return: Hex digest that changes whenever the chunk needs to be embedded again
+    """
+    digest = hashlib.sha256()
+    for part in (document.metadata['source'], str(document.metadata['document_chunk_seq_num']), document.page_content):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def table_exists(conninfo: str, table_name: str) -> bool:
+    with psycopg.connect(conninfo) as conn:
+        return conn.execute('SELECT to_regclass(%s) IS NOT NULL', (f'"{table_name}"',)).fetchone()[0]
+
+class IngestManifest:
+    """
+    Content-hash manifest of the chunks in the vector store table used to only embed new or changed chunks
+
+    The manifest table is keyed by the same id as the vector store table (see chunk_id) so chunks that vanished from
+    the source are deleted from both tables in the same transaction. The document sequence number of every source is
+    kept in a table of its own so a source keeps its number when other sources are added or removed, otherwise the
+    unchanged chunks of the renumbered sources would be skipped with a stale document_seq_num.
+    """
+
+    def __init__(self, conninfo: str, table_name: str, manifest_table_name: str):
+        self.conninfo: str = conninfo
+        self.table_name: str = table_name
+        self.manifest_table_name: str = manifest_table_name
+        self.sources_table_name: str = f'{manifest_table_name}_sources'
+        self._stored_hashes: dict[str, str] = {}
+        self._stored_sources: dict[str, str] = {}
+        self._seen_ids: set[str] = set()
+        self._changed: dict[str, tuple[str, int, str]] = {}
+        self._document_seq_nums: dict[str, int] = {}
+        self._new_sources: dict[str, int] = {}
+
+    def load(self, reset: bool = False) -> None:
+        """
+        Creates the manifest table if needed and loads the stored hashes
+
+        :param reset: Whether to forget every stored hash, i.e., when the vector store table was just recreated
+        """
+        with psycopg.connect(self.conninfo) as conn:
+            conn.execute(sql.SQL(
+                """CREATE TABLE IF NOT EXISTS {}(
+                    langchain_id UUID PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    document_chunk_seq_num INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )"""
+            ).format(sql.Identifier(self.manifest_table_name)))
+            conn.execute(sql.SQL(
+                """CREATE TABLE IF NOT EXISTS {}(
+                    source TEXT PRIMARY KEY,
+                    document_seq_num INTEGER NOT NULL
+                )"""
+            ).format(sql.Identifier(self.sources_table_name)))
+            if reset:
+                conn.execute(sql.SQL('TRUNCATE {}, {}').format(
+                    sql.Identifier(self.manifest_table_name), sql.Identifier(self.sources_table_name)
+                ))
+            rows = conn.execute(
+                sql.SQL('SELECT langchain_id::text, content_hash, source FROM {}').format(
+                    sql.Identifier(self.manifest_table_name)
+                )
+            ).fetchall()
+            source_rows = conn.execute(
+                sql.SQL('SELECT source, document_seq_num FROM {}').format(sql.Identifier(self.sources_table_name))
+            ).fetchall()
+        self._stored_hashes = {id: content_hash for id, content_hash, _ in rows}
+        self._stored_sources = {id: source for id, _, source in rows}
+        self._document_seq_nums = dict(source_rows)
+        self._seen_ids.clear()
+        self._changed.clear()
+        self._new_sources.clear()
+        logger.info(f'Loaded {len(self._stored_hashes)} chunk hashes from manifest "{self.manifest_table_name}"')
+
+    def document_seq_num(self, source: str) -> int:
+        """
+        Looks up the document sequence number of a source, assigning the next unused one to a new source
+
+        Numbers aren't reused once their source vanishes so a filter on document_seq_num never matches another source.
+
+        :param source: Source of the documents, e.g. the S3 URI of the object
+        :return: Document sequence number of the source, starting at 1
+        """
+        if source not in self._document_seq_nums:
+            self._document_seq_nums[source] = max(self._document_seq_nums.values(), default=0) + 1
+            self._new_sources[source] = self._document_seq_nums[source]
+        return self._document_seq_nums[source]
+
+    def filter_changed(self, documents: Iterable[Document]) -> Iterator[Document]:
+        """
+        Assigns stable ids to the split documents and only yields the ones that are new or changed
+
+        :param documents: Every split document currently in the source, consumed lazily so it may be a generator
+        :return: Iterator over the documents that need to be embedded and written
+        """
+        for document in documents:
+            document.id = chunk_id(document)
+            self._seen_ids.add(document.id)
+            content_hash: str = chunk_hash(document)
+            if self._stored_hashes.get(document.id) == content_hash:
+                continue
+            self._changed[document.id] = (
+                document.metadata['source'], document.metadata['document_chunk_seq_num'], content_hash
+            )
+            yield document
+
+    def retain_sources(self, sources: Iterable[str]) -> None:
+        """
+        Keeps every stored chunk of the given sources without them being passed to filter_changed
+
+        :param sources: Sources that weren't read because they're known to be unchanged, e.g. not modified since the
+            last run
+        """
+        retained: set[str] = set(sources)
+        self._seen_ids.update(id for id, source in self._stored_sources.items() if source in retained)
+
+    def vanished_ids(self) -> list[str]:
+        return [id for id in self._stored_hashes if id not in self._seen_ids]
+
+    def commit(self) -> bool:
+        """
+        Records the hashes of the written documents and deletes the chunks that are no longer in the source
+
+        Should only be called once every document yielded by filter_changed has been written to the vector store.
+
+        :return: Whether any chunk was written or deleted, i.e., whether searches of the vector store may have changed
+        """
+        vanished_ids: list[str] = self.vanished_ids()
+        with psycopg.connect(self.conninfo) as conn:
+            if self._new_sources:
+                with conn.cursor() as cursor:
+                    cursor.executemany(
+                        sql.SQL(
+                            'INSERT INTO {}(source, document_seq_num) VALUES (%s, %s) ON CONFLICT (source) DO NOTHING'
+                        ).format(sql.Identifier(self.sources_table_name)),
+                        list(self._new_sources.items())
+                    )
+            if vanished_ids:
+                for table_name in (self.table_name, self.manifest_table_name):
+                    conn.execute(
+                        sql.SQL('DELETE FROM {} WHERE langchain_id = ANY(%s::uuid[])').format(sql.Identifier(table_name)),
+                        (vanished_ids,)
+                    )
+            if self._changed:
+                with conn.cursor() as cursor:
+                    cursor.executemany(
+                        sql.SQL(
+                            """INSERT INTO {}(langchain_id, source, document_chunk_seq_num, content_hash)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (langchain_id) DO UPDATE SET
+                                source = EXCLUDED.source,
+                                document_chunk_seq_num = EXCLUDED.document_chunk_seq_num,
+                                content_hash = EXCLUDED.content_hash,
+                                updated_at = now()"""
+                        ).format(sql.Identifier(self.manifest_table_name)),
+                        [(id, *entry) for id, entry in self._changed.items()]
+                    )
+        unchanged: int = len(self._seen_ids) - len(self._changed)
+        logger.info(
+            f'Manifest updated with {len(self._changed)} new or changed chunks, {unchanged} unchanged chunks and '
+            f'{len(vanished_ids)} vanished chunks deleted'
+        )
+        for id in vanished_ids:
+            del self._stored_hashes[id]
+            del self._stored_sources[id]
+        for id, (source, _, content_hash) in self._changed.items():
+            self._stored_hashes[id] = content_hash
+            self._stored_sources[id] = source
+        modified: bool = bool(self._changed or vanished_ids)
+        self._changed.clear()
+        self._new_sources.clear()
+        return modified
+
+def bump_ingest_generation(conninfo: str, generation_table_name: str, table_name: str) -> int:
+    """
+    Records that the vector store table was written to, e.g. so results cached by the agents are invalidated
+
+    :param conninfo: psycopg connection string
+    :param generation_table_name: Table keeping the ingest generation of every vector store table, created if missing
+    :param table_name: Vector store table that was written to
+    :return: New ingest generation of the table
+    """
+    with psycopg.connect(conninfo) as conn:
+        conn.execute(sql.SQL(
+            """CREATE TABLE IF NOT EXISTS {}(
+                table_name TEXT PRIMARY KEY,
+                generation BIGINT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )"""
+        ).format(sql.Identifier(generation_table_name)))
+        generation: int = conn.execute(
+            sql.SQL(
+                """INSERT INTO {0}(table_name, generation) VALUES (%s, 1)
+                ON CONFLICT (table_name) DO UPDATE SET generation = {0}.generation + 1, updated_at = now()
+                RETURNING generation"""
+            ).format(sql.Identifier(generation_table_name)),
+            (table_name,)
+        ).fetchone()[0]
+    logger.info(f'Ingest generation of "{table_name}" is now {generation}')
+    return generation
+
+def get_ingest_generation(conninfo: str, generation_table_name: str, table_name: str) -> int:
+    # 0 until the loader has run since generations were introduced
+    with psycopg.connect(conninfo) as conn:
+        if not conn.execute('SELECT to_regclass(%s) IS NOT NULL', (f'"{generation_table_name}"',)).fetchone()[0]:
+            return 0
+        row = conn.execute(
+            sql.SQL('SELECT generation FROM {} WHERE table_name = %s').format(sql.Identifier(generation_table_name)),
+            (table_name,)
+        ).fetchone()
+    return row[0] if row is not None else 0
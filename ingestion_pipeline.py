@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, groupby
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from typing import Any, Awaitable, Callable, Iterable, Iterator
+from ingestion import IngestManifest, assign_ids, batched
+from json_chunker import JsonChunker
+from json_stream import iter_json_array
+from pipeline import Pipeline
+from s3_utils import S3Object, iter_objects
+
+def fetch_objects(
+    s3_client: Any,
+    bucket: str,
+    sources: list[tuple[S3Object, dict[str, Any]]],
+    max_workers: int = 16,
+    range_threshold: int = 16 * 1024 * 1024,
+    part_size: int = 8 * 1024 * 1024,
+    max_buffer_bytes: int = 64 * 1024 * 1024,
+) -> Iterator[tuple[bytes, dict[str, Any]]]:
+    metadata_by_key: dict[str, dict[str, Any]] = { obj.key: metadata for obj, metadata in sources }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for obj, chunks in iter_objects(
+            s3_client, bucket, [obj for obj, _ in sources], executor,
+            lookahead=max_workers, range_threshold=range_threshold, part_size=part_size, max_buffer_bytes=max_buffer_bytes
+        ):
+            # the ranges of a large object are fetched here rather than by the parse stage so each object is consumed
+            # before the next one and the executor is only shut down once the last range has been fetched
+            for chunk in chunks:
+                yield chunk, metadata_by_key[obj.key]
+
+def parse_objects(chunks: Iterable[tuple[bytes, dict[str, Any]]]) -> Iterator[tuple[dict[str, Any], dict[str, Any]]]:
+    # the chunks of an object are consecutive so they're told apart by their source
+    for _, object_chunks in groupby(chunks, key=lambda item: item[1]['source']):
+        first_chunk, metadata = next(object_chunks)
+        # note that the output-#.json files are actually JSON arrays which are parsed as the content arrives
+        # instead of reading the whole content into memory first
+        for element in iter_json_array(chain([first_chunk], (chunk for chunk, _ in object_chunks))):
+            yield element, metadata
+
+def build_ingestion_pipeline(
+    s3_client: Any,
+    bucket: str,
+    sources: list[tuple[S3Object, dict[str, Any]]],
+    json_chunker: JsonChunker,
+    embeddings: Embeddings,
+    write_batch: Callable[[list[Document], list[list[float]]], Awaitable[list[str]]],
+    manifest: IngestManifest | None = None,
+    batch_size: int = 64,
+    max_concurrency: int = 4,
+    max_write_concurrency: int = 2,
+    max_retries: int = 3,
+    queue_size: int = 16,
+    s3_max_workers: int = 16,
+    s3_range_threshold: int = 16 * 1024 * 1024,
+    s3_part_size: int = 8 * 1024 * 1024,
+    s3_max_buffer_bytes: int = 64 * 1024 * 1024,
+    s3_queue_size: int = 2,
+) -> Pipeline:
+    """
+    Builds the pipeline that fetches, parses, splits, embeds and writes the JSON arrays in S3
+
+    The stages are named fetch, parse, split, embed and write. The fetch stage outputs the content of the objects in
+    order, whole for small objects and one range at a time for large ones. The output of the pipeline is the ids
+    written by each batch.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: Bucket the objects are in
+    :param sources: Objects to ingest along with the metadata of their documents, i.e., source and document_seq_num
+    :param json_chunker: Splits every element of the arrays into documents
+    :param embeddings: Embeds each batch of documents
+    :param write_batch: Writes a batch of documents under their ids along with their embeddings, returning the ids
+    :param manifest: Assigns stable ids to the documents and skips the unchanged ones if set, otherwise every document
+        is written under a random id
+    :param batch_size: Number of documents embedded and written per request
+    :param max_concurrency: Maximum number of embedding requests in flight
+    :param max_write_concurrency: Maximum number of writes in flight
+    :param max_retries: Number of times a failed embedding request or write is retried before its batch is dropped
+    :param queue_size: Maximum number of items waiting between two stages
+    :param s3_max_workers: Number of threads fetching objects, see iter_objects
+    :param s3_range_threshold: Size from which an object is fetched with ranged GETs
+    :param s3_part_size: Size of each ranged GET
+    :param s3_max_buffer_bytes: Number of bytes fetched ahead of the parse stage on top of the queue after the fetch
+        stage, see iter_objects
+    :param s3_queue_size: Maximum number of objects or ranges waiting after the fetch stage, each up to
+        s3_range_threshold bytes, kept small since the fetches already run ahead within s3_max_buffer_bytes
+    :return: Pipeline to run with arun
+    """
+    def split(elements: Iterator[tuple[dict[str, Any], dict[str, Any]]]) -> Iterator[list[Document]]:
+        documents: Iterator[Document] = json_chunker.create_documents(elements)
+        return batched(manifest.filter_changed(documents) if manifest is not None else documents, batch_size)
+
+    async def embed(batch: list[Document]) -> tuple[list[Document], list[list[float]]]:
+        return batch, await embeddings.aembed_documents([document.page_content for document in batch])
+
+    async def write(embedded_batch: tuple[list[Document], list[list[float]]]) -> list[str]:
+        batch, vectors = embedded_batch
+        assign_ids(batch)
+        return await write_batch(batch, vectors)
+
+    return (
+        Pipeline(queue_size=queue_size)
+        .source(
+            'fetch',
+            fetch_objects(s3_client, bucket, sources, s3_max_workers, s3_range_threshold, s3_part_size, s3_max_buffer_bytes),
+            queue_size=s3_queue_size
+        )
+        .transform('parse', parse_objects)
+        .transform('split', split)
+        .map('embed', embed, workers=max_concurrency, max_retries=max_retries)
+        .map('write', write, workers=max_write_concurrency, max_retries=max_retries)
+    )
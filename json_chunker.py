@@ -0,0 +1,131 @@
+import json
+from langchain_core.documents import Document
+from typing import Any, Callable, Iterable, Iterator
+
+class JsonChunker:
+    """
+    Splits JSON objects into chunks of nested objects that preserve the path of every value
+
+    Produces the same chunks as RecursiveJsonSplitter, which serializes the chunk and every candidate subtree to measure
+    them, i.e., once per level a value is nested at. Instead, the serialized size of every subtree is computed bottom-up
+    in a single pass and the size of the chunk is updated as values are added, so each element is serialized once for
+    measuring and once per chunk for the output.
+
+    Sizes can also be measured in tokens by passing a length function, in which case the size of a chunk is the sum of
+    the lengths of its keys, values and punctuation, which slightly overestimates the tokens of the serialized chunk.
+    """
+
+    def __init__(
+        self,
+        max_chunk_size: int = 2000,
+        min_chunk_size: int | None = None,
+        length_function: Callable[[str], int] = len,
+    ):
+        """
+        :param max_chunk_size: Maximum size of a chunk, only exceeded by a single value that's too large on its own
+        :param min_chunk_size: Size from which a chunk is closed when the next value doesn't fit, defaults to 200 less
+            than max_chunk_size with a lower bound of 50 like RecursiveJsonSplitter
+        :param length_function: Measures the size of serialized JSON, e.g. in tokens with
+            lambda text: len(tokenizer.encode(text)), characters by default
+        """
+        self.max_chunk_size: int = max_chunk_size
+        self.min_chunk_size: int = min_chunk_size if min_chunk_size is not None else max(max_chunk_size - 200, 50)
+        self.length_function: Callable[[str], int] = length_function
+        self._braces: int = length_function('{}')
+        self._brackets: int = length_function('[]')
+        self._comma: int = length_function(', ')
+        self._colon: int = length_function(': ')
+
+    def _key_size(self, key: str) -> int:
+        return self.length_function(json.dumps(key))
+
+    def _measure(self, value: Any, sizes: dict[int, int]) -> int:
+        # sizes is keyed by id since the element, and so every subtree, is alive for as long as it's being split
+        size: int | None = sizes.get(id(value))
+        if size is not None:
+            return size
+        if isinstance(value, dict):
+            size = self._braces + self._comma * max(len(value) - 1, 0) + sum(
+                self._key_size(key) + self._colon + self._measure(item, sizes) for key, item in value.items()
+            )
+        elif isinstance(value, list):
+            size = self._brackets + self._comma * max(len(value) - 1, 0) + sum(
+                self._measure(item, sizes) for item in value
+            )
+        else:
+            size = self.length_function(json.dumps(value))
+        sizes[id(value)] = size
+        return size
+
+    def split_json(self, data: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        """
+        Splits a JSON object into chunks
+
+        :param data: JSON object to split
+        :return: Iterator over the chunks, each a JSON object with the same nesting as data
+        """
+        if not isinstance(data, dict):
+            raise TypeError(f'Expecting a JSON object but got {type(data).__name__}')
+        sizes: dict[int, int] = {}
+        chunk: dict[str, Any] = {}
+        chunk_size: int = self._braces
+
+        def add(path: list[str], value: Any) -> None:
+            nonlocal chunk_size
+            parent: dict[str, Any] = chunk
+            depth: int = 0
+            while depth < len(path) - 1 and path[depth] in parent:
+                parent = parent[path[depth]]
+                depth += 1
+            # whatever part of the path isn't in the chunk yet is added as nested objects around the value
+            size: int = self._measure(value, sizes)
+            for key in reversed(path[depth + 1:]):
+                size = self._braces + self._key_size(key) + self._colon + size
+            chunk_size += (self._comma if parent else 0) + self._key_size(path[depth]) + self._colon + size
+            for key in path[depth:-1]:
+                parent = parent.setdefault(key, {})
+            parent[path[-1]] = value
+
+        def split(value: Any, path: list[str]) -> Iterator[dict[str, Any]]:
+            nonlocal chunk, chunk_size
+            if not isinstance(value, dict):
+                add(path, value)
+                return
+            for key, item in value.items():
+                item_size: int = self._braces + self._key_size(key) + self._colon + self._measure(item, sizes)
+                if item_size < self.max_chunk_size - chunk_size:
+                    add([*path, key], item)
+                    continue
+                if chunk_size >= self.min_chunk_size:
+                    yield chunk
+                    chunk, chunk_size = {}, self._braces
+                yield from split(item, [*path, key])
+
+        yield from split(data, [])
+        if chunk:
+            yield chunk
+
+    def split_text(self, data: dict[str, Any], ensure_ascii: bool = True) -> Iterator[str]:
+        for chunk in self.split_json(data):
+            yield json.dumps(chunk, ensure_ascii=ensure_ascii)
+
+    def create_documents(
+        self,
+        elements: Iterable[tuple[dict[str, Any], dict[str, Any]]],
+        chunk_seq_num_key: str = 'document_chunk_seq_num',
+    ) -> Iterator[Document]:
+        """
+        Splits JSON objects into documents as they're provided
+
+        :param elements: Each JSON object along with the metadata of the source it came from, consumed lazily so it may
+            be a generator
+        :param chunk_seq_num_key: Metadata key of the chunk sequence number, which starts at 1 for each source
+        :return: Iterator over the documents, each with the metadata of its element and its chunk sequence number
+        """
+        chunk_seq_nums: dict[str, int] = {}
+        for element, metadata in elements:
+            for text in self.split_text(element):
+                chunk_seq_nums[metadata['source']] = chunk_seq_nums.get(metadata['source'], 0) + 1
+                yield Document(
+                    page_content=text, metadata={ **metadata, chunk_seq_num_key: chunk_seq_nums[metadata['source']] }
+                )
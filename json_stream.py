@@ -0,0 +1,78 @@
+import codecs
+import json
+from typing import Any, Iterable, Iterator
+
+_WHITESPACE: str = ' \t\n\r'
+_DELIMITERS: str = _WHITESPACE + ',]'
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Incrementally parses a top-level JSON array, yielding each element as soon as it's complete
+
+    Only the element being parsed and the unread remainder of the current chunk are held in memory, so memory stays
+    flat regardless of the size of the array. When an element spans several chunks, at least as much data as has
+    already been buffered is read before parsing again so large elements are parsed a bounded number of times.
+
+    :param chunks: UTF-8 encoded chunks of the JSON array, e.g. from StreamingBody.iter_chunks()
+    :return: Iterator over the decoded elements of the array
+    :raises json.JSONDecodeError: if the content isn't a well-formed JSON array
+    """
+    decoder: json.JSONDecoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunk_iterator: Iterator[bytes] = iter(chunks)
+    buffer: str = ''
+    pos: int = 0
+    eof: bool = False
+
+    def fill(min_chars: int = 1) -> None:
+        nonlocal buffer, pos, eof
+        pending: list[str] = [buffer[pos:]]
+        read: int = 0
+        while read < min_chars and not eof:
+            chunk: bytes | None = next(chunk_iterator, None)
+            text: str = utf8_decoder.decode(chunk or b'', final=chunk is None)
+            eof = chunk is None
+            pending.append(text)
+            read += len(text)
+        buffer = ''.join(pending)
+        pos = 0
+
+    def next_token() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return ''
+            fill()
+
+    if next_token() != '[':
+        raise json.JSONDecodeError('Expecting a top-level array', buffer, pos)
+    pos += 1
+    if next_token() == ']':
+        return
+    while True:
+        next_token()
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # a number may continue in the next chunk unless a delimiter follows it in the buffer
+                if eof or (end < len(buffer) and (not _is_number(element) or buffer[end] in _DELIMITERS)):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(max(1, len(buffer) - pos))
+        pos = end
+        yield element
+        token: str = next_token()
+        if token == ']':
+            return
+        if token != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter or ']'", buffer, pos)
+        pos += 1
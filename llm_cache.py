@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import re
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumps, loads
+from typing import Any, Callable
+from embedding_cache import SQLiteByteStore
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalizes the casing and whitespace of a serialized prompt, including the escaped line breaks and tabs of its
+    JSON, so questions that only differ in either share a cache entry
+
+    :param prompt: Messages of the prompt as serialized by langchain_core.load.dumps
+    :return: Normalized prompt, only used as part of the cache key
+    """
+    return re.sub(r'(?:\\[nrt]|\s)+', ' ', prompt.casefold())
+
+# fields of a chat model that don't change its responses, e.g. how long Ollama keeps the model loaded
+_NON_SAMPLING_FIELDS: set[str] = {
+    'name', 'disable_streaming', 'validate_model_on_init', 'keep_alive', 'base_url', 'client_kwargs',
+    'async_client_kwargs', 'sync_client_kwargs'
+}
+
+def model_fingerprint(model: BaseChatModel) -> str:
+    """
+    Identifies a chat model by its model id and sampling parameters
+
+    Some chat models, e.g. ChatOllama, leave them out of the LLM string LangChain passes to the cache, in which case
+    responses would be shared across models and temperatures unless the fingerprint is used as the namespace.
+
+    :param model: Chat model whose responses are cached
+    :return: Parameters of the model as JSON
+    """
+    return json.dumps(model.model_dump(exclude=_NON_SAMPLING_FIELDS), sort_keys=True, default=str)
+
+class SQLiteLLMCache(BaseCache):
+    """
+    LLM cache persisted to a SQLite file that is bounded in size by evicting the least recently used responses
+
+    Responses are keyed by the rendered messages along with the LLM string LangChain derives from the model and a
+    namespace, which is meant to be the model_fingerprint of the model, so a response is only reused for the exact same
+    request to the same model with the same sampling parameters. Set it as the cache of a chat model, e.g.
+    model.cache = SQLiteLLMCache(path, namespace=model_fingerprint(model)).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 256 * 1024 ** 2,
+        memory_max_bytes: int = 16 * 1024 ** 2,
+        normalize: Callable[[str], str] | None = None,
+        namespace: str = '',
+    ):
+        """
+        :param path: Path to the SQLite file, created along with its directory if missing
+        :param max_bytes: Maximum total size of the responses kept in the SQLite file
+        :param memory_max_bytes: Maximum total size of the responses kept in memory
+        :param normalize: Normalizes the prompt before it's hashed into the key, e.g. normalize_prompt
+        :param namespace: Part of every key, e.g. model_fingerprint(model)
+        """
+        self.normalize: Callable[[str], str] | None = normalize
+        self.namespace: str = namespace
+        self.hits: int = 0
+        self.misses: int = 0
+        self._store: SQLiteByteStore = SQLiteByteStore(path, max_bytes=max_bytes, memory_max_bytes=memory_max_bytes)
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        if self.normalize is not None:
+            prompt = self.normalize(prompt)
+        return hashlib.sha256(f'{self.namespace}\n{llm_string}\n{prompt}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        value: bytes | None = self._store.mget([self._key(prompt, llm_string)])[0]
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return loads(value.decode('utf-8'))
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self._store.mset([(self._key(prompt, llm_string), dumps(return_val).encode('utf-8'))])
+
+    def clear(self, **kwargs: Any) -> None:
+        self._store.mdelete(list(self._store.yield_keys()))
@@ -1,36 +1,37 @@
-import boto3
+import asyncio
+import json
 import logging
-import os
 import uuid
-from langchain.chat_models import init_chat_model
-from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import BaseMessage
 from langchain_core.prompt_values import PromptValue
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
 from langgraph.graph.state import CompiledStateGraph
-from tavily import TavilyClient
 from typing import Any, TypedDict
+from resources import (
+    S3_BUCKET,
+    get_async_tavily_client,
+    get_chat_model,
+    get_executor,
+    get_extract_model,
+    get_product_matcher,
+    get_s3_client,
+    run_blocking,
+)
+from report_streaming import astream_answer, astream_to_s3
+from single_flight import coalesce
 
-OLLAMA_MODEL_ID: str = 'llama3.2:3b'
-OLLAMA_BASE_URL: str = 'http://localhost:11434'
-TAVILY_API_KEY: str = os.environ.get('TAVILY_API_KEY')
-S3_BUCKET: str = 'analysis'
-S3_ACCESS_KEY: str = 'admin'
-S3_SECRET_KEY: str = 'password'
-MINIO_ENDPOINT: str = 'http://localhost:9000'
+# the searches are issued concurrently and a search that fails or takes longer than the timeout is left out rather than
+# failing the analysis, where only the title, url and the start of the content of each result is kept for the prompt
+TAVILY_TIMEOUT_SECONDS: float = 15.0
+TAVILY_SNIPPET_MAX_CHARS: int = 500
+# stream the report to S3 with a multipart upload while it's being generated rather than uploading it once it's done
+STREAM_TO_S3: bool = True
 
-client: TavilyClient = TavilyClient(TAVILY_API_KEY)
-llm: BaseChatModel = init_chat_model(OLLAMA_MODEL_ID, model_provider='ollama', base_url=OLLAMA_BASE_URL)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger: logging.Logger = logging.getLogger(__name__)
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_KEY,
-    endpoint_url=MINIO_ENDPOINT
-)
 
 class State(TypedDict):
     question: str
@@ -39,10 +40,11 @@ class State(TypedDict):
     answer: str
     s3_result_location: str
 
-def extract(state: State) -> dict[str, Any]:
-    question: str = state['question']
-    prompt: ChatPromptTemplate = ChatPromptTemplate.from_template(
-        '''
+# The prompts are built once and split into a static system message followed by a human message with everything that
+# varies per request, so that every request starts with the same prefix whose computation Ollama can reuse.
+
+EXTRACT_PROMPT: ChatPromptTemplate = ChatPromptTemplate.from_messages([
+    ('system', '''
         # Role: Market Analyst for AwsomeCar
         
         # Goal: Extract the core product/topic from the question.
@@ -59,39 +61,16 @@ def extract(state: State) -> dict[str, Any]:
             - "Write a marketing report on Tesla Model Y" → "Tesla Model Y"
             - "Compare and analyze Hyundai IONIQ 5 and Kia EV6" → "Hyundai IONIQ 5, Kia EV6"
             - "Tell me about the latest electric vehicle market trends" → "Electric vehicles"
-        
-        Question: {question}
-        '''
-    )
-    messages: PromptValue = prompt.invoke({'question': state['question']})
-    ai_message: BaseMessage = llm.invoke(messages)
-    product: str = ai_message.content
-    logger.info(f'Extracted product: "{product}" from question: "{question}"')
-    return {'product': product}
+        '''),
+    ('human', 'Question: {question}'),
+])
 
-def search_tavily(state: State) -> dict[str, Any]:
-    product: str = state['product']
-    search_queries: list[str] = [
-        'market size and growth trends for the specific product/industry in the target market',
-        'detailed competitor analysis including market share and strategies',
-        'target audience demographics, psychographics, and behaviors in the specific market',
-        'regulatory factors, local market challenges, and consumer preferences'
-    ]
-    api_responses: list[dict[str, Any]] = []
-    for search_query in search_queries:
-        query: str = f'Provide {search_query} regarding the {product}'
-        logger.info(f'Query: "{query}" sent to Tavily')
-        api_responses.append(client.search(query=query))
-    return {'api_responses': api_responses}
-
-def generate(state: State) -> dict[str, Any]:
-    # TODO the output format isn't adhered to exactly so need to enforce it somehow...
-    prompt: ChatPromptTemplate = ChatPromptTemplate.from_template(
-        '''
+# TODO the output format isn't adhered to exactly so need to enforce it somehow...
+GENERATE_PROMPT: ChatPromptTemplate = ChatPromptTemplate.from_messages([
+    ('system', '''
         # Role: Market Analyst for AwsomeCar
 
         # Goal: Provide comprehensive market research based on search engine results pages and format the results in a standardized format that can be stored for further processing.
-        Product or Trend: {product}
         
         # Guideline:
         1. CRITICAL: For EACH data point, statistic, or claim in your analysis, you MUST include the reference source
@@ -121,29 +100,123 @@ def generate(state: State) -> dict[str, Any]:
         1. NEVER ask clarifying questions to the user
         2. ENSURE all sections contain DETAILED content with specific examples and data points
         3. CRITICAL: Format your analysis according to the template specified
+        '''),
+    ('human', '''
+        Product or Trend: {product}
 
         Search Engine Result Pages: <search_results>{api_responses}</search_results>
-        '''
-    )
+        '''),
+])
+
+async def extract(state: State) -> dict[str, Any]:
+    question: str = state['question']
+    # the LLM is only asked when the question doesn't mention any known product, where several products are listed the
+    # same way the LLM is asked to, e.g. "Hyundai IONIQ 5, Kia EV6"
+    products: list[str] = (await run_blocking(get_product_matcher)).match(question)
+    if products:
+        logger.info(f'Matched products: {products} in question: "{question}"')
+        return {'product': ', '.join(products)}
+    messages: PromptValue = EXTRACT_PROMPT.invoke({'question': question})
+    ai_message: BaseMessage = await get_extract_model().ainvoke(messages)
+    product: str = ai_message.content
+    logger.info(f'Extracted product: "{product}" from question: "{question}"')
+    return {'product': product}
+
+def compact_search_response(
+    response: dict[str, Any], snippet_max_chars: int = TAVILY_SNIPPET_MAX_CHARS
+) -> dict[str, Any]:
+    """
+    Reduces a Tavily response to what the prompt needs, dropping the scores, timings, raw content and so on
+
+    :param response: Response of TavilyClient.search
+    :param snippet_max_chars: Maximum length of the content of each result, cut at the last sentence that fits
+    :return: Query along with the title, url and snippet of each result
+    """
+    results: list[dict[str, str]] = []
+    for result in response.get('results', []):
+        snippet: str = ' '.join(result.get('content', '').split())
+        if len(snippet) > snippet_max_chars:
+            cut: str = snippet[:snippet_max_chars]
+            snippet = cut[:cut.rfind('. ') + 1] if '. ' in cut else cut.rstrip() + '...'
+        results.append({'title': result.get('title', ''), 'url': result.get('url', ''), 'snippet': snippet})
+    return {'query': response.get('query', ''), 'results': results}
+
+async def search_tavily(state: State, config: RunnableConfig) -> dict[str, Any]:
     product: str = state['product']
-    messages: PromptValue = prompt.invoke({'product': product, 'api_responses': state['api_responses']})
-    logger.info(f'LLM invoked for market analysis on product or trend: "{product}"')
-    ai_message: BaseMessage = llm.invoke(messages)
-    return {'answer': ai_message.content}
 
-def store_results_in_s3(state: State) -> dict[str, Any]:
+    async def search() -> dict[str, Any]:
+        search_queries: list[str] = [
+            'market size and growth trends for the specific product/industry in the target market',
+            'detailed competitor analysis including market share and strategies',
+            'target audience demographics, psychographics, and behaviors in the specific market',
+            'regulatory factors, local market challenges, and consumer preferences'
+        ]
+        queries: list[str] = [f'Provide {search_query} regarding the {product}' for search_query in search_queries]
+        logger.info(f'Queries: {queries} sent to Tavily')
+        responses: list[dict[str, Any] | BaseException] = await asyncio.gather(
+            *(
+                asyncio.wait_for(get_async_tavily_client().search(query=query), TAVILY_TIMEOUT_SECONDS)
+                for query in queries
+            ),
+            return_exceptions=True
+        )
+        api_responses: list[dict[str, Any]] = []
+        for query, response in zip(queries, responses):
+            if isinstance(response, BaseException):
+                logger.warning(f'Query: "{query}" left out since Tavily failed: {response!r}')
+                continue
+            api_responses.append(compact_search_response(response))
+        if not api_responses:
+            raise RuntimeError(f'All {len(queries)} Tavily searches failed for product: "{product}"')
+        return {'api_responses': api_responses}
+
+    # the questions of a batch about the same product share a single search
+    return await coalesce(config, ('search_tavily', product), search)
+
+async def generate(state: State, config: RunnableConfig) -> dict[str, Any]:
+    product: str = state['product']
+
+    async def analyze() -> dict[str, Any]:
+        messages: PromptValue = GENERATE_PROMPT.invoke({
+            'product': product,
+            'api_responses': json.dumps(state['api_responses'], ensure_ascii=False, separators=(',', ':'))
+        })
+        logger.info(f'LLM invoked for market analysis on product or trend: "{product}"')
+        if STREAM_TO_S3:
+            key: str = f'market_analysis_agent/{uuid.uuid4()}.txt'
+            answer: str = await astream_to_s3(
+                get_chat_model(), messages, await run_blocking(get_s3_client), S3_BUCKET, key, executor=get_executor()
+            )
+            logger.info(f'Market analysis saved to s3://{S3_BUCKET}/{key}')
+            return {'answer': answer, 's3_result_location': f's3://{S3_BUCKET}/{key}'}
+        ai_message: BaseMessage = await get_chat_model().ainvoke(messages)
+        return {'answer': ai_message.content}
+
+    return await coalesce(config, ('generate', product), analyze)
+
+async def store_results_in_s3(state: State) -> dict[str, Any]:
     key: str = f'market_analysis_agent/{uuid.uuid4()}.txt'
     s3_location: str = f's3://{S3_BUCKET}/{key}'
-    s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=state['answer'], ContentType='text/plain')
+    # boto3 has no async client so the upload runs on the bounded executor
+    s3_client = await run_blocking(get_s3_client)
+    await run_blocking(s3_client.put_object, Bucket=S3_BUCKET, Key=key, Body=state['answer'], ContentType='text/plain')
     logger.info(f'Market analysis saved to {s3_location}')
     return {'s3_result_location': s3_location}
 
 graph_builder: StateGraph = StateGraph(State)
-graph_builder.add_sequence([extract, search_tavily, generate, store_results_in_s3])
 graph_builder.add_edge(START, 'extract')
-graph_builder.add_edge('store_results_in_s3', END)
+if STREAM_TO_S3:
+    graph_builder.add_sequence([extract, search_tavily, generate])
+    graph_builder.add_edge('generate', END)
+else:
+    graph_builder.add_sequence([extract, search_tavily, generate, store_results_in_s3])
+    graph_builder.add_edge('store_results_in_s3', END)
 graph: CompiledStateGraph = graph_builder.compile()
-logger.info(graph.get_graph().draw_ascii())
 
-response: dict[str, Any] = graph.invoke({'question': 'Tell me about Tesla Cybertruck and summarize consumer reactions.'})
-print(response['s3_result_location'])
+if __name__ == '__main__':
+    logger.info(graph.get_graph().draw_ascii())
+    # the report is printed as it's generated
+    response: dict[str, Any] = asyncio.run(astream_answer(
+        graph, {'question': 'Tell me about Tesla Cybertruck and summarize consumer reactions.'}, {'generate'}
+    ))
+    print(response['s3_result_location'])
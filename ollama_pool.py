@@ -0,0 +1,383 @@
+import asyncio
+import httpx
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+from ollama import ResponseError
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, model_validator
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+from typing_extensions import Self
+
+logger: logging.Logger = logging.getLogger(__name__)
+T = TypeVar('T')
+M = TypeVar('M', bound=BaseModel)
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """
+    :param error: Error a request to an endpoint failed with
+    :return: Whether the endpoint is to blame, i.e., it couldn't be reached, timed out or failed with a server error,
+        rather than the request, e.g. for a model that isn't pulled
+    """
+    return isinstance(error, (ConnectionError, httpx.TransportError)) \
+        or (isinstance(error, ResponseError) and error.status_code >= 500)
+
+@dataclass
+class OllamaEndpoint:
+    base_url: str
+    # requests in flight, which is what requests are routed by
+    outstanding: int = 0
+    requests: int = 0
+    consecutive_failures: int = 0
+    # monotonic time until which no requests are routed to the endpoint, inf until a health check passes
+    ejected_until: float = 0.0
+
+class OllamaPool:
+    """
+    Spreads requests over several Ollama endpoints serving the same model
+
+    Each request goes to the endpoint with the fewest requests in flight, up to max_concurrency per endpoint beyond
+    which requests wait for one to finish, e.g. matching the OLLAMA_NUM_PARALLEL of the servers so requests queue here
+    rather than on one server while another is idle. An endpoint that fails failure_threshold requests in a row is
+    ejected for eject_seconds, and one that fails a health check is ejected until it passes one again. A request that
+    fails because of its endpoint is retried on another one as long as nothing was returned yet. If every endpoint is
+    ejected, requests are routed to them regardless rather than failing outright.
+
+    Requests can be made from threads and event loops alike, so a pool can be shared by every model of a process, see
+    PooledChatOllama and PooledOllamaEmbeddings.
+    """
+
+    def __init__(
+        self,
+        base_urls: list[str],
+        max_concurrency: int = 4,
+        failure_threshold: int = 3,
+        eject_seconds: float = 30.0,
+        health_check_interval_seconds: float | None = 10.0,
+        health_check_timeout_seconds: float = 2.0,
+    ):
+        """
+        :param base_urls: Base URLs of the Ollama endpoints
+        :param max_concurrency: Maximum number of requests in flight per endpoint
+        :param failure_threshold: Number of failed requests in a row that ejects an endpoint
+        :param eject_seconds: How long an endpoint is ejected for after failure_threshold failed requests
+        :param health_check_interval_seconds: Interval of the health checks, which start with the first request, or
+            None to only eject endpoints for failed requests
+        :param health_check_timeout_seconds: Timeout of each health check
+        """
+        if not base_urls:
+            raise ValueError('At least one Ollama endpoint is required')
+        self.endpoints: list[OllamaEndpoint] = [OllamaEndpoint(base_url.rstrip('/')) for base_url in base_urls]
+        self.max_concurrency: int = max_concurrency
+        self.failure_threshold: int = failure_threshold
+        self.eject_seconds: float = eject_seconds
+        self.health_check_interval_seconds: float | None = health_check_interval_seconds
+        self.health_check_timeout_seconds: float = health_check_timeout_seconds
+        self._lock: threading.Lock = threading.Lock()
+        self._released: threading.Condition = threading.Condition(self._lock)
+        # requests waiting for an endpoint on an event loop, which a thread can only wake through the loop
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._health_checks: threading.Thread | None = None
+        self._closed: threading.Event = threading.Event()
+
+    @property
+    def base_urls(self) -> list[str]:
+        return [endpoint.base_url for endpoint in self.endpoints]
+
+    def _select(self, exclude: set[str]) -> OllamaEndpoint | None:
+        # called with the lock held
+        now: float = time.monotonic()
+        candidates: list[OllamaEndpoint] = [endpoint for endpoint in self.endpoints if endpoint.base_url not in exclude]
+        healthy: list[OllamaEndpoint] = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+        available: list[OllamaEndpoint] = [
+            endpoint for endpoint in healthy or candidates if endpoint.outstanding < self.max_concurrency
+        ]
+        if not available:
+            return None
+        # ties go to the endpoint that served the fewest requests so an idle pool still takes turns
+        endpoint: OllamaEndpoint = min(available, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def _acquire(self, exclude: set[str]) -> OllamaEndpoint:
+        self._start_health_checks()
+        with self._released:
+            while (endpoint := self._select(exclude)) is None:
+                self._released.wait()
+            return endpoint
+
+    async def _aacquire(self, exclude: set[str]) -> OllamaEndpoint:
+        self._start_health_checks()
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                endpoint: OllamaEndpoint | None = self._select(exclude)
+                if endpoint is not None:
+                    return endpoint
+                waiter: asyncio.Future = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def _notify(self) -> None:
+        # called with the lock held
+        self._released.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._async_waiters.clear()
+
+    def _release(self, endpoint: OllamaEndpoint, error: BaseException | None) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+            elif is_endpoint_failure(error):
+                endpoint.consecutive_failures += 1
+                now: float = time.monotonic()
+                # an endpoint that's already ejected stays ejected until then, e.g. until it passes a health check
+                if endpoint.consecutive_failures >= self.failure_threshold and endpoint.ejected_until <= now:
+                    endpoint.ejected_until = now + self.eject_seconds
+                    logger.warning(
+                        f'Ejected {endpoint.base_url} for {self.eject_seconds:.0f}s after '
+                        f'{endpoint.consecutive_failures} failed requests in a row: {error!r}'
+                    )
+            self._notify()
+
+    def _retry(self, endpoint: OllamaEndpoint, error: BaseException, tried: set[str], retriable: bool = True) -> bool:
+        # releases the endpoint of a failed request and tells whether to retry it on another one
+        self._release(endpoint, error)
+        tried.add(endpoint.base_url)
+        if not retriable or not is_endpoint_failure(error) or len(tried) == len(self.endpoints):
+            return False
+        logger.warning(f'Retrying on another endpoint after {endpoint.base_url} failed: {error!r}')
+        return True
+
+    def run(self, request: Callable[[str], T]) -> T:
+        """
+        :param request: Makes the request to the endpoint of the given base URL
+        :return: Result of the request
+        """
+        tried: set[str] = set()
+        while True:
+            endpoint: OllamaEndpoint = self._acquire(tried)
+            try:
+                result: T = request(endpoint.base_url)
+            except BaseException as e:
+                if self._retry(endpoint, e, tried):
+                    continue
+                raise
+            self._release(endpoint, None)
+            return result
+
+    async def arun(self, request: Callable[[str], Awaitable[T]]) -> T:
+        """
+        :param request: Makes the request to the endpoint of the given base URL
+        :return: Result of the request
+        """
+        tried: set[str] = set()
+        while True:
+            endpoint: OllamaEndpoint = await self._aacquire(tried)
+            try:
+                result: T = await request(endpoint.base_url)
+            except BaseException as e:
+                if self._retry(endpoint, e, tried):
+                    continue
+                raise
+            self._release(endpoint, None)
+            return result
+
+    def stream(self, request: Callable[[str], Iterator[T]]) -> Iterator[T]:
+        """
+        :param request: Makes the streaming request to the endpoint of the given base URL
+        :return: Iterator over the streamed response, which holds the endpoint until it's exhausted or closed
+        """
+        tried: set[str] = set()
+        while True:
+            endpoint: OllamaEndpoint = self._acquire(tried)
+            streamed: bool = False
+            try:
+                for item in request(endpoint.base_url):
+                    streamed = True
+                    yield item
+            except BaseException as e:
+                if self._retry(endpoint, e, tried, retriable=not streamed):
+                    continue
+                raise
+            self._release(endpoint, None)
+            return
+
+    async def astream(self, request: Callable[[str], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """
+        :param request: Makes the streaming request to the endpoint of the given base URL
+        :return: Iterator over the streamed response, which holds the endpoint until it's exhausted or closed
+        """
+        tried: set[str] = set()
+        while True:
+            endpoint: OllamaEndpoint = await self._aacquire(tried)
+            streamed: bool = False
+            try:
+                async for item in request(endpoint.base_url):
+                    streamed = True
+                    yield item
+            except BaseException as e:
+                if self._retry(endpoint, e, tried, retriable=not streamed):
+                    continue
+                raise
+            self._release(endpoint, None)
+            return
+
+    def check_health(self) -> None:
+        """
+        Ejects the endpoints that don't respond to GET /api/version and readmits those that do again
+        """
+        for endpoint in self.endpoints:
+            error: httpx.HTTPError | None = None
+            try:
+                httpx.get(
+                    f'{endpoint.base_url}/api/version', timeout=self.health_check_timeout_seconds
+                ).raise_for_status()
+            except httpx.HTTPError as e:
+                error = e
+            with self._lock:
+                if error is None and endpoint.ejected_until == math.inf:
+                    endpoint.ejected_until = 0.0
+                    endpoint.consecutive_failures = 0
+                    logger.info(f'Readmitted {endpoint.base_url} after it passed a health check')
+                    self._notify()
+                elif error is not None and endpoint.ejected_until != math.inf:
+                    endpoint.ejected_until = math.inf
+                    logger.warning(f'Ejected {endpoint.base_url} until it passes a health check: {error!r}')
+
+    def _start_health_checks(self) -> None:
+        if self._health_checks is not None or self.health_check_interval_seconds is None:
+            return
+        with self._lock:
+            if self._health_checks is None:
+                self._health_checks = threading.Thread(
+                    target=self._run_health_checks, name='ollama-health-checks', daemon=True
+                )
+                self._health_checks.start()
+
+    def _run_health_checks(self) -> None:
+        while not self._closed.is_set():
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.exception(f'Health check failed: {e!r}')
+            self._closed.wait(self.health_check_interval_seconds)
+
+    def close(self) -> None:
+        self._closed.set()
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+def _endpoint_models(model: BaseModel, model_class: type[M], base_urls: list[str]) -> dict[str, M]:
+    # the fields that were set on the pooled model, other than its base URL, are passed on to the model of each endpoint
+    fields: dict[str, Any] = {
+        name: getattr(model, name)
+        for name in model.model_fields_set if name in model_class.model_fields and name != 'base_url'
+    }
+    return {base_url: model_class(**fields, base_url=base_url) for base_url in base_urls}
+
+class PooledChatOllama(ChatOllama):
+    """
+    ChatOllama that sends each request to an endpoint of an OllamaPool instead of base_url
+
+    A drop-in for ChatOllama, e.g. PooledChatOllama(pool=pool, model='llama3.2:3b', temperature=0), where tool binding,
+    structured output, caching and callbacks all work the same since only the requests themselves are routed.
+    """
+
+    pool: OllamaPool = Field(exclude=True)
+    _endpoint_models: dict[str, ChatOllama] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode='after')
+    def _set_endpoint_models(self) -> Self:
+        self._endpoint_models = _endpoint_models(self, ChatOllama, self.pool.base_urls)
+        return self
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.pool.run(
+            lambda base_url: self._endpoint_models[base_url]._generate(messages, stop, run_manager, **kwargs)
+        )
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await self.pool.arun(
+            lambda base_url: self._endpoint_models[base_url]._agenerate(messages, stop, run_manager, **kwargs)
+        )
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        yield from self.pool.stream(
+            lambda base_url: self._endpoint_models[base_url]._stream(messages, stop, run_manager, **kwargs)
+        )
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.pool.astream(
+            lambda base_url: self._endpoint_models[base_url]._astream(messages, stop, run_manager, **kwargs)
+        ):
+            yield chunk
+
+class PooledOllamaEmbeddings(OllamaEmbeddings):
+    """
+    OllamaEmbeddings that sends each request to an endpoint of an OllamaPool instead of base_url
+
+    A drop-in for OllamaEmbeddings, e.g. PooledOllamaEmbeddings(pool=pool, model='llama3.2:3b'), where the pool is
+    best kept separate from the one of the chat models so embedding a batch of documents doesn't hold up generation.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    pool: OllamaPool = Field(exclude=True)
+    _endpoint_models: dict[str, OllamaEmbeddings] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode='after')
+    def _set_endpoint_models(self) -> Self:
+        self._endpoint_models = _endpoint_models(self, OllamaEmbeddings, self.pool.base_urls)
+        return self
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.pool.run(lambda base_url: self._endpoint_models[base_url].embed_documents(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.pool.run(lambda base_url: self._endpoint_models[base_url].embed_query(text))
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.pool.arun(lambda base_url: self._endpoint_models[base_url].aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.pool.arun(lambda base_url: self._endpoint_models[base_url].aembed_query(text))
@@ -0,0 +1,193 @@
+import logging
+import psycopg
+import queue
+import threading
+import time
+import uuid
+from langchain_core.documents import Document
+from pgvector.psycopg import register_vector
+from psycopg import sql
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+class CopyWriter:
+    """
+    Writes embedded documents into a PGVectorStore table with binary COPY instead of one INSERT per row
+
+    With upsert, rows are copied into a temporary staging table and merged with INSERT ... ON CONFLICT so that
+    existing ids are overwritten the same way PGVectorStore does; otherwise they're copied straight into the table,
+    which is only safe when none of the ids exist yet (e.g. right after the table was created). Each write is its own
+    transaction so that a failed batch can be retried on its own. Up to max_connections writes run at once, each on a
+    connection of its own with its own staging table, where connections are opened as they're needed.
+    """
+
+    def __init__(
+        self,
+        conninfo: str,
+        table_name: str,
+        upsert: bool = True,
+        id_column: str = 'langchain_id',
+        content_column: str = 'content',
+        embedding_column: str = 'embedding',
+        metadata_json_column: str = 'langchain_metadata',
+        metadata_columns: list[str] | None = None,
+        max_connections: int = 1,
+    ):
+        self.conninfo: str = conninfo
+        self.table_name: str = table_name
+        self.upsert: bool = upsert
+        self.id_column: str = id_column
+        # like PGVectorStore, metadata with a column of its own is written to that column instead of the JSON column
+        self.metadata_columns: list[str] = metadata_columns or []
+        self.columns: list[str] = [id_column, content_column, embedding_column, *self.metadata_columns, metadata_json_column]
+        self.max_connections: int = max_connections
+        self._lock: threading.Lock = threading.Lock()
+        # a slot is held for every connection in use, idle connections are reused before new ones are opened
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(max_connections)
+        self._connections: list[psycopg.Connection] = []
+        self._idle: list[psycopg.Connection] = []
+        conn: psycopg.Connection = self._connect()
+        # binary COPY needs the exact type of every column, which also picks vector or halfvec for the embedding
+        column_types: dict[str, str] = dict(conn.execute(
+            '''SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+            WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped''',
+            (sql.Identifier(table_name).as_string(conn),)
+        ).fetchall())
+        self.types: list[str] = [column_types[column] for column in self.columns]
+        self._idle.append(conn)
+
+    @property
+    def _staging_table_name(self) -> str:
+        return f'{self.table_name}_staging'
+
+    def _connect(self) -> psycopg.Connection:
+        conn: psycopg.Connection = psycopg.connect(self.conninfo, autocommit=True)
+        register_vector(conn)
+        if self.upsert:
+            # temporary tables are per connection so every connection needs its own staging table
+            conn.execute(sql.SQL(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+            ).format(sql.Identifier(self._staging_table_name), sql.Identifier(self.table_name)))
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _acquire(self) -> psycopg.Connection:
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: psycopg.Connection) -> None:
+        with self._lock:
+            if conn.broken or conn.closed:
+                # e.g. after the server closed it, a new connection is opened the next time one is needed
+                self._connections.remove(conn)
+                conn.close()
+            else:
+                self._idle.append(conn)
+        self._slots.release()
+
+    def write(self, documents: list[Document], embeddings: list[list[float]]) -> list[str]:
+        """
+        Copies the documents and their embeddings into the table under the documents' ids
+
+        :param documents: Documents with their ids already assigned
+        :param embeddings: Embedding of each document
+        :return: Ids of the documents written
+        """
+        conn: psycopg.Connection = self._acquire()
+        try:
+            self._copy(conn, documents, embeddings)
+        finally:
+            self._release(conn)
+        return [document.id for document in documents]
+
+    def _copy(self, conn: psycopg.Connection, documents: list[Document], embeddings: list[list[float]]) -> None:
+        column_names: sql.Composable = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        target: str = self._staging_table_name if self.upsert else self.table_name
+        with conn.transaction(), conn.cursor() as cursor:
+            with cursor.copy(sql.SQL('COPY {} ({}) FROM STDIN (FORMAT BINARY)').format(
+                sql.Identifier(target), column_names
+            )) as copy:
+                copy.set_types(self.types)
+                for document, embedding in zip(documents, embeddings):
+                    copy.write_row((
+                        uuid.UUID(document.id),
+                        document.page_content,
+                        embedding,
+                        *(document.metadata.get(column) for column in self.metadata_columns),
+                        { key: value for key, value in document.metadata.items() if key not in self.metadata_columns }
+                    ))
+            if self.upsert:
+                cursor.execute(sql.SQL(
+                    'INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO UPDATE SET {}'
+                ).format(
+                    sql.Identifier(self.table_name),
+                    column_names,
+                    column_names,
+                    sql.Identifier(target),
+                    sql.Identifier(self.id_column),
+                    sql.SQL(', ').join(
+                        sql.SQL('{} = EXCLUDED.{}').format(sql.Identifier(column), sql.Identifier(column))
+                        for column in self.columns if column != self.id_column
+                    )
+                ))
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._idle.clear()
+
+    def __enter__(self) -> 'CopyWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def get_index_definitions(conninfo: str, table_name: str) -> dict[str, str]:
+    """
+    Gets the definitions of the secondary indexes of a table, i.e., excluding primary key and unique indexes
+
+    :param conninfo: psycopg connection string
+    :param table_name: Table to get the indexes of
+    :return: CREATE INDEX statement of each index by name
+    """
+    with psycopg.connect(conninfo) as conn:
+        return dict(conn.execute(
+            '''SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index
+            WHERE indrelid = %s::regclass AND NOT indisprimary AND NOT indisunique''',
+            (sql.Identifier(table_name).as_string(conn),)
+        ).fetchall())
+
+def set_maintenance_options(conn: psycopg.Connection, maintenance_work_mem: str, max_parallel_maintenance_workers: int) -> None:
+    conn.execute(sql.SQL('SET maintenance_work_mem = {}').format(sql.Literal(maintenance_work_mem)))
+    conn.execute(sql.SQL('SET max_parallel_maintenance_workers = {}').format(sql.Literal(max_parallel_maintenance_workers)))
+
+def build_indexes(
+    conninfo: str,
+    index_definitions: dict[str, str],
+    maintenance_work_mem: str = '1GB',
+    max_parallel_maintenance_workers: int = 4,
+) -> None:
+    """
+    Builds indexes with more memory and parallel workers than the server defaults, i.e., after a bulk load
+
+    :param conninfo: psycopg connection string
+    :param index_definitions: CREATE INDEX statement of each index by name, see get_index_definitions
+    :param maintenance_work_mem: Memory each build may use, builds that don't fit are much slower
+    :param max_parallel_maintenance_workers: Number of parallel workers each build may use
+    """
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        set_maintenance_options(conn, maintenance_work_mem, max_parallel_maintenance_workers)
+        for name, definition in index_definitions.items():
+            started: float = time.perf_counter()
+            conn.execute(definition)
+            logger.info(f'Built index {name} in {time.perf_counter() - started:.1f}s')
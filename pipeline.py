@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Coroutine, Iterable, Iterator
+from ingestion import aretry
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# marks the end of the items in a queue
+_DONE: object = object()
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    queue_size: int
+    items_in: int = 0
+    items_out: int = 0
+    failed: int = 0
+    # waiting on the upstream queue for input, i.e., the stage is faster than the stages before it
+    starved_seconds: float = 0.0
+    # waiting on the downstream queue for room, i.e., the stage is faster than the stages after it
+    stalled_seconds: float = 0.0
+    max_queue_depth: int = 0
+    # time from the start of the pipeline until the stage finished, None while it's running
+    finished_seconds: float | None = None
+
+    def busy_seconds(self, elapsed: float) -> float:
+        # whatever isn't spent waiting on either queue is spent working
+        running: float = self.finished_seconds if self.finished_seconds is not None else elapsed
+        return max(0.0, running * self.workers - self.starved_seconds - self.stalled_seconds)
+
+    def summary(self, elapsed: float, queue_depth: int) -> str:
+        busy: float = self.busy_seconds(elapsed)
+        return (
+            f'{self.name}: {self.items_out} out at {self.items_out / elapsed:.1f}/s, '
+            f'queue {queue_depth}/{self.queue_size} (max {self.max_queue_depth}), '
+            f'busy {busy / (elapsed * self.workers):.0%}, starved {self.starved_seconds:.1f}s, '
+            f'stalled {self.stalled_seconds:.1f}s'
+            f'{f", {self.failed} failed" if self.failed else ""}'
+        )
+
+class Pipeline:
+    """
+    Streams items through stages that run concurrently with a bounded queue after each stage
+
+    Blocking stages (e.g. S3 fetches, parsing, splitting) each run in their own thread, transforming an iterator over
+    their input into an iterator over their output, while async stages (e.g. embedding and writing) run their function on
+    every item with a number of concurrent workers. A full queue blocks the stage feeding it, so memory is bounded by the
+    queue sizes and the slowest stage sets the pace. The stats of every stage are logged periodically to show which
+    stage is the bottleneck: a bottleneck is busy and stalls the stages before it while starving the stages after it.
+    """
+
+    def __init__(self, queue_size: int = 16):
+        """
+        :param queue_size: Default maximum number of items waiting after each stage
+        """
+        self.queue_size: int = queue_size
+        self.stages: list[StageStats] = []
+        self._runners: list[Callable[[asyncio.Queue | None, asyncio.Queue, StageStats], Coroutine[Any, Any, None]]] = []
+        self._failures: list[Exception] = []
+        self._aborted: threading.Event = threading.Event()
+
+    def _add_stage(
+        self,
+        name: str,
+        workers: int,
+        queue_size: int | None,
+        runner: Callable[[asyncio.Queue | None, asyncio.Queue, StageStats], Coroutine[Any, Any, None]],
+    ) -> 'Pipeline':
+        self.stages.append(StageStats(name, workers, queue_size or self.queue_size))
+        self._runners.append(runner)
+        return self
+
+    def source(self, name: str, items: Iterable, queue_size: int | None = None) -> 'Pipeline':
+        """
+        Adds the first stage, which iterates over items in its own thread
+
+        :param name: Name of the stage in the stats
+        :param items: Items to stream, consumed lazily so it may be a generator
+        :param queue_size: Maximum number of items waiting after this stage
+        """
+        if self.stages:
+            raise ValueError('The source has to be the first stage')
+        return self._add_stage(name, 1, queue_size, lambda _, output, stats: self._run_thread(lambda _: items, None, output, stats))
+
+    def transform(
+        self, name: str, func: Callable[[Iterator], Iterable], queue_size: int | None = None
+    ) -> 'Pipeline':
+        """
+        Adds a blocking stage that transforms the iterator over the previous stage's items in its own thread
+
+        :param name: Name of the stage in the stats
+        :param func: Transforms an iterator over the input into the output, e.g. a generator function, items are
+            processed in order so it may keep state across items
+        :param queue_size: Maximum number of items waiting after this stage
+        """
+        return self._add_stage(name, 1, queue_size, lambda input, output, stats: self._run_thread(func, input, output, stats))
+
+    def map(
+        self,
+        name: str,
+        func: Callable[[Any], Awaitable[Any]],
+        workers: int = 1,
+        max_retries: int = 0,
+        retry_backoff_seconds: float = 1.0,
+        queue_size: int | None = None,
+    ) -> 'Pipeline':
+        """
+        Adds an async stage that awaits func on each of the previous stage's items, out of order when workers > 1
+
+        Items that still fail after max_retries are dropped so the rest of the items keep flowing, and are reported
+        once the pipeline has finished.
+
+        :param name: Name of the stage in the stats
+        :param func: Transforms an item, retried on failure so it should be idempotent
+        :param workers: Number of items in flight at once
+        :param max_retries: Number of times a failed item is retried before it's dropped
+        :param retry_backoff_seconds: Initial delay before retrying a failed item, doubled on every attempt
+        :param queue_size: Maximum number of items waiting after this stage
+        """
+        async def run(input: asyncio.Queue, output: asyncio.Queue, stats: StageStats) -> None:
+            async def work() -> None:
+                while True:
+                    started: float = time.perf_counter()
+                    item: Any = await input.get()
+                    stats.starved_seconds += time.perf_counter() - started
+                    if item is _DONE:
+                        # left for the other workers
+                        await input.put(_DONE)
+                        return
+                    stats.items_in += 1
+                    try:
+                        result: Any = await aretry(lambda: func(item), f'{name} of item {stats.items_in}', max_retries, retry_backoff_seconds)
+                    except Exception as e:
+                        stats.failed += 1
+                        self._failures.append(e)
+                        logger.error(f'{name} failed after {max_retries} retries: {e}')
+                        continue
+                    await self._put(output, result, stats)
+
+            await asyncio.gather(*(work() for _ in range(workers)))
+            await output.put(_DONE)
+
+        return self._add_stage(name, workers, queue_size, run)
+
+    async def _put(self, output: asyncio.Queue, item: Any, stats: StageStats) -> None:
+        started: float = time.perf_counter()
+        await output.put(item)
+        stats.stalled_seconds += time.perf_counter() - started
+        stats.items_out += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, output.qsize())
+
+    def _wait(self, future: Future) -> Any:
+        # polls so that a thread blocked on a queue notices when another stage failed
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except TimeoutError:
+                if self._aborted.is_set():
+                    future.cancel()
+                    raise RuntimeError('Pipeline aborted')
+
+    async def _run_thread(
+        self, func: Callable[[Iterator], Iterable], input: asyncio.Queue | None, output: asyncio.Queue, stats: StageStats
+    ) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        def iter_input() -> Iterator:
+            while True:
+                started: float = time.perf_counter()
+                item: Any = self._wait(asyncio.run_coroutine_threadsafe(input.get(), loop))
+                stats.starved_seconds += time.perf_counter() - started
+                if item is _DONE:
+                    return
+                stats.items_in += 1
+                yield item
+
+        def run() -> None:
+            for item in func(iter_input() if input is not None else None):
+                self._wait(asyncio.run_coroutine_threadsafe(self._put(output, item, stats), loop))
+            self._wait(asyncio.run_coroutine_threadsafe(output.put(_DONE), loop))
+
+        # a dedicated thread rather than the default executor, which the stage functions may be using themselves
+        future: Future = Future()
+
+        def target() -> None:
+            # a running future can't be cancelled, the thread stops through _aborted instead
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                run()
+                future.set_result(None)
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, name=f'pipeline-{stats.name}', daemon=True).start()
+        await asyncio.wrap_future(future)
+
+    def _log_stats(self, queues: list[asyncio.Queue], started: float) -> None:
+        elapsed: float = max(time.perf_counter() - started, 1e-9)
+        for stats, queue in zip(self.stages, queues):
+            logger.info(stats.summary(elapsed, queue.qsize()))
+
+    async def arun(self, report_interval_seconds: float = 10.0) -> list[Any]:
+        """
+        Runs every stage until the source is exhausted and every item went through the last stage
+
+        :param report_interval_seconds: Interval between the stats being logged
+        :return: Output of the last stage
+        :raises RuntimeError: if any item was dropped by an async stage
+        """
+        queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=stats.queue_size) for stats in self.stages]
+        results: list[Any] = []
+        started: float = time.perf_counter()
+
+        async def collect() -> None:
+            while (item := await queues[-1].get()) is not _DONE:
+                results.append(item)
+
+        async def report() -> None:
+            while True:
+                await asyncio.sleep(report_interval_seconds)
+                self._log_stats(queues, started)
+
+        async def run_stage(i: int) -> None:
+            await self._runners[i](queues[i - 1] if i > 0 else None, queues[i], self.stages[i])
+            self.stages[i].finished_seconds = time.perf_counter() - started
+
+        tasks: list[asyncio.Task] = [asyncio.create_task(run_stage(i)) for i in range(len(self.stages))]
+        tasks.append(asyncio.create_task(collect()))
+        reporter: asyncio.Task = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self._aborted.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            reporter.cancel()
+            self._log_stats(queues, started)
+
+        if self._failures:
+            raise RuntimeError(f'{len(self._failures)} item(s) failed to go through the pipeline') from self._failures[0]
+        return results
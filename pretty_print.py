@@ -0,0 +1,45 @@
+from langchain_core.messages import convert_to_messages
+
+# START of code snippet for debugging copied from https://langchain-ai.github.io/langgraph/tutorials/multi_agent/agent_supervisor
+def pretty_print_message(message, indent=False):
+    pretty_message = message.pretty_repr(html=True)
+    if not indent:
+        print(pretty_message)
+        return
+
+    indented = "\n".join("\t" + c for c in pretty_message.split("\n"))
+    print(indented)
+
+def pretty_print_messages(update, last_message=False):
+    is_subgraph = False
+    if isinstance(update, tuple):
+        ns, update = update
+        # skip parent graph updates in the printouts
+        if len(ns) == 0:
+            return
+
+        graph_id = ns[-1].split(":")[0]
+        print(f"Update from subgraph {graph_id}:")
+        print("\n")
+        is_subgraph = True
+
+    for node_name, node_update in update.items():
+        update_label = f"Update from node {node_name}:"
+        if is_subgraph:
+            update_label = "\t" + update_label
+
+        print(update_label)
+        print("\n")
+
+        # this change is needed with Step 4 due to node_update being None after transfer back to supervisor
+        if node_update:
+            messages = convert_to_messages(node_update["messages"])
+            if last_message:
+                messages = messages[-1:]
+
+            for m in messages:
+                pretty_print_message(m, indent=is_subgraph)
+        else:
+            print("node_update was set to None due to delegation task")
+        print("\n")
+# END of code snippet for debugging
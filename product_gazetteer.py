@@ -0,0 +1,248 @@
+import itertools
+import json
+import logging
+import os
+import psycopg
+import re
+import time
+import unicodedata
+from collections import deque
+from psycopg import sql
+from typing import Iterable, Iterator
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Korean spellings of the words product names are made of, which are substituted for each word of a product to
+# generate its Korean and mixed aliases, e.g. "테슬라 모델 Y" and "테슬라 Model Y" for Tesla Model Y
+KOREAN_WORD_ALIASES: dict[str, list[str]] = {
+    'tesla': ['테슬라'],
+    'hyundai': ['현대', '현대차'],
+    'kia': ['기아', '기아차'],
+    'genesis': ['제네시스'],
+    'toyota': ['토요타', '도요타'],
+    'honda': ['혼다'],
+    'ford': ['포드'],
+    'volkswagen': ['폭스바겐'],
+    'bmw': ['비엠더블유'],
+    'mercedes': ['메르세데스', '벤츠'],
+    'model': ['모델'],
+    'ioniq': ['아이오닉'],
+    'cybertruck': ['사이버트럭'],
+    'mustang': ['머스탱'],
+}
+# brands that can be left out of an alias, e.g. "IONIQ 5" for Hyundai IONIQ 5, as long as no two products share the rest
+BRANDS: set[str] = {
+    'tesla', 'hyundai', 'kia', 'genesis', 'toyota', 'honda', 'ford', 'volkswagen', 'bmw', 'mercedes', 'mercedes-benz'
+}
+
+_TOKEN_PATTERN: re.Pattern = re.compile(r'[ᄀ-ᇿ㄰-㆏가-힣]+|[^\W\d_ᄀ-ᇿ㄰-㆏가-힣]+|\d+')
+
+def _is_hangul(char: str) -> bool:
+    return 'ᄀ' <= char <= 'ᇿ' or '㄰' <= char <= '㆏' or '가' <= char <= '힣'
+
+def _normalize(text: str) -> tuple[str, set[int]]:
+    normalized: str = ''
+    # positions of the spaces separating words that were written together, e.g. the one in "y 2" for "Y2"
+    joined: set[int] = set()
+    end: int = -1
+    for token in _TOKEN_PATTERN.finditer(unicodedata.normalize('NFKC', text).casefold()):
+        if normalized and not (_is_hangul(normalized[-1]) and _is_hangul(token[0][0])):
+            if token.start() == end and not _is_hangul(normalized[-1]) and not _is_hangul(token[0][0]):
+                joined.add(len(normalized))
+            normalized += ' '
+        normalized += token[0]
+        end = token.end()
+    return normalized, joined
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a question or a product name into the words the gazetteer matches on
+
+    The text is case folded and split into runs of Hangul, other letters and digits, so "IONIQ5", "Ioniq 5" and
+    "ioniq-5" all become "ioniq 5". Korean words are joined since their spacing varies, e.g. "테슬라 모델" and "테슬라모델",
+    and particles attach to them.
+
+    :param text: Question or product name
+    :return: Words separated by single spaces
+    """
+    return _normalize(text)[0]
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton that finds every occurrence of any number of patterns in a single pass over a text
+    """
+
+    def __init__(self, patterns: dict[str, str]):
+        """
+        :param patterns: Value reported for each pattern, where patterns are matched as they are
+        """
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # length of each pattern ending at the state along with its value
+        self._output: list[list[tuple[int, str]]] = [[]]
+        for pattern, value in patterns.items():
+            state: int = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append((len(pattern), value))
+        queue: deque[int] = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail: int = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find_all(self, text: str) -> Iterator[tuple[int, int, str]]:
+        """
+        :param text: Text to search
+        :return: Start, end and value of every occurrence of a pattern, including overlapping ones
+        """
+        state: int = 0
+        for i, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for length, value in self._output[state]:
+                yield i + 1 - length, i + 1, value
+
+def product_aliases(product: str, aliases: Iterable[str] = ()) -> set[str]:
+    """
+    Generates the normalized aliases of a product
+
+    :param product: Name of the product, e.g. Hyundai IONIQ 5
+    :param aliases: Further names of the product, e.g. 아이오닉5
+    :return: Normalized name and aliases along with the variants with their words spelled in Korean
+    """
+    names: set[str] = {normalize_text(product), *(normalize_text(alias) for alias in aliases)}
+    # the model written without separators as well, e.g. "Honda CRV" for Honda CR-V
+    for name in list(names):
+        brand, _, model = name.partition(' ')
+        names.add(normalize_text(f'{brand} {model.replace(" ", "")}'))
+    variants: set[str] = set()
+    for name in names:
+        words: list[str] = name.split(' ')
+        for spelling in itertools.product(*([word, *KOREAN_WORD_ALIASES.get(word, [])] for word in words)):
+            variants.add(normalize_text(' '.join(spelling)))
+    return {variant for variant in variants if variant}
+
+class ProductMatcher:
+    """
+    Finds the known products mentioned in a question without asking the LLM
+
+    Every product is matched by its name and aliases, their Korean spellings and, where it's unambiguous, without the
+    brand, e.g. "Cybertruck" or "사이버트럭" for Tesla Cybertruck.
+    """
+
+    def __init__(self, products: dict[str, list[str]]):
+        """
+        :param products: Aliases of each product by the name the product is reported as
+        """
+        patterns: dict[str, str] = {
+            alias: product for product, aliases in products.items() for alias in product_aliases(product, aliases)
+        }
+        self._automaton: AhoCorasick = AhoCorasick(self._with_brandless_aliases(patterns))
+        logger.info(f'Built product matcher of {len(products)} products')
+
+    @staticmethod
+    def _with_brandless_aliases(patterns: dict[str, str]) -> dict[str, str]:
+        # longest first so that e.g. 현대차 is stripped rather than 현대
+        brand_spellings: list[str] = sorted({
+            normalize_text(spelling) for brand in BRANDS for spelling in [brand, *KOREAN_WORD_ALIASES.get(brand, [])]
+        }, key=len, reverse=True)
+        brandless: dict[str, set[str]] = {}
+        for alias, product in patterns.items():
+            for brand in brand_spellings:
+                rest: str | None = None
+                if alias.startswith(brand + ' '):
+                    rest = alias[len(brand) + 1:]
+                elif _is_hangul(brand[0]) and alias.startswith(brand) and len(alias) > len(brand):
+                    rest = alias[len(brand):].lstrip(' ')
+                if rest is not None:
+                    if ' ' in rest or len(rest) >= 4:
+                        brandless.setdefault(rest, set()).add(product)
+                    break
+        return {
+            **{alias: next(iter(products)) for alias, products in brandless.items() if len(products) == 1},
+            **patterns,
+        }
+
+    def match(self, question: str) -> list[str]:
+        """
+        :param question: Question to look for products in
+        :return: Products mentioned in the question in the order they are first mentioned, where overlapping mentions
+            are resolved in favor of the leftmost longest one
+        """
+        text, joined = _normalize(question)
+
+        def at_boundary(start: int, end: int) -> bool:
+            # Korean words are matched anywhere within a word since particles attach to them, while other words have to
+            # match whole words, where letters and digits written together count as one word, e.g. "Model Y2" doesn't
+            # mention Model Y
+            return (start == 0 or text[start - 1] == ' ' and start - 1 not in joined or _is_hangul(text[start])) \
+                and (end == len(text) or text[end] == ' ' and end not in joined or _is_hangul(text[end - 1]))
+
+        matches: list[tuple[int, int, str]] = sorted(
+            (match for match in self._automaton.find_all(text) if at_boundary(match[0], match[1])),
+            key=lambda match: (match[0], match[0] - match[1])
+        )
+        products: list[str] = []
+        covered: int = 0
+        for start, end, product in matches:
+            if start < covered:
+                continue
+            covered = end
+            if product not in products:
+                products.append(product)
+        return products
+
+def load_products(path: str) -> dict[str, list[str]]:
+    """
+    :param path: Path to a JSON object of the aliases of each product, e.g. written by write_products
+    :return: Aliases of each product, empty if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def write_products(path: str, products: dict[str, list[str]]) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(products, file, ensure_ascii=False, indent=2)
+
+def seed_products(conninfo: str, table_name: str, field: str = 'vehicle', content_column: str = 'content') -> list[str]:
+    """
+    Collects the product names of the ingested documents
+
+    The chunks are JSON but not necessarily valid JSON on their own, so the names are picked out of the content as the
+    string values of the field and decoded as JSON strings, since the content escapes every non-ASCII character, e.g.
+    "\\ud604\\ub300" for 현대.
+
+    :param conninfo: psycopg connection string
+    :param table_name: Vector store table
+    :param field: Key the product name is stored under in the documents
+    :param content_column: Column the content of the documents is stored in
+    :return: Distinct product names
+    """
+    started: float = time.perf_counter()
+    with psycopg.connect(conninfo) as conn:
+        rows = conn.execute(sql.SQL(
+            'SELECT DISTINCT substring({} from {}) FROM {}'
+        ).format(
+            sql.Identifier(content_column),
+            sql.Literal(f'"{re.escape(field)}"\\s*:\\s*"((?:[^"\\\\]|\\\\.)+)"'),
+            sql.Identifier(table_name)
+        )).fetchall()
+    # distinct spellings of a name may decode to the same name, e.g. "\u00e9" and "é"
+    products: list[str] = sorted({json.loads(f'"{row[0]}"') for row in rows if row[0]})
+    logger.info(f'Found {len(products)} products in {table_name} in {time.perf_counter() - started:.1f}s')
+    return products
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompt_values import PromptValue
+from langgraph.graph.state import CompiledStateGraph
+from typing import Any
+from s3_utils import MultipartUpload
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+async def astream_to_s3(
+    model: BaseChatModel,
+    messages: PromptValue,
+    s3_client: Any,
+    bucket: str,
+    key: str,
+    executor: Executor | None = None,
+    content_type: str = 'text/plain',
+) -> str:
+    """
+    Streams the response of a chat model into an S3 object as the tokens are generated
+
+    When called from a graph node, the tokens are streamed to the caller of graph.astream(..., stream_mode='messages')
+    at the same time, see astream_answer.
+
+    :param model: Chat model to generate the response with
+    :param messages: Prompt of the model
+    :param s3_client: boto3 S3 client
+    :param bucket: Bucket to upload to
+    :param key: Key of the object
+    :param executor: Executor the blocking S3 calls run on, the default executor of the loop if None
+    :param content_type: Content type of the object
+    :return: Complete response
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    upload: MultipartUpload = MultipartUpload(s3_client, bucket, key, content_type=content_type)
+    # the upload is started while the model evaluates the prompt so only the last part is left once it's done
+    started: asyncio.Future = loop.run_in_executor(executor, upload.start)
+    parts: list[str] = []
+    first_token: float | None = None
+    began: float = time.perf_counter()
+    try:
+        async for chunk in model.astream(messages):
+            if first_token is None:
+                first_token = time.perf_counter()
+            parts.append(chunk.content)
+            upload.write(chunk.content)
+            if upload.pending_bytes >= upload.part_size:
+                await started
+                await loop.run_in_executor(executor, upload.upload_parts)
+        await started
+        await loop.run_in_executor(executor, upload.complete)
+    except BaseException:
+        try:
+            await started
+            await loop.run_in_executor(executor, upload.abort)
+        except Exception as e:
+            logger.warning(f'Failed to abort the upload of s3://{bucket}/{key}: {e!r}')
+        raise
+    logger.info(
+        f'Streamed response to s3://{bucket}/{key} with the first token after {(first_token or began) - began:.2f}s '
+        f'and the upload completed after {time.perf_counter() - began:.2f}s'
+    )
+    return ''.join(parts)
+
+async def astream_answer(graph: CompiledStateGraph, input: dict[str, Any], token_nodes: set[str]) -> dict[str, Any]:
+    """
+    Runs a graph, printing the tokens generated by the models of the given nodes as they are generated
+
+    :param graph: Graph to run
+    :param input: Input of the graph, e.g. the question
+    :param token_nodes: Nodes whose tokens are printed, which shouldn't run in parallel with each other for the tokens
+        not to interleave
+    :return: Final state of the graph
+    """
+    state: dict[str, Any] = {}
+    async for mode, chunk in graph.astream(input, stream_mode=['messages', 'values']):
+        if mode == 'messages':
+            message, metadata = chunk
+            if metadata.get('langgraph_node') in token_nodes and isinstance(message.content, str):
+                print(message.content, end='', flush=True)
+        else:
+            state = chunk
+    print()
+    return state
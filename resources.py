@@ -0,0 +1,235 @@
+import asyncio
+import boto3
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_ollama import ChatOllama
+from langchain_postgres import PGEngine, PGVectorStore
+from langchain_postgres.v2.hybrid_search_config import HybridSearchConfig
+from langchain_postgres.v2.indexes import HNSWQueryOptions, QueryOptions
+from langchain_tavily import TavilySearch
+from tavily import AsyncTavilyClient
+from typing import Any, Callable, ParamSpec, TypeVar
+from embedding_cache import cached_embeddings
+from hybrid_search import METADATA_COLUMNS, hybrid_search_config
+from ingestion import get_ingest_generation
+from llm_cache import SQLiteLLMCache, model_fingerprint, normalize_prompt
+from ollama_pool import OllamaPool, PooledChatOllama, PooledOllamaEmbeddings
+from product_gazetteer import ProductMatcher, load_products
+from search_cache import SemanticSearchCache
+from web_search_cache import CachedTavilyClient, CachedTavilySearchAPIWrapper, WebSearchCache
+
+# Configuration and clients shared by the agents, where every client is created on first use rather than on import and
+# then reused for as long as the process lives, e.g. across invocations of a runtime container. The hosts and
+# credentials can be overridden with environment variables of the same name.
+
+POSTGRES_USER: str = os.environ.get('POSTGRES_USER', 'langchain')
+POSTGRES_PASSWORD: str = os.environ.get('POSTGRES_PASSWORD', 'langchain')
+POSTGRES_HOST: str = os.environ.get('POSTGRES_HOST', 'localhost')
+POSTGRES_PORT: str = os.environ.get('POSTGRES_PORT', '5432')
+POSTGRES_DB: str = os.environ.get('POSTGRES_DB', 'langchain')
+TABLE_NAME: str = 'vectorstore'
+CONNECTION_STRING: str = f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}'
+# the ingest generation is read through psycopg directly since PGEngine doesn't expose arbitrary queries
+PSYCOPG_CONNECTION_STRING: str = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}'
+OLLAMA_MODEL_ID: str = os.environ.get('OLLAMA_MODEL_ID', 'llama3.2:3b')
+OLLAMA_BASE_URL: str = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+# how long Ollama keeps the model loaded after a request in seconds (or -1 for as long as it runs, in seconds since
+# OllamaEmbeddings takes no durations like '30m') so it isn't unloaded between questions, and the context window, which
+# has to be the same for the chat model and the embeddings since Ollama reloads the model whenever it changes and then
+# loses the prompt prefix it has cached
+OLLAMA_KEEP_ALIVE: int = int(os.environ.get('OLLAMA_KEEP_ALIVE', '1800'))
+OLLAMA_NUM_CTX: int = int(os.environ.get('OLLAMA_NUM_CTX', '8192'))
+# comma separated Ollama endpoints serving the model, which the requests are spread over by the fewest in flight (see
+# OllamaPool), where the chat models and the embeddings get separate pools so that embedding the queries doesn't wait
+# for generation, each capped at the requests the endpoints process in parallel, i.e., their OLLAMA_NUM_PARALLEL
+OLLAMA_CHAT_BASE_URLS: list[str] = os.environ.get('OLLAMA_CHAT_BASE_URLS', OLLAMA_BASE_URL).split(',')
+OLLAMA_EMBEDDING_BASE_URLS: list[str] = os.environ.get('OLLAMA_EMBEDDING_BASE_URLS', OLLAMA_BASE_URL).split(',')
+OLLAMA_CHAT_MAX_CONCURRENCY: int = int(os.environ.get('OLLAMA_CHAT_MAX_CONCURRENCY', '4'))
+OLLAMA_EMBEDDING_MAX_CONCURRENCY: int = int(os.environ.get('OLLAMA_EMBEDDING_MAX_CONCURRENCY', '4'))
+EMBEDDING_CACHE_PATH: str = 'temp/embedding_cache.sqlite'
+# responses of the extraction model are cached by the prompt (ignoring casing and whitespace) and the model parameters
+# so a question that was asked before skips the model altogether, where the model is run greedily for the extraction
+# to be deterministic and therefore safe to cache
+LLM_CACHE_PATH: str = 'temp/llm_cache.sqlite'
+LLM_CACHE_MAX_BYTES: int = 256 * 1024 ** 2
+# known products are matched in the question before falling back to the LLM to extract them, which are the products the
+# document loader found in the vector store (see seed_products) along with PRODUCTS, i.e., the aliases of each product
+PRODUCT_GAZETTEER_PATH: str = 'temp/product_gazetteer.json'
+PRODUCTS: dict[str, list[str]] = {
+    'Tesla Cybertruck': [],
+    'Tesla Model Y': [],
+    'Tesla Model 3': [],
+    'Hyundai IONIQ 5': [],
+    'Kia EV6': [],
+}
+# must match the VECTOR_INDEX of the document loader, i.e., IVFFlatQueryOptions(probes=...) for an IVFFlat index, where
+# a higher ef_search (or probes) trades search latency for recall, which can be overridden per search with the
+# index_query_options of asimilarity_search_many
+VECTOR_INDEX_QUERY_OPTIONS: QueryOptions = HNSWQueryOptions(ef_search=40)
+# results of similarity searches are cached by query embedding, where a query is served from the cache when its
+# embedding is at least SEARCH_CACHE_SIMILARITY_THRESHOLD similar to a previous query, until the TTL expires or the
+# document loader bumps the ingest generation of the table
+SEARCH_CACHE_PATH: str = 'temp/search_cache.sqlite'
+SEARCH_CACHE_SIMILARITY_THRESHOLD: float = 0.97
+SEARCH_CACHE_TTL_SECONDS: float = 24 * 60 * 60
+GENERATION_TABLE_NAME: str = 'vectorstore_generation'
+# vector search fused with a full-text search by reciprocal rank fusion so exact model names and trims like Cybertruck
+# or IONIQ 5, which the embeddings of a 3B model represent poorly, are still found, see hybrid_search_config
+HYBRID_SEARCH: bool = True
+HYBRID_SEARCH_CANDIDATES: int = 20
+S3_BUCKET: str = 'analysis'
+S3_ACCESS_KEY: str = os.environ.get('S3_ACCESS_KEY', 'admin')
+S3_SECRET_KEY: str = os.environ.get('S3_SECRET_KEY', 'password')
+MINIO_ENDPOINT: str = os.environ.get('MINIO_ENDPOINT', 'http://localhost:9000')
+TAVILY_API_KEY: str = os.environ.get('TAVILY_API_KEY')
+TAVILY_MAX_RESULTS: int = 3
+# web searches are cached by normalized query and parameters, where TAVILY_OFFLINE=true replays the cached searches
+# regardless of their age instead of calling Tavily, e.g. to run the agents without network access
+TAVILY_CACHE_PATH: str = 'temp/tavily_cache.sqlite'
+TAVILY_CACHE_TTL_SECONDS: float = 7 * 24 * 60 * 60
+TAVILY_OFFLINE: bool = os.environ.get('TAVILY_OFFLINE', 'false').lower() == 'true'
+# maximum number of calls to blocking SDKs (e.g. boto3) in flight across every graph running on the event loop
+BLOCKING_MAX_WORKERS: int = 32
+
+logger: logging.Logger = logging.getLogger(__name__)
+T = TypeVar('T')
+P = ParamSpec('P')
+
+def lazy(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Turns a factory into a getter that creates the resource on first use and returns the same instance afterwards
+
+    The getter can be called from several threads at once, e.g. by the parallel branches of a graph, in which case the
+    resource is still only created once.
+    """
+    lock: threading.Lock = threading.Lock()
+    instance: list[T] = []
+
+    @functools.wraps(factory)
+    def get() -> T:
+        if not instance:
+            with lock:
+                if not instance:
+                    started: float = time.perf_counter()
+                    instance.append(factory())
+                    logger.info(f'Initialized {factory.__name__.removeprefix("get_")} in {time.perf_counter() - started:.2f}s')
+        return instance[0]
+    return get
+
+@lazy
+def get_pg_engine() -> PGEngine:
+    # the engine pools its connections, so every agent of the process shares the same pool
+    return PGEngine.from_connection_string(url=CONNECTION_STRING)
+
+@lazy
+def get_chat_pool() -> OllamaPool:
+    return OllamaPool(OLLAMA_CHAT_BASE_URLS, max_concurrency=OLLAMA_CHAT_MAX_CONCURRENCY)
+
+@lazy
+def get_embedding_pool() -> OllamaPool:
+    return OllamaPool(OLLAMA_EMBEDDING_BASE_URLS, max_concurrency=OLLAMA_EMBEDDING_MAX_CONCURRENCY)
+
+@lazy
+def get_embeddings() -> Embeddings:
+    return cached_embeddings(
+        PooledOllamaEmbeddings(
+            pool=get_embedding_pool(), model=OLLAMA_MODEL_ID, keep_alive=OLLAMA_KEEP_ALIVE, num_ctx=OLLAMA_NUM_CTX
+        ),
+        OLLAMA_MODEL_ID,
+        EMBEDDING_CACHE_PATH
+    )
+
+@lazy
+def get_vector_store() -> PGVectorStore:
+    return PGVectorStore.create_sync(
+        engine=get_pg_engine(),
+        table_name=TABLE_NAME,
+        embedding_service=get_embeddings(),
+        metadata_columns=list(METADATA_COLUMNS),
+        index_query_options=VECTOR_INDEX_QUERY_OPTIONS
+    )
+
+@lazy
+def get_search_cache() -> SemanticSearchCache:
+    return SemanticSearchCache(
+        SEARCH_CACHE_PATH,
+        lambda: get_ingest_generation(PSYCOPG_CONNECTION_STRING, GENERATION_TABLE_NAME, TABLE_NAME),
+        similarity_threshold=SEARCH_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds=SEARCH_CACHE_TTL_SECONDS
+    )
+
+def get_search_config() -> HybridSearchConfig | None:
+    return _get_hybrid_search_config() if HYBRID_SEARCH else None
+
+@lazy
+def _get_hybrid_search_config() -> HybridSearchConfig:
+    return hybrid_search_config(HYBRID_SEARCH_CANDIDATES)
+
+@lazy
+def get_chat_model() -> BaseChatModel:
+    return PooledChatOllama(
+        pool=get_chat_pool(), model=OLLAMA_MODEL_ID, keep_alive=OLLAMA_KEEP_ALIVE, num_ctx=OLLAMA_NUM_CTX
+    )
+
+@lazy
+def get_extract_model() -> BaseChatModel:
+    model: ChatOllama = PooledChatOllama(
+        pool=get_chat_pool(), model=OLLAMA_MODEL_ID, keep_alive=OLLAMA_KEEP_ALIVE, num_ctx=OLLAMA_NUM_CTX, temperature=0
+    )
+    model.cache = SQLiteLLMCache(
+        LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, normalize=normalize_prompt, namespace=model_fingerprint(model)
+    )
+    return model
+
+@lazy
+def get_product_matcher() -> ProductMatcher:
+    products: dict[str, list[str]] = load_products(PRODUCT_GAZETTEER_PATH)
+    for product, aliases in PRODUCTS.items():
+        products[product] = [*products.get(product, []), *aliases]
+    return ProductMatcher(products)
+
+@lazy
+def get_s3_client() -> Any:
+    return boto3.client(
+        's3',
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+        endpoint_url=MINIO_ENDPOINT
+    )
+
+@lazy
+def get_web_search_cache() -> WebSearchCache:
+    return WebSearchCache(TAVILY_CACHE_PATH, ttl_seconds=TAVILY_CACHE_TTL_SECONDS)
+
+@lazy
+def get_tavily_search() -> TavilySearch:
+    # the API key is only checked for being set, so any value will do when offline
+    api_wrapper: CachedTavilySearchAPIWrapper = CachedTavilySearchAPIWrapper(
+        tavily_api_key=TAVILY_API_KEY or 'offline', cache=get_web_search_cache(), offline=TAVILY_OFFLINE
+    )
+    return TavilySearch(api_wrapper=api_wrapper, max_results=TAVILY_MAX_RESULTS)
+
+@lazy
+def get_async_tavily_client() -> CachedTavilyClient:
+    return CachedTavilyClient(
+        None if TAVILY_OFFLINE else AsyncTavilyClient(TAVILY_API_KEY), get_web_search_cache(), offline=TAVILY_OFFLINE
+    )
+
+@lazy
+def get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=BLOCKING_MAX_WORKERS, thread_name_prefix='blocking')
+
+async def run_blocking(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    """
+    Runs a blocking call on the bounded executor so it doesn't stall the event loop
+
+    :param func: Blocking function, e.g. s3_client.put_object
+    :return: Result of func
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
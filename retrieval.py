@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import numpy as np
+import time
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_postgres.v2.hybrid_search_config import HybridSearchConfig
+from langchain_postgres.v2.indexes import QueryOptions
+from typing import Any, Callable, Iterable
+from search_cache import SemanticSearchCache
+from vector_index import with_index_query_options
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+async def asimilarity_search_many(
+    vector_store: VectorStore,
+    queries: list[str],
+    k: int = 4,
+    filter: dict[str, Any] | None = None,
+    cache: SemanticSearchCache | None = None,
+    hybrid_search_config: HybridSearchConfig | None = None,
+    fts_query: str | None = None,
+    index_query_options: QueryOptions | None = None,
+) -> dict[str, list[Document]]:
+    """
+    Searches the vector store for several queries at once
+
+    The queries are embedded in a single request rather than one round trip each, after which the searches run
+    concurrently.
+
+    :param vector_store: Vector store to search, e.g. PGVectorStore
+    :param queries: Queries to search for
+    :param k: Number of documents to return per query
+    :param filter: Metadata filter applied to every search, which PGVectorStore can only apply to metadata columns
+    :param cache: Serves the queries similar enough to a previous one without searching the vector store if set
+    :param hybrid_search_config: Fuses every search with a full-text search if set along with fts_query, only supported
+        by PGVectorStore, see hybrid_search.hybrid_search_config
+    :param fts_query: Full-text query of the hybrid searches, where every word has to match, e.g. just the vehicle
+        name, without which only the vector search is run since a whole query would hardly ever match
+    :param index_query_options: Overrides the index query options of the vector store for these searches, e.g.
+        HNSWQueryOptions(ef_search=100) to trade latency for recall, only supported by PGVectorStore
+    :return: Documents found for each query, in the order of the queries
+    """
+    started: float = time.perf_counter()
+    query_embeddings: list[list[float]] = await vector_store.embeddings.aembed_documents(queries)
+    embedded: float = time.perf_counter()
+    # every word of the full-text query has to match, so a whole query would hardly ever match anything and only make
+    # the cache key unique to its exact text
+    if not fts_query or hybrid_search_config is None:
+        hybrid_search_config, fts_query = None, None
+    if index_query_options is not None:
+        vector_store = with_index_query_options(vector_store, index_query_options)
+    # searches with other index query options may find other documents so they're cached apart
+    query_options: list[str] | None = index_query_options.to_parameter() if index_query_options is not None else None
+    results: list[list[Document] | None] = [None] * len(queries)
+    if cache is not None:
+        results = await asyncio.to_thread(lambda: [
+            cache.get(query_embedding, k, filter, fts_query=fts_query, index_query_options=query_options)
+            for query_embedding in query_embeddings
+        ])
+
+    async def search(i: int) -> list[Document]:
+        if hybrid_search_config is None:
+            return await vector_store.asimilarity_search_by_vector(query_embeddings[i], k=k, filter=filter)
+        # the vector search is limited to the same number of candidates as the full-text search so both contribute to
+        # the fusion, of which the top k are kept
+        documents: list[Document] = await vector_store.asimilarity_search_by_vector(
+            query_embeddings[i],
+            k=max(k, hybrid_search_config.primary_top_k),
+            filter=filter,
+            hybrid_search_config=hybrid_search_config,
+            fts_query=fts_query
+        )
+        return documents[:k]
+
+    misses: list[int] = [i for i, result in enumerate(results) if result is None]
+    searched: list[list[Document]] = await asyncio.gather(*(search(i) for i in misses))
+    for i, documents in zip(misses, searched):
+        results[i] = documents
+        if cache is not None:
+            await asyncio.to_thread(
+                cache.put, query_embeddings[i], k, filter, documents, fts_query=fts_query, index_query_options=query_options
+            )
+    logger.info(
+        f'Searched {len(queries)} queries in {time.perf_counter() - started:.2f}s '
+        f'(embedding {embedded - started:.2f}s, searches {time.perf_counter() - embedded:.2f}s, '
+        f'{len(queries) - len(misses)} served from cache)'
+    )
+    return dict(zip(queries, results))
+
+def document_key(document: Document) -> str:
+    # the id is the chunk id in the vector store, otherwise the chunk is identified by its position in its source
+    if document.id is not None:
+        return document.id
+    if 'source' in document.metadata and 'document_chunk_seq_num' in document.metadata:
+        return f"{document.metadata['source']}#{document.metadata['document_chunk_seq_num']}"
+    return document.page_content
+
+def dedupe_documents(documents: Iterable[Document]) -> list[Document]:
+    """
+    Removes the documents that were already returned for another query, keeping the first occurrence
+
+    :param documents: Documents retrieved for one or more queries
+    :return: Unique documents in the order they were first seen
+    """
+    unique: dict[str, Document] = {}
+    for document in documents:
+        unique.setdefault(document_key(document), document)
+    return list(unique.values())
+
+def maximal_marginal_relevance(
+    query_embeddings: list[list[float]], document_embeddings: list[list[float]], k: int, lambda_mult: float = 0.5
+) -> list[int]:
+    """
+    Selects the documents that are relevant to any of the queries while being least similar to each other
+
+    :param query_embeddings: Embedding of every query, the relevance of a document is its similarity to the closest
+    :param document_embeddings: Embedding of every candidate document
+    :param k: Number of documents to select
+    :param lambda_mult: Trade-off between relevance (1) and diversity (0)
+    :return: Indices of the selected documents, from most to least relevant
+    """
+    if not document_embeddings:
+        return []
+
+    def normalize(vectors: list[list[float]]) -> np.ndarray:
+        matrix: np.ndarray = np.asarray(vectors, dtype=np.float32)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    documents: np.ndarray = normalize(document_embeddings)
+    relevance: np.ndarray = (documents @ normalize(query_embeddings).T).max(axis=1)
+    similarity: np.ndarray = documents @ documents.T
+    selected: list[int] = [int(relevance.argmax())]
+    while len(selected) < min(k, len(documents)):
+        redundancy: np.ndarray = similarity[:, selected].max(axis=1)
+        scores: np.ndarray = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(scores.argmax()))
+    return selected
+
+def format_document(document: Document) -> str:
+    content: str = document.page_content
+    try:
+        # the chunks are JSON with non-ASCII characters escaped, e.g. Korean, which takes several times the tokens
+        content = json.dumps(json.loads(content), ensure_ascii=False, separators=(',', ':'))
+    except ValueError:
+        pass
+    return f"[{document.metadata.get('source', 'unknown')}#{document.metadata.get('document_chunk_seq_num', '?')}]\n{content}"
+
+def pack_documents(
+    documents: list[Document], token_budget: int, length_function: Callable[[str], int] = lambda text: len(text) // 4
+) -> tuple[list[Document], str]:
+    """
+    Packs as many documents as fit into a token budget in a compact plain text format
+
+    :param documents: Documents from most to least important, a document that doesn't fit is skipped in favor of the
+        following ones
+    :param token_budget: Maximum number of tokens of the packed context
+    :param length_function: Counts the tokens of a text, estimated as 4 characters per token by default
+    :return: Documents that were packed along with the packed context
+    """
+    packed: list[Document] = []
+    parts: list[str] = []
+    tokens: int = 0
+    for document in documents:
+        part: str = format_document(document)
+        part_tokens: int = length_function(part) + 1
+        if tokens + part_tokens > token_budget:
+            continue
+        packed.append(document)
+        parts.append(part)
+        tokens += part_tokens
+    logger.info(f'Packed {len(packed)} of {len(documents)} documents into {tokens} of {token_budget} tokens')
+    return packed, '\n\n'.join(parts)
+
+async def aassemble_context(
+    vector_store: VectorStore,
+    documents_by_query: dict[str, list[Document]],
+    k: int = 8,
+    lambda_mult: float = 0.5,
+    token_budget: int = 3000,
+    length_function: Callable[[str], int] = lambda text: len(text) // 4,
+) -> tuple[list[Document], str]:
+    """
+    Turns the documents retrieved for several queries into a deduplicated, diversified and compact context
+
+    The embeddings of the queries and documents come from the vector store's embedding model, which only hits Ollama
+    when they aren't in the embedding cache yet (see cached_embeddings).
+
+    :param vector_store: Vector store the documents were retrieved from
+    :param documents_by_query: Documents retrieved for each query, e.g. from asimilarity_search_many
+    :param k: Maximum number of documents selected with maximal marginal relevance
+    :param lambda_mult: Trade-off between relevance (1) and diversity (0)
+    :param token_budget: Maximum number of tokens of the context
+    :param length_function: Counts the tokens of a text, estimated as 4 characters per token by default
+    :return: Documents in the context along with the context
+    """
+    documents: list[Document] = dedupe_documents(document for docs in documents_by_query.values() for document in docs)
+    query_embeddings, document_embeddings = await asyncio.gather(
+        vector_store.embeddings.aembed_documents(list(documents_by_query)),
+        vector_store.embeddings.aembed_documents([document.page_content for document in documents]),
+    )
+    selected: list[int] = maximal_marginal_relevance(query_embeddings, document_embeddings, k, lambda_mult)
+    return pack_documents([documents[i] for i in selected], token_budget, length_function)
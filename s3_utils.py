@@ -0,0 +1,182 @@
+import fnmatch
+import logging
+from collections import deque
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Iterable, Iterator
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class S3Object:
+    key: str
+    size: int
+    last_modified: datetime
+    etag: str
+
+def list_objects(
+    s3_client: Any,
+    bucket: str,
+    prefix: str = '',
+    pattern: str = '*',
+    modified_after: datetime | None = None,
+) -> Iterator[S3Object]:
+    """
+    Lists the objects under a prefix page by page, in key order
+
+    :param s3_client: boto3 S3 client
+    :param bucket: Bucket to list
+    :param prefix: Only list the keys starting with this prefix
+    :param pattern: Only list the keys (excluding the prefix) matching this fnmatch pattern, e.g. "output-*.json"
+    :param modified_after: Only list the objects modified after this timezone-aware time
+    :return: Iterator over the matching objects
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get('Contents', []):
+            if not fnmatch.fnmatch(content['Key'][len(prefix):], pattern):
+                continue
+            if modified_after is not None and content['LastModified'] <= modified_after:
+                continue
+            yield S3Object(content['Key'], content['Size'], content['LastModified'], content['ETag'])
+
+def _get_object(s3_client: Any, bucket: str, obj: S3Object) -> bytes:
+    return s3_client.get_object(Bucket=bucket, Key=obj.key, IfMatch=obj.etag)['Body'].read()
+
+def _get_object_range(s3_client: Any, bucket: str, obj: S3Object, start: int, end: int) -> bytes:
+    # IfMatch guarantees every range comes from the same version of the object
+    return s3_client.get_object(Bucket=bucket, Key=obj.key, IfMatch=obj.etag, Range=f'bytes={start}-{end}')['Body'].read()
+
+def _iter_object_ranges(
+    s3_client: Any, bucket: str, obj: S3Object, executor: Executor, part_size: int, parts_in_flight: int
+) -> Iterator[bytes]:
+    pending: deque[Future] = deque()
+    for start in range(0, obj.size, part_size):
+        pending.append(executor.submit(_get_object_range, s3_client, bucket, obj, start, min(start + part_size, obj.size) - 1))
+        if len(pending) >= parts_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def iter_objects(
+    s3_client: Any,
+    bucket: str,
+    objects: Iterable[S3Object],
+    executor: Executor,
+    lookahead: int = 8,
+    range_threshold: int = 16 * 1024 * 1024,
+    part_size: int = 8 * 1024 * 1024,
+    max_buffer_bytes: int = 64 * 1024 * 1024,
+) -> Iterator[tuple[S3Object, Iterator[bytes]]]:
+    """
+    Fetches objects in parallel through an executor while handing them to the caller in order
+
+    Objects smaller than range_threshold are fetched whole, up to lookahead objects and max_buffer_bytes ahead of the
+    one being consumed. Larger objects are fetched as parallel ranged GETs of part_size bytes, up to lookahead parts
+    and max_buffer_bytes ahead, so memory is bounded by roughly max_buffer_bytes plus the object (or part) being
+    consumed regardless of object size. The caller has to consume the chunks of an object before moving on to the
+    next one.
+
+    :param s3_client: boto3 S3 client, which is thread safe and should have a connection pool at least as large as the
+        executor
+    :param bucket: Bucket the objects are in
+    :param objects: Objects to fetch, e.g. from list_objects
+    :param executor: Executor the GETs are submitted to
+    :param lookahead: Number of objects (or parts of a large object) fetched ahead of the consumer
+    :param range_threshold: Size from which an object is fetched with ranged GETs
+    :param part_size: Size of each ranged GET
+    :param max_buffer_bytes: Number of bytes fetched ahead of the consumer, exceeded by a single object or part that's
+        larger on its own
+    :return: Iterator over each object along with an iterator over its content
+    """
+    pending: deque[tuple[S3Object, Future | None]] = deque()
+    pending_bytes: int = 0
+    parts_in_flight: int = max(1, min(lookahead, max_buffer_bytes // part_size))
+
+    def emit(obj: S3Object, future: Future | None) -> tuple[S3Object, Iterator[bytes]]:
+        nonlocal pending_bytes
+        if future is None:
+            logger.info(f'Fetching s3://{bucket}/{obj.key} ({obj.size} bytes) in ranges of {part_size} bytes')
+            return obj, _iter_object_ranges(s3_client, bucket, obj, executor, part_size, parts_in_flight)
+        pending_bytes -= obj.size
+        logger.info(f'Fetched s3://{bucket}/{obj.key} ({obj.size} bytes)')
+        return obj, iter([future.result()])
+
+    for obj in objects:
+        # large objects are only fetched once they're consumed so they don't take up any of the buffer until then
+        ranged: bool = obj.size >= range_threshold
+        size: int = 0 if ranged else obj.size
+        while pending and (len(pending) >= lookahead or pending_bytes + size > max_buffer_bytes):
+            yield emit(*pending.popleft())
+        pending.append((obj, None if ranged else executor.submit(_get_object, s3_client, bucket, obj)))
+        pending_bytes += size
+    while pending:
+        yield emit(*pending.popleft())
+
+class MultipartUpload:
+    """
+    Uploads an object as it's being written through a multipart upload
+
+    Written data is buffered until a part of part_size bytes is complete, since S3 requires every part but the last to
+    be at least 5 MiB, so an object smaller than part_size is uploaded as a single part once the upload is completed.
+    None of the methods but write buffer, so all the others are meant to run on an executor from async code.
+    """
+
+    def __init__(
+        self, s3_client: Any, bucket: str, key: str, content_type: str = 'text/plain', part_size: int = 8 * 1024 * 1024
+    ):
+        """
+        :param s3_client: boto3 S3 client
+        :param bucket: Bucket to upload to
+        :param key: Key of the object
+        :param content_type: Content type of the object
+        :param part_size: Size of each part but the last, at least 5 MiB
+        """
+        self.s3_client: Any = s3_client
+        self.bucket: str = bucket
+        self.key: str = key
+        self.content_type: str = content_type
+        self.part_size: int = max(part_size, 5 * 1024 * 1024)
+        self.upload_id: str | None = None
+        self._buffer: bytearray = bytearray()
+        self._parts: list[dict[str, Any]] = []
+
+    @property
+    def pending_bytes(self) -> int:
+        return len(self._buffer)
+
+    def start(self) -> None:
+        self.upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+        )['UploadId']
+
+    def write(self, data: str | bytes) -> None:
+        self._buffer += data.encode('utf-8') if isinstance(data, str) else data
+
+    def _upload_part(self, body: bytes) -> None:
+        part_number: int = len(self._parts) + 1
+        etag: str = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )['ETag']
+        self._parts.append({'ETag': etag, 'PartNumber': part_number})
+
+    def upload_parts(self) -> None:
+        # only complete parts are uploaded, the rest stays buffered for the next part or the last one
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+    def complete(self) -> None:
+        self.upload_parts()
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self._parts}
+        )
+        logger.info(f'Uploaded s3://{self.bucket}/{self.key} in {len(self._parts)} parts')
+
+    def abort(self) -> None:
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
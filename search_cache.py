@@ -0,0 +1,200 @@
+import json
+import logging
+import numpy as np
+import os
+import sqlite3
+import threading
+import time
+from langchain_core.documents import Document
+from typing import Any, Callable
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+def _serialize_documents(documents: list[Document]) -> str:
+    return json.dumps(
+        [{'id': document.id, 'page_content': document.page_content, 'metadata': document.metadata} for document in documents],
+        ensure_ascii=False
+    )
+
+def _deserialize_documents(value: str) -> list[Document]:
+    return [Document(**document) for document in json.loads(value)]
+
+def _normalize(embedding: list[float]) -> np.ndarray:
+    vector: np.ndarray = np.asarray(embedding, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+class SemanticSearchCache:
+    """
+    Cache of similarity search results keyed by the embedding of the query
+
+    A search is served from the cache when a previous search with the same k, filter and full-text query had a query
+    embedding whose cosine similarity is at least similarity_threshold, so the same query with slightly different
+    wording or casing doesn't hit the vector store again. Entries expire after ttl_seconds and are all invalidated once the ingest
+    generation changes, i.e., whenever the document loader has written to the vector store table (see
+    bump_ingest_generation). Entries are persisted to a SQLite file so they are shared across runs and agents, with the
+    normalized embeddings of the current generation kept in memory to compare against.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        get_generation: Callable[[], int],
+        similarity_threshold: float = 0.97,
+        ttl_seconds: float = 24 * 60 * 60,
+        max_entries: int = 10000,
+        generation_check_interval_seconds: float = 30.0,
+    ):
+        """
+        :param path: Path to the SQLite file, created along with its directory if missing
+        :param get_generation: Returns the current ingest generation of the vector store table, e.g.
+            lambda: get_ingest_generation(conninfo, 'vectorstore_generation', 'vectorstore')
+        :param similarity_threshold: Minimum cosine similarity of the query embeddings for a cached result to be used,
+            where 1 only matches the exact same query
+        :param ttl_seconds: Time after which a cached result is no longer used
+        :param max_entries: Maximum number of cached results, the oldest are evicted first
+        :param generation_check_interval_seconds: How often the ingest generation is checked, i.e., how long stale
+            results may still be served after the document loader has run
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.get_generation: Callable[[], int] = get_generation
+        self.similarity_threshold: float = similarity_threshold
+        self.ttl_seconds: float = ttl_seconds
+        self.max_entries: int = max_entries
+        self.generation_check_interval_seconds: float = generation_check_interval_seconds
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._conn: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS search_cache(
+                id INTEGER PRIMARY KEY,
+                generation INTEGER NOT NULL,
+                search_key TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                documents TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._generation: int | None = None
+        self._generation_checked_at: float = 0.0
+        # entries of the current generation by search key, i.e., k, filter and full-text query, as their row ids,
+        # creation times and a matrix of their normalized embeddings
+        self._entries: dict[str, tuple[list[int], list[float], np.ndarray]] = {}
+
+    def _check_generation(self) -> int:
+        now: float = time.monotonic()
+        if self._generation is not None and now - self._generation_checked_at < self.generation_check_interval_seconds:
+            return self._generation
+        generation: int = self.get_generation()
+        self._generation_checked_at = now
+        if generation != self._generation:
+            if self._generation is not None:
+                logger.info(f'Ingest generation changed from {self._generation} to {generation}, search cache invalidated')
+            self._generation = generation
+            self._load()
+        return generation
+
+    def _load(self) -> None:
+        self._conn.execute('DELETE FROM search_cache WHERE generation != ? OR created_at < ?', (
+            self._generation, time.time() - self.ttl_seconds
+        ))
+        rows = self._conn.execute('SELECT id, search_key, embedding, created_at FROM search_cache ORDER BY id').fetchall()
+        grouped: dict[str, tuple[list[int], list[float], list[np.ndarray]]] = {}
+        for id, search_key, embedding, created_at in rows:
+            ids, created, embeddings = grouped.setdefault(search_key, ([], [], []))
+            ids.append(id)
+            created.append(created_at)
+            embeddings.append(np.frombuffer(embedding, dtype=np.float32))
+        self._entries = {
+            search_key: (ids, created, np.vstack(embeddings)) for search_key, (ids, created, embeddings) in grouped.items()
+        }
+        logger.info(f'Loaded {len(rows)} cached search results for ingest generation {self._generation}')
+
+    @staticmethod
+    def search_key(
+        k: int, filter: dict[str, Any] | None, fts_query: str | None = None, index_query_options: list[str] | None = None
+    ) -> str:
+        return json.dumps(
+            {'k': k, 'filter': filter, 'fts_query': fts_query, 'index_query_options': index_query_options},
+            sort_keys=True,
+            default=str
+        )
+
+    def get(
+        self,
+        embedding: list[float],
+        k: int,
+        filter: dict[str, Any] | None = None,
+        fts_query: str | None = None,
+        index_query_options: list[str] | None = None,
+    ) -> list[Document] | None:
+        """
+        Looks up the result of the most similar cached search
+
+        :param embedding: Embedding of the query
+        :param k: Number of documents searched for
+        :param filter: Metadata filter of the search
+        :param fts_query: Full-text query of a hybrid search, only searches with the same full-text query match
+        :param index_query_options: Index query options the search overrode, e.g. ['hnsw.ef_search = 100']
+        :return: Documents of the cached search, None on a miss
+        """
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(self.search_key(k, filter, fts_query, index_query_options))
+            if entry is not None:
+                ids, created, embeddings = entry
+                similarities: np.ndarray = embeddings @ _normalize(embedding)
+                # expired entries are skipped here and removed the next time the entries are loaded
+                similarities[np.asarray(created) < time.time() - self.ttl_seconds] = -np.inf
+                best: int = int(similarities.argmax())
+                if similarities[best] >= self.similarity_threshold:
+                    row = self._conn.execute('SELECT documents FROM search_cache WHERE id = ?', (ids[best],)).fetchone()
+                    if row is not None:
+                        self.hits += 1
+                        return _deserialize_documents(row[0])
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        embedding: list[float],
+        k: int,
+        filter: dict[str, Any] | None,
+        documents: list[Document],
+        fts_query: str | None = None,
+        index_query_options: list[str] | None = None,
+    ) -> None:
+        """
+        Caches the result of a search
+
+        :param embedding: Embedding of the query
+        :param k: Number of documents searched for
+        :param filter: Metadata filter of the search
+        :param documents: Documents found
+        :param fts_query: Full-text query of a hybrid search
+        :param index_query_options: Index query options the search overrode
+        """
+        with self._lock:
+            generation: int = self._check_generation()
+            search_key: str = self.search_key(k, filter, fts_query, index_query_options)
+            normalized: np.ndarray = _normalize(embedding)
+            now: float = time.time()
+            id: int = self._conn.execute(
+                'INSERT INTO search_cache(generation, search_key, embedding, documents, created_at) VALUES (?, ?, ?, ?, ?)',
+                (generation, search_key, normalized.tobytes(), _serialize_documents(documents), now)
+            ).lastrowid
+            ids, created, embeddings = self._entries.get(search_key, ([], [], np.empty((0, normalized.size), dtype=np.float32)))
+            self._entries[search_key] = ([*ids, id], [*created, now], np.vstack([embeddings, normalized]))
+            if self._conn.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0] > self.max_entries:
+                # evict down to 90% of the limit so a full cache doesn't evict on every write
+                self._conn.execute(
+                    'DELETE FROM search_cache WHERE id NOT IN (SELECT id FROM search_cache ORDER BY id DESC LIMIT ?)',
+                    (int(self.max_entries * 0.9),)
+                )
+                self._load()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM search_cache')
+            self._entries.clear()
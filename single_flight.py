@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from langchain_core.runnables import RunnableConfig
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+logger: logging.Logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+class SingleFlight:
+    """
+    Runs the work for a key once and shares its result with every caller asking for the same key
+
+    Callers that arrive while the work is still running wait for it rather than starting it again, and callers that
+    arrive later get the result right away. Work that fails is forgotten so the next caller runs it again.
+    """
+
+    def __init__(self):
+        self.hits: int = 0
+        self.misses: int = 0
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, work: Callable[[], Awaitable[T]]) -> T:
+        """
+        :param key: Identifies the work, e.g. the name of the graph node along with the product it's run for
+        :param work: Runs the work, only called for the first caller of the key
+        :return: Result of the work
+        """
+        task: asyncio.Task | None = self._tasks.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(work())
+            task.add_done_callback(lambda done: self._forget_failed(key, done))
+            self._tasks[key] = task
+        else:
+            self.hits += 1
+            logger.info(f'Coalesced {key}')
+        # shielded so a caller that's cancelled doesn't cancel the work of the others
+        return await asyncio.shield(task)
+
+    def _forget_failed(self, key: Hashable, task: asyncio.Task) -> None:
+        if (task.cancelled() or task.exception() is not None) and self._tasks.get(key) is task:
+            del self._tasks[key]
+
+async def coalesce(config: RunnableConfig | None, key: Hashable, work: Callable[[], Awaitable[T]]) -> T:
+    """
+    Runs the work through the SingleFlight of the graph run, if any, e.g. one shared across the questions of a batch
+
+    :param config: Config of the graph node, with the SingleFlight under configurable.single_flight
+    :param key: Identifies the work
+    :param work: Runs the work
+    :return: Result of the work
+    """
+    single_flight: SingleFlight | None = (config or {}).get('configurable', {}).get('single_flight')
+    if single_flight is None:
+        return await work()
+    return await single_flight.do(key, work)
@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from benchmark_stubs import FakeS3Client, generate_corpus
+from ingestion_pipeline import build_ingestion_pipeline
+from json_chunker import JsonChunker
+from s3_utils import S3Object, list_objects
+
+BUCKET: str = 'benchmark'
+
+@pytest.fixture(scope='module')
+def s3_client() -> FakeS3Client:
+    s3_client: FakeS3Client = FakeS3Client()
+    for key, body in generate_corpus(objects=3, records_per_object=40, reviews=3, text_length=200):
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return s3_client
+
+def ingest(s3_client: FakeS3Client, **kwargs) -> list[Document]:
+    written: list[Document] = []
+
+    async def write_batch(batch: list[Document], vectors: list[list[float]]) -> list[str]:
+        written.extend(batch)
+        return [document.id for document in batch]
+
+    objects: list[S3Object] = list(list_objects(s3_client, BUCKET))
+    pipeline = build_ingestion_pipeline(
+        s3_client,
+        BUCKET,
+        [(obj, { 'source': f's3://{BUCKET}/{obj.key}', 'document_seq_num': i + 1 }) for i, obj in enumerate(objects)],
+        JsonChunker(max_chunk_size=500),
+        DeterministicFakeEmbedding(size=8),
+        write_batch,
+        max_concurrency=1,
+        max_write_concurrency=1,
+        s3_max_workers=4,
+        **kwargs
+    )
+    asyncio.run(pipeline.arun())
+    return written
+
+def test_ranged_objects_go_through_the_pipeline(s3_client: FakeS3Client) -> None:
+    whole: list[Document] = ingest(s3_client)
+    # every object is about 78 KB so each is fetched as dozens of ranges
+    ranged: list[Document] = ingest(s3_client, s3_range_threshold=1000, s3_part_size=1000)
+    assert [(document.metadata, document.page_content) for document in ranged] == \
+        [(document.metadata, document.page_content) for document in whole]
+    records: int = sum(
+        len(json.loads(s3_client.objects[BUCKET][obj.key][0])) for obj in list_objects(s3_client, BUCKET)
+    )
+    assert len({document.metadata['source'] for document in ranged}) == 3 and len(ranged) >= records
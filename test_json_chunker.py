@@ -0,0 +1,40 @@
+import random
+from typing import Any
+
+import pytest
+from langchain_text_splitters import RecursiveJsonSplitter
+
+from benchmark_stubs import generate_record
+from json_chunker import JsonChunker
+
+FIXTURES: list[dict[str, Any]] = [
+    {'title': 'Tesla Model Y', 'price_usd': 45000, 'awd': True, 'trim': None},
+    {
+        'vehicle': 'Kia EV6',
+        'specifications': {'range_km': 499, 'battery': {'kwh': 77.4, 'chemistry': 'NMC'}, 'drivetrain': 'AWD'},
+        'summary': 'comfortable cabin with a long range ' * 8,
+        'reviews': [{'rating': 4, 'pros': 'fast charging ' * 10}, {'rating': 2, 'cons': 'road noise ' * 10}],
+    },
+    {'a': {'b': {'c': {'d': {'e': 'deeply nested ' * 20}}}}, 'f': {'g': 'café ☃ ' * 30}},
+    *(generate_record(random.Random(seed), seed, reviews=3, text_length=120) for seed in range(3)),
+]
+
+@pytest.mark.parametrize('max_chunk_size', [50, 120, 300, 1000])
+@pytest.mark.parametrize('data', FIXTURES)
+def test_split_json_matches_recursive_json_splitter(data: dict[str, Any], max_chunk_size: int) -> None:
+    expected: list[dict[str, Any]] = RecursiveJsonSplitter(max_chunk_size=max_chunk_size).split_json(data)
+    assert list(JsonChunker(max_chunk_size=max_chunk_size).split_json(data)) == expected
+
+def test_create_documents_numbers_chunks_per_source() -> None:
+    chunker: JsonChunker = JsonChunker(max_chunk_size=120)
+    documents = list(chunker.create_documents([
+        (FIXTURES[1], {'source': 's3://raw/output-1.json'}),
+        (FIXTURES[2], {'source': 's3://raw/output-2.json'}),
+        (FIXTURES[1], {'source': 's3://raw/output-1.json'}),
+    ]))
+    for source in ('s3://raw/output-1.json', 's3://raw/output-2.json'):
+        seq_nums: list[int] = [
+            document.metadata['document_chunk_seq_num'] for document in documents
+            if document.metadata['source'] == source
+        ]
+        assert seq_nums == list(range(1, len(seq_nums) + 1))
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from json_stream import iter_json_array
+
+ARRAYS: list[str] = [
+    '[]',
+    '[1.5, 2]',
+    '[1e5, 2]',
+    '[-12.25E-3 , 0, 10]',
+    '[true, false, null, "a, ]"]',
+    '[{"product": "café", "scores": [1, 2.5, {"nested": -3e2}]}, "☃", 42]',
+]
+
+@pytest.mark.parametrize('text', ARRAYS)
+def test_iter_json_array_one_byte_per_chunk(text: str) -> None:
+    data: bytes = text.encode('utf-8')
+    chunks: list[bytes] = [data[i:i + 1] for i in range(len(data))]
+    assert list(iter_json_array(chunks)) == json.loads(text)
+
+@pytest.mark.parametrize('chunks', [[b'[1.', b'5, ', b'2]'], [b'[1', b'e5, 2]']])
+def test_iter_json_array_number_split_across_chunks(chunks: list[bytes]) -> None:
+    assert list(iter_json_array(chunks)) == json.loads(b''.join(chunks))
+
+@pytest.mark.parametrize('text', ['{"a": 1}', '[1, 2', '[1 2]'])
+def test_iter_json_array_rejects_malformed_input(text: str) -> None:
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array([text.encode('utf-8')]))
@@ -0,0 +1,87 @@
+import asyncio
+import math
+import socket
+import time
+from typing import Iterator
+
+import pytest
+
+from benchmark_stubs import StubEmbeddingServer
+from ollama_pool import OllamaPool, PooledOllamaEmbeddings
+
+@pytest.fixture(scope='module')
+def stub_server() -> Iterator[StubEmbeddingServer]:
+    with StubEmbeddingServer(dimensions=8, latency_seconds=0.0, latency_per_input_seconds=0.0) as server:
+        yield server
+
+@pytest.fixture
+def dead_base_url() -> str:
+    # a port that was just free has nothing listening on it, so connecting to it is refused
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+def test_requests_are_routed_around_a_dead_endpoint(stub_server: StubEmbeddingServer, dead_base_url: str) -> None:
+    pool: OllamaPool = OllamaPool(
+        [dead_base_url, stub_server.base_url], failure_threshold=1, health_check_interval_seconds=None
+    )
+    embeddings: PooledOllamaEmbeddings = PooledOllamaEmbeddings(pool=pool, model='stub')
+    for _ in range(5):
+        vectors: list[list[float]] = embeddings.embed_documents(['range', 'charging'])
+        assert len(vectors) == 2 and all(len(vector) == 8 for vector in vectors)
+    dead, live = pool.endpoints
+    # the first request was retried on the live endpoint and ejected the dead one for every request after it
+    assert dead.requests == 1 and dead.ejected_until > time.monotonic()
+    assert live.requests == 5 and live.outstanding == 0 and dead.outstanding == 0
+
+def test_async_requests_are_routed_around_a_dead_endpoint(stub_server: StubEmbeddingServer, dead_base_url: str) -> None:
+    pool: OllamaPool = OllamaPool([dead_base_url, stub_server.base_url], health_check_interval_seconds=None)
+    embeddings: PooledOllamaEmbeddings = PooledOllamaEmbeddings(pool=pool, model='stub')
+
+    async def embed() -> list[list[float]]:
+        return await asyncio.gather(*(embeddings.aembed_query(f'query {i}') for i in range(6)))
+
+    assert all(len(vector) == 8 for vector in asyncio.run(embed()))
+    assert pool.endpoints[1].requests == 6
+
+def test_check_health_ejects_and_readmits(stub_server: StubEmbeddingServer, dead_base_url: str) -> None:
+    pool: OllamaPool = OllamaPool([dead_base_url, stub_server.base_url], health_check_interval_seconds=None)
+    pool.check_health()
+    assert pool.endpoints[0].ejected_until == math.inf and pool.endpoints[1].ejected_until == 0.0
+    pool.endpoints[0].base_url = stub_server.base_url
+    pool.check_health()
+    assert pool.endpoints[0].ejected_until == 0.0
+
+def test_requests_go_to_the_least_outstanding_endpoint() -> None:
+    pool: OllamaPool = OllamaPool(['http://a', 'http://b'], max_concurrency=2, health_check_interval_seconds=None)
+
+    async def run() -> list[str]:
+        release: asyncio.Event = asyncio.Event()
+
+        async def request(base_url: str) -> str:
+            await release.wait()
+            return base_url
+
+        tasks: list[asyncio.Task] = [asyncio.create_task(pool.arun(request)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        # every endpoint is at max_concurrency so the fifth request waits for one to finish
+        assert [endpoint.outstanding for endpoint in pool.endpoints] == [2, 2]
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    base_urls: list[str] = asyncio.run(run())
+    assert sorted(base_urls.count(base_url) for base_url in ('http://a', 'http://b')) == [2, 3]
+    assert [endpoint.outstanding for endpoint in pool.endpoints] == [0, 0]
+
+def test_request_errors_are_not_retried() -> None:
+    pool: OllamaPool = OllamaPool(['http://a', 'http://b'], failure_threshold=1, health_check_interval_seconds=None)
+    attempts: list[str] = []
+
+    def request(base_url: str) -> None:
+        attempts.append(base_url)
+        raise ValueError('model not found')
+
+    with pytest.raises(ValueError):
+        pool.run(request)
+    assert len(attempts) == 1
+    assert all(endpoint.ejected_until == 0.0 and endpoint.outstanding == 0 for endpoint in pool.endpoints)
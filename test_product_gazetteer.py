@@ -0,0 +1,67 @@
+import pytest
+
+from product_gazetteer import AhoCorasick, ProductMatcher, normalize_text
+
+PRODUCTS: dict[str, list[str]] = {
+    'Tesla Model Y': [],
+    'Tesla Model 3': [],
+    'Tesla Cybertruck': [],
+    'Hyundai IONIQ 5': ['아이오닉5'],
+    'Kia EV6': [],
+    'Honda CR-V': [],
+}
+
+@pytest.fixture(scope='module')
+def matcher() -> ProductMatcher:
+    return ProductMatcher(PRODUCTS)
+
+def test_aho_corasick_finds_overlapping_patterns() -> None:
+    automaton: AhoCorasick = AhoCorasick({'he': 'HE', 'she': 'SHE', 'his': 'HIS', 'hers': 'HERS'})
+    assert sorted(automaton.find_all('ushers')) == [(1, 4, 'SHE'), (2, 4, 'HE'), (2, 6, 'HERS')]
+    assert list(automaton.find_all('xyz')) == []
+
+@pytest.mark.parametrize('text, expected', [
+    ('IONIQ5', 'ioniq 5'),
+    ('Ioniq-5', 'ioniq 5'),
+    ('테슬라 모델Y', '테슬라모델 y'),
+    ('ＣＲ－Ｖ', 'cr v'),
+])
+def test_normalize_text(text: str, expected: str) -> None:
+    assert normalize_text(text) == expected
+
+@pytest.mark.parametrize('question, expected', [
+    ('테슬라 모델 Y 가격은?', ['Tesla Model Y']),
+    ('테슬라모델Y랑 아이오닉5는 뭐가 달라?', ['Tesla Model Y', 'Hyundai IONIQ 5']),
+    ('현대 아이오닉 5 주행거리', ['Hyundai IONIQ 5']),
+    ('사이버트럭 출시일', ['Tesla Cybertruck']),
+    ('기아 EV6 충전 속도', ['Kia EV6']),
+])
+def test_match_korean_aliases(matcher: ProductMatcher, question: str, expected: list[str]) -> None:
+    assert matcher.match(question) == expected
+
+@pytest.mark.parametrize('question, expected', [
+    ('How far does the Model Y go?', ['Tesla Model Y']),
+    ('Is the Cybertruck bulletproof?', ['Tesla Cybertruck']),
+    ('IONIQ 5 or EV6?', ['Hyundai IONIQ 5', 'Kia EV6']),
+    ('Honda CRV cargo space', ['Honda CR-V']),
+])
+def test_match_brandless_aliases(matcher: ProductMatcher, question: str, expected: list[str]) -> None:
+    assert matcher.match(question) == expected
+
+def test_brandless_alias_shared_by_two_products_is_dropped() -> None:
+    matcher: ProductMatcher = ProductMatcher({'Kia Sportage': [], 'Hyundai Sportage': []})
+    assert matcher.match('Sportage mileage') == []
+    assert matcher.match('Kia Sportage mileage') == ['Kia Sportage']
+
+@pytest.mark.parametrize('question', [
+    'Model Y2 specs',
+    'Is there a Tesla Model Y2?',
+    'Model 35 range',
+    'EV60 price',
+    'modelsy',
+])
+def test_match_whole_words_only(matcher: ProductMatcher, question: str) -> None:
+    assert matcher.match(question) == []
+
+def test_match_prefers_leftmost_longest_mention(matcher: ProductMatcher) -> None:
+    assert matcher.match('Tesla Model 3 vs Model Y vs Tesla Model 3') == ['Tesla Model 3', 'Tesla Model Y']
@@ -0,0 +1,42 @@
+from concurrent.futures import Executor, Future
+from typing import Any, Callable
+
+from benchmark_stubs import FakeS3Client
+from s3_utils import iter_objects, list_objects
+
+BUCKET: str = 'raw'
+
+class ImmediateExecutor(Executor):
+    # runs every GET as it's submitted so the number of GETs is the number of objects or ranges fetched ahead
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        future: Future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+def put_objects(s3_client: FakeS3Client, sizes: list[int]) -> None:
+    for i, size in enumerate(sizes):
+        s3_client.put_object(Bucket=BUCKET, Key=f'output-{i}.json', Body=bytes([ord('a') + i]) * size)
+
+def test_iter_objects_limits_the_bytes_fetched_ahead() -> None:
+    s3_client: FakeS3Client = FakeS3Client()
+    put_objects(s3_client, [1000] * 6)
+    objects = iter_objects(
+        s3_client, BUCKET, list_objects(s3_client, BUCKET), ImmediateExecutor(), lookahead=16, max_buffer_bytes=2500
+    )
+    for i, (obj, chunks) in enumerate(objects):
+        # the object being consumed and the ones that fit in the buffer after it, but never more than the lookahead
+        assert s3_client.gets <= min(i + 3, 6)
+        assert b''.join(chunks) == s3_client.objects[BUCKET][obj.key][0]
+
+def test_iter_objects_fetches_large_objects_in_ranges_in_order() -> None:
+    s3_client: FakeS3Client = FakeS3Client()
+    put_objects(s3_client, [500, 10_000, 0, 2500])
+    objects = iter_objects(
+        s3_client, BUCKET, list_objects(s3_client, BUCKET), ImmediateExecutor(),
+        range_threshold=2000, part_size=1000, max_buffer_bytes=3000
+    )
+    contents: dict[str, bytes] = { obj.key: b''.join(chunks) for obj, chunks in objects }
+    assert contents == { key: body for key, (body, _) in s3_client.objects[BUCKET].items() }
+    # one GET per small object and one per range of the large ones
+    assert s3_client.gets == 1 + 10 + 1 + 3
@@ -0,0 +1,154 @@
+import copy
+import logging
+import psycopg
+import time
+from dataclasses import dataclass
+from langchain_postgres import PGVectorStore
+from langchain_postgres.v2.indexes import DEFAULT_INDEX_NAME_SUFFIX, BaseIndex, QueryOptions
+from psycopg import sql
+from pg_bulk_load import set_maintenance_options
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# pgvector can only build HNSW and IVFFlat indexes on vector columns of up to 2000 dimensions, halfvec goes up to 4000
+VECTOR_MAX_INDEX_DIMENSIONS: int = 2000
+HALFVEC_MAX_INDEX_DIMENSIONS: int = 4000
+
+@dataclass(frozen=True)
+class VectorIndexReport:
+    name: str
+    index_type: str
+    size_bytes: int
+    # None when the index already existed and wasn't rebuilt
+    build_seconds: float | None
+
+def default_index_name(table_name: str) -> str:
+    # same name PGVectorStore uses for areindex, adrop_vector_index and is_valid_index
+    return table_name + DEFAULT_INDEX_NAME_SUFFIX
+
+def get_column_type(conn: psycopg.Connection, table_name: str, column_name: str) -> str:
+    return conn.execute(
+        '''SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped''',
+        (sql.Identifier(table_name).as_string(conn), column_name)
+    ).fetchone()[0]
+
+def get_index_size(conn: psycopg.Connection, index_name: str) -> int:
+    return conn.execute(
+        'SELECT pg_relation_size(%s::regclass)', (sql.Identifier(index_name).as_string(conn),)
+    ).fetchone()[0]
+
+def ensure_indexable_column(conninfo: str, table_name: str, vector_size: int, embedding_column: str = 'embedding') -> str:
+    """
+    Converts the embedding column to halfvec when the embeddings have too many dimensions to be indexed as vector
+
+    PGVectorStore binds query embeddings as text so its queries work against either type unchanged, while halfvec halves
+    the storage of every embedding at the cost of precision that rarely changes the nearest neighbours.
+
+    :param conninfo: psycopg connection string
+    :param table_name: Vector store table
+    :param vector_size: Number of dimensions of the embeddings
+    :param embedding_column: Column the embeddings are stored in
+    :return: Type of the embedding column, i.e., vector or halfvec
+    :raises ValueError: if the embeddings have too many dimensions to be indexed at all
+    """
+    if vector_size > HALFVEC_MAX_INDEX_DIMENSIONS:
+        raise ValueError(f'{vector_size} dimensions is over the {HALFVEC_MAX_INDEX_DIMENSIONS} pgvector can index')
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        column_type: str = get_column_type(conn, table_name, embedding_column)
+        if vector_size > VECTOR_MAX_INDEX_DIMENSIONS and column_type.startswith('vector'):
+            started: float = time.perf_counter()
+            conn.execute(sql.SQL('ALTER TABLE {} ALTER COLUMN {} TYPE halfvec({}) USING {}::halfvec({})').format(
+                sql.Identifier(table_name),
+                sql.Identifier(embedding_column),
+                sql.Literal(vector_size),
+                sql.Identifier(embedding_column),
+                sql.Literal(vector_size)
+            ))
+            logger.info(
+                f'Converted {table_name}.{embedding_column} from {column_type} to halfvec({vector_size}) '
+                f'in {time.perf_counter() - started:.1f}s so it can be indexed'
+            )
+            column_type = f'halfvec({vector_size})'
+    return column_type.split('(')[0]
+
+def create_vector_index(
+    conninfo: str,
+    table_name: str,
+    index: BaseIndex,
+    embedding_column: str = 'embedding',
+    rebuild: bool = False,
+    maintenance_work_mem: str = '1GB',
+    max_parallel_maintenance_workers: int = 4,
+) -> VectorIndexReport:
+    """
+    Creates an approximate nearest neighbour index on the embedding column, or rebuilds it with new parameters
+
+    A rebuild builds the new index next to the existing one and swaps them in a single transaction so searches keep
+    using the old index until the new one is ready. The operator class follows the type of the column, e.g.
+    halfvec_cosine_ops once the column was converted by ensure_indexable_column.
+
+    :param conninfo: psycopg connection string
+    :param table_name: Vector store table
+    :param index: Index to create, e.g. HNSWIndex(m=16, ef_construction=64) or IVFFlatIndex(lists=100)
+    :param embedding_column: Column the embeddings are stored in
+    :param rebuild: Whether to rebuild the index if it already exists, i.e., after changing its parameters
+    :param maintenance_work_mem: Memory the build may use, HNSW builds that don't fit are much slower
+    :param max_parallel_maintenance_workers: Number of parallel workers the build may use
+    :return: Size of the index and how long it took to build
+    """
+    name: str = index.name or default_index_name(table_name)
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        exists: bool = conn.execute(
+            'SELECT to_regclass(%s) IS NOT NULL', (sql.Identifier(name).as_string(conn),)
+        ).fetchone()[0]
+        if exists and not rebuild:
+            size_bytes: int = get_index_size(conn, name)
+            logger.info(f'Index {name} already exists ({size_bytes / 1024 ** 2:.1f} MiB)')
+            return VectorIndexReport(name, index.index_type, size_bytes, None)
+        column_type: str = get_column_type(conn, table_name, embedding_column).split('(')[0]
+        # halfvec has the same operator classes as vector, e.g. halfvec_cosine_ops for vector_cosine_ops
+        operator_class: str = index.get_index_function().replace('vector', column_type, 1)
+        build_name: str = f'{name}_rebuild' if exists else name
+        set_maintenance_options(conn, maintenance_work_mem, max_parallel_maintenance_workers)
+        started: float = time.perf_counter()
+        conn.execute(sql.SQL('DROP INDEX IF EXISTS {}').format(sql.Identifier(build_name)))
+        conn.execute(sql.SQL('CREATE INDEX {} ON {} USING {} ({} {}) WITH {}').format(
+            sql.Identifier(build_name),
+            sql.Identifier(table_name),
+            sql.SQL(index.index_type),
+            sql.Identifier(embedding_column),
+            sql.SQL(operator_class),
+            sql.SQL(index.index_options())
+        ))
+        build_seconds: float = time.perf_counter() - started
+        if exists:
+            with conn.transaction():
+                conn.execute(sql.SQL('DROP INDEX {}').format(sql.Identifier(name)))
+                conn.execute(sql.SQL('ALTER INDEX {} RENAME TO {}').format(sql.Identifier(build_name), sql.Identifier(name)))
+        size_bytes = get_index_size(conn, name)
+    logger.info(
+        f'{"Rebuilt" if exists else "Built"} {index.index_type} index {name} on {table_name}.{embedding_column} '
+        f'({operator_class}) in {build_seconds:.1f}s ({size_bytes / 1024 ** 2:.1f} MiB)'
+    )
+    return VectorIndexReport(name, index.index_type, size_bytes, build_seconds)
+
+def with_index_query_options(vector_store: PGVectorStore, index_query_options: QueryOptions) -> PGVectorStore:
+    """
+    Copies a vector store to search it with other index query options, e.g. a higher ef_search for better recall
+
+    PGVectorStore only applies the index query options it was created with (with SET LOCAL before every search), so the
+    copy shares the engine and embedding service of the vector store and only differs in its index query options.
+
+    :param vector_store: Vector store to copy
+    :param index_query_options: Options of the copy, e.g. HNSWQueryOptions(ef_search=100) or IVFFlatQueryOptions(probes=10)
+    :return: Copy of the vector store
+    """
+    if not isinstance(vector_store, PGVectorStore):
+        raise TypeError(f'Index query options are only supported by PGVectorStore, not {type(vector_store).__name__}')
+    # PGVectorStore keeps its AsyncPGVectorStore, which holds the options, in a private attribute
+    async_vector_store = copy.copy(vector_store._PGVectorStore__vs)
+    async_vector_store.index_query_options = index_query_options
+    copied: PGVectorStore = copy.copy(vector_store)
+    copied._PGVectorStore__vs = async_vector_store
+    return copied
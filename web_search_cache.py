@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from langchain_tavily._utilities import TavilySearchAPIWrapper
+from pydantic import ConfigDict
+from tavily import AsyncTavilyClient
+from typing import Any
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+def normalize_query(query: str) -> str:
+    # searches that only differ in casing or whitespace return the same results
+    return ' '.join(query.lower().split())
+
+class WebSearchCache:
+    """
+    Cache of web search responses keyed by the normalized query and the parameters of the search
+
+    Responses are persisted to a SQLite file so they are shared across runs and agents, and expire after ttl_seconds
+    unless they are replayed offline (see CachedTavilyClient), in which case the file serves as a recording of every
+    search made while online.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 7 * 24 * 60 * 60, max_entries: int = 10000):
+        """
+        :param path: Path to the SQLite file, created along with its directory if missing
+        :param ttl_seconds: Time after which a cached response is searched for again
+        :param max_entries: Maximum number of cached responses, the oldest are evicted first
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl_seconds: float = ttl_seconds
+        self.max_entries: int = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._conn: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS web_search_cache(
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                params TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+
+    @staticmethod
+    def search_key(query: str, params: dict[str, Any]) -> str:
+        # parameters left unset are the same as not passing them at all
+        return hashlib.sha256(json.dumps(
+            {'query': normalize_query(query), 'params': {k: v for k, v in params.items() if v is not None}},
+            sort_keys=True,
+            default=str
+        ).encode('utf-8')).hexdigest()
+
+    def get(self, query: str, params: dict[str, Any], ignore_ttl: bool = False) -> dict[str, Any] | None:
+        """
+        Looks up the cached response of a search
+
+        :param query: Query searched for
+        :param params: Parameters of the search other than the query, e.g. max_results
+        :param ignore_ttl: Returns expired responses as well, e.g. to replay them offline
+        :return: Cached response, None on a miss
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response FROM web_search_cache WHERE key = ? AND created_at >= ?',
+                (self.search_key(query, params), 0.0 if ignore_ttl else time.time() - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, query: str, params: dict[str, Any], response: dict[str, Any]) -> None:
+        """
+        Caches the response of a search
+
+        :param query: Query searched for
+        :param params: Parameters of the search other than the query
+        :param response: Response of the search
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO web_search_cache(key, query, params, response, created_at) VALUES (?, ?, ?, ?, ?)',
+                (
+                    self.search_key(query, params),
+                    query,
+                    json.dumps(params, sort_keys=True, default=str),
+                    json.dumps(response, ensure_ascii=False),
+                    time.time()
+                )
+            )
+            if self._conn.execute('SELECT COUNT(*) FROM web_search_cache').fetchone()[0] > self.max_entries:
+                # evict down to 90% of the limit so a full cache doesn't evict on every write
+                self._conn.execute(
+                    'DELETE FROM web_search_cache WHERE key NOT IN '
+                    '(SELECT key FROM web_search_cache ORDER BY created_at DESC LIMIT ?)',
+                    (int(self.max_entries * 0.9),)
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM web_search_cache')
+
+class CachedTavilyClient:
+    """
+    Stand-in for AsyncTavilyClient that serves searches from a WebSearchCache
+
+    Online, a search that isn't cached (or has expired) goes to Tavily and its response is cached. Offline, no client
+    is needed and the cached responses are replayed regardless of their age, so the agents can be run and benchmarked
+    without network access once the searches have been recorded by an online run.
+    """
+
+    def __init__(self, client: AsyncTavilyClient | None, cache: WebSearchCache, offline: bool = False):
+        """
+        :param client: Client the searches that aren't cached are sent to, may be None when offline
+        :param cache: Cache of the responses
+        :param offline: Only replays cached responses, raising LookupError for any search that wasn't recorded
+        """
+        if client is None and not offline:
+            raise ValueError('A Tavily client is required unless offline')
+        self.client: AsyncTavilyClient | None = client
+        self.cache: WebSearchCache = cache
+        self.offline: bool = offline
+
+    async def search(self, query: str, **kwargs: Any) -> dict[str, Any]:
+        """
+        Searches the web, see AsyncTavilyClient.search
+
+        :param query: Query to search for
+        :param kwargs: Parameters of the search, e.g. max_results, which are part of the cache key
+        :return: Response of the search
+        """
+        response: dict[str, Any] | None = await asyncio.to_thread(self.cache.get, query, kwargs, ignore_ttl=self.offline)
+        if response is not None:
+            logger.info(f'Query: "{query}" served from web search cache')
+            return response
+        if self.offline:
+            raise LookupError(f'Query: "{query}" was never recorded in the web search cache')
+        response = await self.client.search(query, **kwargs)
+        await asyncio.to_thread(self.cache.put, query, kwargs, response)
+        return response
+
+class CachedTavilySearchAPIWrapper(TavilySearchAPIWrapper):
+    """
+    TavilySearchAPIWrapper that serves searches from a WebSearchCache the same way as CachedTavilyClient, for the
+    TavilySearch tool, e.g. TavilySearch(api_wrapper=CachedTavilySearchAPIWrapper(...), max_results=3)
+    """
+    cache: WebSearchCache
+    offline: bool = False
+
+    model_config = ConfigDict(extra='forbid', arbitrary_types_allowed=True)
+
+    def raw_results(self, query: str, **kwargs: Any) -> dict[str, Any]:
+        response: dict[str, Any] | None = self.cache.get(query, kwargs, ignore_ttl=self.offline)
+        if response is not None:
+            logger.info(f'Query: "{query}" served from web search cache')
+            return response
+        if self.offline:
+            raise LookupError(f'Query: "{query}" was never recorded in the web search cache')
+        response = super().raw_results(query, **kwargs)
+        self.cache.put(query, kwargs, response)
+        return response
+
+    async def raw_results_async(self, query: str, **kwargs: Any) -> dict[str, Any]:
+        response: dict[str, Any] | None = await asyncio.to_thread(self.cache.get, query, kwargs, ignore_ttl=self.offline)
+        if response is not None:
+            logger.info(f'Query: "{query}" served from web search cache')
+            return response
+        if self.offline:
+            raise LookupError(f'Query: "{query}" was never recorded in the web search cache')
+        response = await super().raw_results_async(query, **kwargs)
+        await asyncio.to_thread(self.cache.put, query, kwargs, response)
+        return response